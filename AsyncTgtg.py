@@ -0,0 +1,106 @@
+import time
+import asyncio
+
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+from tgtg.exceptions import TgtgAPIError, TgtgLoginError
+
+from Metrics import TGTG_REQUEST_SECONDS
+
+
+def shared_http_adapter(pool_size: int) -> HTTPAdapter:
+    """One connection pool for every client: keep-alive connections to the TGTG host are reused across users"""
+    return HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+
+
+class AsyncTgtgClient:
+    """
+    Awaitable facade of a TgtgClient. The tgtg library is built on requests, its blocking calls run on a bounded
+    executor so the bot and the poller share one event loop. Attributes are read from the wrapped client.
+    Calls of one client never overlap, a token refresh rotates the refresh token the other call would use.
+    Calls of every client are paced by the shared request budget.
+    """
+
+    def __init__(self, client, executor=None, http_adapter=None, budget=None):
+        self.client = client
+        self.executor = executor
+        self.budget = budget
+        # bound to the loop it is first contended on, TooGoodToGo.start() replaces it on a new loop
+        self.lock = asyncio.Lock()
+        # size and duration of the last call, for the usage stats
+        self.response_bytes = 0
+        self.last_elapsed = 0.0
+        client.session.hooks['response'].append(self.count_response)
+
+        if http_adapter is not None:
+            # the session keeps its own headers and cookies, only the transport is shared
+            for prefix, adapter in list(client.session.adapters.items()):
+                adapter.close()
+                client.session.mount(prefix, http_adapter)
+
+    def count_response(self, response, *args, **kwargs):
+        # wire size when known, gzip responses may come without Content-Length
+        self.response_bytes += int(response.headers.get('Content-Length') or len(response.content))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def run(self, method, *args, **kwargs):
+        async with self.lock:
+            self.response_bytes = 0
+            self.last_elapsed = 0.0
+            if self.budget:
+                try:
+                    await self.budget.acquire()
+                except asyncio.CancelledError:
+                    self.budget.release()
+                    raise
+            loop = asyncio.get_running_loop()
+            # timed in the worker thread so the executor queue is not counted, observed back on the loop
+            elapsed = [0.0]
+
+            def call():
+                started = time.perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    elapsed[0] = time.perf_counter() - started
+
+            status = 200
+            try:
+                return await loop.run_in_executor(self.executor, call)
+            except (TgtgAPIError, TgtgLoginError) as err:
+                # the HTTP status, else a state of the answer such as an unknown email
+                status = err.args[0] if len(err.args) == 2 and isinstance(err.args[0], int) else 'rejected'
+                raise
+            except RequestException:
+                # no usable answer: connection error, timeout, garbled body
+                status = 'error'
+                raise
+            except asyncio.CancelledError:
+                # e.g. on shutdown, the answer is never seen so it is neither a success nor a failure
+                status = 'cancelled'
+                raise
+            except Exception:
+                # TgtgPollingError and the like, TGTG answered
+                status = 'rejected'
+                raise
+            finally:
+                self.last_elapsed = elapsed[0]
+                TGTG_REQUEST_SECONDS.observe(elapsed[0], method.__name__, status)
+                if self.budget and status == 'cancelled':
+                    self.budget.release()
+                elif self.budget:
+                    self.budget.record(status)
+
+    async def login(self):
+        return await self.run(self.client.login)
+
+    async def get_credentials(self):
+        return await self.run(self.client.get_credentials)
+
+    async def get_items(self, **kwargs):
+        return await self.run(self.client.get_items, **kwargs)
+
+    async def get_item(self, item_id):
+        return await self.run(self.client.get_item, item_id)
@@ -0,0 +1,327 @@
+"""
+Load test of the poller against local stand-in servers of the TGTG API and the Telegram Bot API.
+
+    python Benchmark.py --users 1000 --favorites 5 --items 2000 --duration 60
+
+The stand-in servers run in a child process so the CPU and memory reported are the bot's own.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import multiprocessing
+from datetime import datetime
+from urllib.parse import parse_qsl
+
+from aiohttp import web, ClientSession
+
+import tgtg
+import telebot.asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ITEM_URL = re.compile(r'share\.toogoodtogo\.com/item/(\w+)')
+
+
+def percentile(values, ratio):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def synthetic_favourites(users, items, favorites, zipf, seed):
+    """Favorites per user, popular items are shared by many users following a zipf distribution"""
+    generator = random.Random(seed)
+    item_ids = [str(100000 + number) for number in range(items)]
+    weights = [1 / (rank + 1) ** zipf for rank in range(items)]
+    user_favourites = {}
+    for number in range(users):
+        picked = set(generator.choices(item_ids, weights, k=favorites))
+        user_favourites[str(1000000 + number)] = sorted(picked)
+    return user_favourites
+
+
+class FakeTgtgApi:
+    """Answers the favorites and token refresh endpoints, restocks and sells items at random"""
+
+    def __init__(self, user_favourites, latency_ms, jitter_ms, error_rate, change_rate, seed):
+        self.user_favourites = user_favourites
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.change_rate = change_rate
+        self.random = random.Random(seed)
+
+        item_ids = {item_id for favourites in user_favourites.values() for item_id in favourites}
+        self.stock = {item_id: self.random.choice((0, 0, 1, 3)) for item_id in item_ids}
+        self.changed_at = {}
+        self.requests = {}
+        self.errors = 0
+
+    def item(self, item_id):
+        return {
+            'item': {
+                'item_id': item_id,
+                'item_price': {'code': 'EUR', 'minor_units': 399, 'decimals': 2},
+                'taxation_policy': 'PRICE_INCLUDES_TAXES',
+                'sales_taxes': [],
+                'price_including_taxes': {'code': 'EUR', 'minor_units': 399, 'decimals': 2},
+                'value_including_taxes': {'code': 'EUR', 'minor_units': 1200, 'decimals': 2},
+            },
+            'store': {
+                'store_name': f'Store {item_id}',
+                'store_location': {'address': {'address_line': f'{item_id} Benchmark Street'}},
+            },
+            'items_available': self.stock[item_id],
+            'pickup_interval': {'start': '2024-01-01T17:00:00Z', 'end': '2024-01-01T18:00:00Z'},
+        }
+
+    async def respond(self, endpoint):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        await asyncio.sleep(max(0.0, self.random.gauss(self.latency, self.jitter)))
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=500, text='stand-in error')
+        return None
+
+    async def items(self, request):
+        error = await self.respond('item')
+        if error:
+            return error
+        data = await request.json()
+        favourites = self.user_favourites.get(str(data['user_id']), [])
+        return web.json_response({'items': [self.item(item_id) for item_id in favourites]})
+
+    async def refresh(self, request):
+        error = await self.respond('refresh')
+        if error:
+            return error
+        return web.json_response({'access_token': 'access', 'refresh_token': 'refresh'},
+                                 headers={'Set-Cookie': 'datadome=benchmark'})
+
+    async def change_stock(self):
+        """Every second each item changes with change_rate probability"""
+        while True:
+            await asyncio.sleep(1)
+            now = time.time()
+            for item_id, items_available in self.stock.items():
+                if self.random.random() >= self.change_rate:
+                    continue
+                if items_available == 0:
+                    self.stock[item_id] = self.random.randint(1, 5)
+                elif self.random.random() < 0.3:
+                    self.stock[item_id] = 0
+                else:
+                    self.stock[item_id] = max(0, items_available + self.random.choice((-1, 1)))
+                self.changed_at[item_id] = now
+
+
+class FakeTelegramApi:
+    """Accepts the bot calls and measures how long after the stock change each alert arrives"""
+
+    def __init__(self, tgtg_api: FakeTgtgApi):
+        self.tgtg_api = tgtg_api
+        self.message_id = 0
+        self.methods = {}
+        self.latencies = []
+
+    async def method(self, request):
+        method = request.match_info['method']
+        self.methods[method] = self.methods.get(method, 0) + 1
+        if method != 'sendMessage':
+            return web.json_response({'ok': True, 'result': True})
+
+        # the bot sends its parameters urlencoded, with GET requests
+        form = dict(parse_qsl(await request.text()))
+        now = time.time()
+        for item_id in ITEM_URL.findall(form.get('reply_markup', '')):
+            changed_at = self.tgtg_api.changed_at.get(item_id)
+            if changed_at:
+                self.latencies.append(now - changed_at)
+
+        self.message_id += 1
+        return web.json_response({'ok': True, 'result': {
+            'message_id': self.message_id,
+            'date': int(now),
+            'chat': {'id': int(form['chat_id']), 'type': 'private'},
+            'text': form.get('text', ''),
+        }})
+
+    async def stats(self, request):
+        return web.json_response({
+            'tgtg_requests': self.tgtg_api.requests,
+            'tgtg_errors': self.tgtg_api.errors,
+            'telegram_methods': self.methods,
+            'notification_latencies': self.latencies,
+        })
+
+
+def serve(args, user_favourites, connection):
+    """Child process: run both stand-in servers until killed"""
+    async def main():
+        tgtg_api = FakeTgtgApi(user_favourites, args.latency_ms, args.jitter_ms, args.error_rate, args.change_rate, args.seed)
+        telegram_api = FakeTelegramApi(tgtg_api)
+
+        tgtg_app = web.Application()
+        tgtg_app.router.add_post('/api/item/v8/', tgtg_api.items)
+        tgtg_app.router.add_post('/api/auth/v3/token/refresh', tgtg_api.refresh)
+
+        telegram_app = web.Application()
+        telegram_app.router.add_route('*', '/bot{token}/{method}', telegram_api.method)
+        telegram_app.router.add_get('/stats', telegram_api.stats)
+
+        ports = []
+        for app in (tgtg_app, telegram_app):
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            ports.append(runner.addresses[0][1])
+
+        connection.send(ports)
+        await tgtg_api.change_stock()
+
+    asyncio.run(main())
+
+
+async def run_benchmark(args, user_favourites, tgtg_port, telegram_port):
+    # imported here so the working directory (data folder) is the temporary one
+    from TooGoodToGo import TooGoodToGo
+
+    telebot.asyncio_helper.API_URL = f'http://127.0.0.1:{telegram_port}/bot{{0}}/{{1}}'
+    # offline: the user agent lookup on Google Play is not part of what is measured
+    tgtg.get_last_apk_version = lambda: tgtg.DEFAULT_APK_VERSION
+
+    config = {
+        'tgtg_url': f'http://127.0.0.1:{tgtg_port}/api/',
+        'interval_seconds': args.interval,
+        'low_hours_start': 0,
+        'low_hours_end': 0,
+        'polling_concurrency': args.concurrency,
+        'http_pool_size': args.concurrency,
+        'tgtg_requests_per_second': args.tgtg_rate,
+        'capture_file': args.capture or '',
+    }
+    bot = AsyncTeleBot('0:benchmark')
+    tooGoodToGo = TooGoodToGo(bot, config)
+
+    for user_id in user_favourites:
+        tooGoodToGo.users_login_data[user_id] = {
+            'user_id': user_id,
+            'access_token': 'access',
+            'refresh_token': 'refresh',
+            'cookie': 'datadome=benchmark',
+            'email': f'{user_id}@example.com',
+            'telegram_username': user_id,
+            'last_time_token_refreshed': datetime.now(),
+        }
+        tooGoodToGo.users_settings_data[user_id] = {status: 1 for status in TooGoodToGo.ITEM_STATUS}
+    tooGoodToGo.update_eligible_users()
+
+    batches = []
+    poll_users = tooGoodToGo.poll_users
+
+    async def timed_poll_users(due_users):
+        started = time.perf_counter()
+        await poll_users(due_users)
+        batches.append((time.perf_counter() - started, len(due_users)))
+
+    tooGoodToGo.poll_users = timed_poll_users
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    await tooGoodToGo.start()
+    await asyncio.sleep(args.duration)
+    await tooGoodToGo.stop()
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    await bot.close_session()
+
+    async with ClientSession() as session:
+        async with session.get(f'http://127.0.0.1:{telegram_port}/stats') as response:
+            stats = await response.json()
+
+    item_requests = stats['tgtg_requests'].get('item', 0)
+    latencies = stats['notification_latencies']
+    durations = [duration for duration, _ in batches]
+    return {
+        'users': len(user_favourites),
+        'distinct_items': len({item_id for favourites in user_favourites.values() for item_id in favourites}),
+        'duration_seconds': round(elapsed, 2),
+        'poll_batches': len(batches),
+        'users_per_batch': round(sum(users for _, users in batches) / len(batches), 1) if batches else 0,
+        'batch_seconds_avg': round(sum(durations) / len(durations), 3) if durations else 0,
+        'batch_seconds_p95': round(percentile(durations, 0.95), 3),
+        'batch_seconds_max': round(max(durations, default=0), 3),
+        'tgtg_requests': stats['tgtg_requests'],
+        'tgtg_errors': stats['tgtg_errors'],
+        'tgtg_item_requests_per_batch': round(item_requests / len(batches), 1) if batches else 0,
+        'notifications': stats['telegram_methods'].get('sendMessage', 0),
+        'notification_latency_avg': round(sum(latencies) / len(latencies), 3) if latencies else 0,
+        'notification_latency_p50': round(percentile(latencies, 0.5), 3),
+        'notification_latency_p95': round(percentile(latencies, 0.95), 3),
+        'outbound_queue': tooGoodToGo.dispatcher.stats()['queue_depth'],
+        'cpu_seconds': round(cpu, 2),
+        'cpu_percent': round(100 * cpu / elapsed, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100, help='synthetic users, 10 to 10000')
+    parser.add_argument('--favorites', type=int, default=5, help='favorites per user')
+    parser.add_argument('--items', type=int, default=500, help='size of the item catalog')
+    parser.add_argument('--zipf', type=float, default=1.1, help='popularity skew of the favorites, 0 is uniform')
+    parser.add_argument('--latency-ms', type=float, default=80, help='mean TGTG response time')
+    parser.add_argument('--jitter-ms', type=float, default=20, help='standard deviation of the response time')
+    parser.add_argument('--tgtg-rate', type=float, default=0, help='TGTG requests per second budget, 0 for unlimited')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of TGTG requests answered with 500')
+    parser.add_argument('--change-rate', type=float, default=0.01, help='probability per item and second of a stock change')
+    parser.add_argument('--interval', type=int, default=5, help='interval_seconds of the bot')
+    parser.add_argument('--concurrency', type=int, default=8, help='polling_concurrency of the bot')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--capture', help='record the TGTG responses to this file, see Replay.py')
+    args = parser.parse_args()
+    if args.capture:
+        args.capture = os.path.abspath(args.capture)
+
+    user_favourites = synthetic_favourites(args.users, args.items, args.favorites, args.zipf, args.seed)
+
+    parent_connection, child_connection = multiprocessing.Pipe()
+    servers = multiprocessing.Process(target=serve, args=(args, user_favourites, child_connection), daemon=True)
+    servers.start()
+    tgtg_port, telegram_port = parent_connection.recv()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    working_directory = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as data_directory:
+            os.chdir(data_directory)
+            report = asyncio.run(run_benchmark(args, user_favourites, tgtg_port, telegram_port))
+    finally:
+        os.chdir(working_directory)
+        servers.terminate()
+
+    for key, value in report.items():
+        print(f'{key:32} {value}')
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import gzip
+import json
+import time
+
+
+class CaptureWriter:
+    """
+    Appends the TGTG responses of the poller to a gzip file of json lines, one {"t", "user", "items"} per response.
+    The file is flushed after every poll batch so it can be read while recording, Replay.py plays it back.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'at', encoding='utf-8')
+        self.records = 0
+
+    def write(self, user_id, items, now=None):
+        self.file.write(json.dumps({'t': now if now is not None else time.time(), 'user': user_id, 'items': items},
+                                   separators=(',', ':')))
+        self.file.write('\n')
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """Records of a capture file in order, a file cut while recording ends at its last complete line"""
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        try:
+            for line in file:
+                if line.endswith('\n'):
+                    yield json.loads(line)
+        except EOFError:
+            return
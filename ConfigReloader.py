@@ -0,0 +1,71 @@
+import os
+import signal
+import asyncio
+import configparser
+
+
+class ConfigReloader:
+    """
+    Reads a section of the config file again on SIGHUP, and when the file changes if check_seconds is set, and passes
+    it to apply. A file that cannot be read or applied is reported and the running values are kept.
+    """
+
+    def __init__(self, path, section, apply, check_seconds=10, forward_to=()):
+        self.path = path
+        self.section = section
+        self.apply = apply
+        self.check_seconds = check_seconds
+        # child processes SIGHUP is passed on to
+        self.forward_to = forward_to
+        self.modified_at = self.file_modified_at()
+        self.watcher = None
+
+    def file_modified_at(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload(self):
+        self.modified_at = self.file_modified_at()
+        config = configparser.ConfigParser(interpolation=None)
+        try:
+            if not config.read(self.path):
+                raise FileNotFoundError(self.path)
+            self.apply(config[self.section])
+        except Exception as err:
+            print(f"Config not reloaded, keeping the running values {err=}")
+
+    def signalled(self):
+        print(f"SIGHUP received, reloading {self.path}")
+        self.reload()
+        for process in self.forward_to:
+            if process.poll() is None:
+                process.send_signal(signal.SIGHUP)
+
+    def start(self):
+        """Install the SIGHUP handler and start the file watch on the running event loop"""
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.signalled)
+        except (NotImplementedError, AttributeError):  # Windows
+            pass
+        if self.check_seconds:
+            self.watcher = asyncio.create_task(self.watch(), name='config-watch')
+
+    async def stop(self):
+        try:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        except (NotImplementedError, AttributeError):
+            pass
+        if self.watcher:
+            self.watcher.cancel()
+            await asyncio.gather(self.watcher, return_exceptions=True)
+            self.watcher = None
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.check_seconds)
+            modified_at = self.file_modified_at()
+            if modified_at is not None and modified_at != self.modified_at:
+                print(f"{self.path} changed, reloading")
+                self.reload()
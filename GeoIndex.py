@@ -0,0 +1,139 @@
+import math
+
+KM_PER_DEGREE = 111.32
+EARTH_RADIUS_KM = 6371.0
+# the item_category values of TGTG, by the name users give them
+CATEGORIES = {
+    'meals': 'MEAL',
+    'bakery': 'BAKED_GOODS',
+    'groceries': 'GROCERIES',
+    'other': 'OTHER',
+}
+
+
+def distance_km(latitude1, longitude1, latitude2, longitude2) -> float:
+    """Haversine distance"""
+    latitude1, longitude1, latitude2, longitude2 = map(math.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = (math.sin((latitude2 - latitude1) / 2) ** 2
+         + math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def parse_category(text) -> str:
+    """The item_category of a name of CATEGORIES or of an item_category itself, ValueError for any other"""
+    name = text.strip().lower().replace(' ', '_')
+    if name in CATEGORIES:
+        return CATEGORIES[name]
+    if name.upper() in CATEGORIES.values():
+        return name.upper()
+    raise ValueError(f"Unknown category {text}")
+
+
+def item_location(item):
+    location = item['store']['store_location']['location']
+    return float(location['latitude']), float(location['longitude'])
+
+
+def item_price(item) -> float:
+    price = item['item'].get('price_including_taxes') or item['item']['item_price']
+    return price['minor_units'] / 10 ** price['decimals']
+
+
+class GeoIndex:
+    """
+    Location subscriptions snapped to a grid of tiles of about tile_km x tile_km. A tile is queried once for all the
+    subscribers whose circle touches it, and a fetched item is matched against the subscribers of its own tile only.
+    A subscription is a dict of latitude, longitude, radius_km and the optional max_price and category filters.
+    """
+
+    def __init__(self, tile_km=5.0):
+        self.tile_km = tile_km
+        self.latitude_step = tile_km / KM_PER_DEGREE
+        self.subscriptions = {}
+        # tile -> user ids, user id -> tiles
+        self.tiles = {}
+        self.user_tiles = {}
+
+    def longitude_step(self, row) -> float:
+        # the width of a degree of longitude at the row edge closest to a pole, tiles stay at least tile_km wide
+        edge_latitude = min(89.0, max(abs(row), abs(row + 1)) * self.latitude_step)
+        return self.tile_km / (KM_PER_DEGREE * math.cos(math.radians(edge_latitude)))
+
+    def tile_of(self, latitude, longitude):
+        row = math.floor(latitude / self.latitude_step)
+        return row, math.floor(longitude / self.longitude_step(row))
+
+    def tile_query(self, tile):
+        """(latitude, longitude, radius_km) of the circle around the tile"""
+        row, column = tile
+        longitude_step = self.longitude_step(row)
+        latitude = (row + 0.5) * self.latitude_step
+        longitude = (column + 0.5) * longitude_step
+        half_width = longitude_step * KM_PER_DEGREE * math.cos(math.radians(latitude)) / 2
+        return latitude, longitude, math.ceil(math.hypot(self.tile_km / 2, half_width))
+
+    def tiles_of(self, latitude, longitude, radius_km):
+        """Tiles of the bounding box of a circle"""
+        latitude_radius = radius_km / KM_PER_DEGREE
+        first_row = math.floor((latitude - latitude_radius) / self.latitude_step)
+        last_row = math.floor((latitude + latitude_radius) / self.latitude_step)
+        tiles = []
+        for row in range(first_row, last_row + 1):
+            edge_latitude = min(89.0, max(abs(row), abs(row + 1)) * self.latitude_step)
+            longitude_radius = radius_km / (KM_PER_DEGREE * math.cos(math.radians(edge_latitude)))
+            longitude_step = self.longitude_step(row)
+            first_column = math.floor((longitude - longitude_radius) / longitude_step)
+            last_column = math.floor((longitude + longitude_radius) / longitude_step)
+            tiles.extend((row, column) for column in range(first_column, last_column + 1))
+        return tiles
+
+    def subscribe(self, user_id, subscription: dict):
+        self.unsubscribe(user_id)
+        self.subscriptions[user_id] = subscription
+        tiles = self.tiles_of(subscription['latitude'], subscription['longitude'], subscription['radius_km'])
+        self.user_tiles[user_id] = tiles
+        for tile in tiles:
+            self.tiles.setdefault(tile, set()).add(user_id)
+
+    def unsubscribe(self, user_id):
+        self.subscriptions.pop(user_id, None)
+        for tile in self.user_tiles.pop(user_id, ()):
+            subscribers = self.tiles[tile]
+            subscribers.discard(user_id)
+            if not subscribers:
+                del self.tiles[tile]
+
+    def clear(self):
+        self.subscriptions.clear()
+        self.tiles.clear()
+        self.user_tiles.clear()
+
+    def active_tiles(self, user_ids):
+        """Tiles with at least one subscriber in user_ids, with those subscribers"""
+        return {tile: subscribers & user_ids for tile, subscribers in self.tiles.items() if not subscribers.isdisjoint(user_ids)}
+
+    def matches(self, item) -> set:
+        """Subscribers whose circle and filters match the item"""
+        try:
+            latitude, longitude = item_location(item)
+        except (KeyError, TypeError, ValueError):
+            return set()
+
+        subscribers = self.tiles.get(self.tile_of(latitude, longitude))
+        if not subscribers:
+            return set()
+
+        matches = set()
+        for user_id in subscribers:
+            subscription = self.subscriptions[user_id]
+            if distance_km(latitude, longitude, subscription['latitude'], subscription['longitude']) > subscription['radius_km']:
+                continue
+            if subscription.get('max_price') is not None and item_price(item) > subscription['max_price']:
+                continue
+            if subscription.get('category') and item['item'].get('item_category') != subscription['category']:
+                continue
+            matches.add(user_id)
+        return matches
+
+    def __len__(self):
+        return len(self.subscriptions)
@@ -0,0 +1,152 @@
+import mmap
+import time
+import zlib
+import struct
+from pathlib import Path
+from threading import Lock
+from datetime import datetime
+
+# timestamp, item_id, old items_available, new items_available, status
+RECORD = struct.Struct('<IQhhB')
+STATUSES = ('sold_out', 'new_stock', 'stock_reduced', 'stock_increased')
+
+
+def item_key(item_id) -> int:
+    """TGTG item ids are numeric strings, anything else is hashed"""
+    item_id = str(item_id)
+    return int(item_id) if item_id.isdigit() else zlib.crc32(item_id.encode())
+
+
+def clamp_count(count: int) -> int:
+    return max(-32768, min(32767, count))
+
+
+class StockHistory:
+    """Append-only binary log of stock transitions, rotated by size and read back through mmap"""
+
+    def __init__(self, folder='data/history', max_file_bytes=16 * 1024 * 1024, max_files=24):
+        self.folder = Path(folder)
+        self.folder.mkdir(exist_ok=True, parents=True)
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.lock = Lock()
+        self.file = None
+        self.open_last_file()
+
+    def files(self):
+        return sorted(self.folder.glob('stock-*.bin'))
+
+    def open_last_file(self):
+        files = self.files()
+        path = files[-1] if files else self.folder / 'stock-000001.bin'
+        self.file = open(path, 'ab')
+
+        # drop a record torn by a crash in the middle of a write
+        size = self.file.tell()
+        if size % RECORD.size:
+            self.file.truncate(size - size % RECORD.size)
+            self.file.seek(0, 2)
+
+    def rotate(self):
+        self.file.close()
+        number = int(self.files()[-1].stem.split('-')[1]) + 1
+        self.file = open(self.folder / f'stock-{number:06d}.bin', 'ab')
+
+        for path in self.files()[:-self.max_files]:
+            path.unlink()
+
+    def append(self, item_id, old_items_available: int, new_items_available: int, status: str, timestamp=None):
+        record = RECORD.pack(int(timestamp if timestamp is not None else time.time()), item_key(item_id),
+                             clamp_count(old_items_available), clamp_count(new_items_available), STATUSES.index(status))
+        with self.lock:
+            self.file.write(record)
+            if self.file.tell() >= self.max_file_bytes:
+                self.rotate()
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def records(self, since=None, item_id=None):
+        """Yield (timestamp, item_key, old, new, status) from the oldest file to the newest"""
+        self.flush()
+        key = item_key(item_id) if item_id is not None else None
+
+        for path in self.files():
+            with open(path, 'rb') as file:
+                size = file.seek(0, 2)
+                size -= size % RECORD.size
+                if not size:
+                    continue
+                with mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as data:
+                    # the timestamp of the last record tells if a whole file is older than since
+                    if since is not None and RECORD.unpack_from(data, size - RECORD.size)[0] < since:
+                        continue
+                    for timestamp, record_key, old, new, status in RECORD.iter_unpack(data):
+                        if (since is None or timestamp >= since) and (key is None or record_key == key):
+                            yield timestamp, record_key, old, new, STATUSES[status]
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class RestockModel:
+    """
+    Per item histogram of the new_stock times of day in 15 minutes buckets.
+    Recent restocks weigh more (half_life_days), the histograms are kept in memory so predictions are O(1).
+    """
+
+    BUCKET_MINUTES = 15
+    BUCKETS = 24 * 60 // BUCKET_MINUTES
+    EPOCH = 1_700_000_000
+    # share of the restocks the window must hold to stand out of restocks spread over the day
+    MIN_WINDOW_SHARE = 1 / 3
+
+    def __init__(self, timezone, half_life_days=14, min_events=2):
+        self.timezone = timezone
+        self.half_life_seconds = half_life_days * 24 * 3600
+        self.min_events = min_events
+        self.histograms = {}
+        self.events = {}
+
+    def load(self, history: StockHistory, days=90):
+        for timestamp, key, _, _, status in history.records(since=time.time() - days * 24 * 3600):
+            if status == 'new_stock':
+                self.add_key(key, timestamp)
+
+    def add(self, item_id, timestamp):
+        self.add_key(item_key(item_id), timestamp)
+
+    def add_key(self, key, timestamp):
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0.0] * RestockModel.BUCKETS
+        local_time = datetime.fromtimestamp(timestamp, self.timezone)
+        bucket = (local_time.hour * 60 + local_time.minute) // RestockModel.BUCKET_MINUTES
+        # weights grow with time instead of decaying, relative weights are the same and old ones never need updates
+        histogram[bucket] += 2 ** ((timestamp - RestockModel.EPOCH) / self.half_life_seconds)
+        self.events[key] = self.events.get(key, 0) + 1
+
+    def predict(self, item_id):
+        """(start, end) minutes of the day of the usual restock window, None without enough history or a clear peak"""
+        key = item_key(item_id)
+        histogram = self.histograms.get(key)
+        if histogram is None or self.events[key] < self.min_events:
+            return None
+
+        peak = max(range(RestockModel.BUCKETS), key=histogram.__getitem__)
+        start = end = peak
+        # widen the window over the neighbouring buckets that are at least half as likely
+        while end - start < RestockModel.BUCKETS - 1 and histogram[(start - 1) % RestockModel.BUCKETS] >= histogram[peak] / 2:
+            start -= 1
+        while end - start < RestockModel.BUCKETS - 1 and histogram[(end + 1) % RestockModel.BUCKETS] >= histogram[peak] / 2:
+            end += 1
+
+        if end - start == RestockModel.BUCKETS - 1:
+            return None
+        window = sum(histogram[bucket % RestockModel.BUCKETS] for bucket in range(start, end + 1))
+        if window < sum(histogram) * RestockModel.MIN_WINDOW_SHARE:
+            return None
+
+        return (start * RestockModel.BUCKET_MINUTES) % (24 * 60), ((end + 1) * RestockModel.BUCKET_MINUTES) % (24 * 60)
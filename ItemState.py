@@ -0,0 +1,89 @@
+import json
+import time
+import zlib
+from threading import Lock
+from collections import OrderedDict
+
+
+class ItemState:
+    """What change detection needs to know about an item, the full payload lives in the ItemCache"""
+
+    __slots__ = ('items_available', 'fingerprint', 'last_seen', 'last_restock', 'stored_last_seen')
+
+    def __init__(self, items_available: int, fingerprint: int = 0, last_seen: float = 0.0, last_restock: float = 0.0):
+        self.items_available = items_available
+        self.fingerprint = fingerprint
+        self.last_seen = last_seen
+        self.last_restock = last_restock
+        self.stored_last_seen = last_seen
+
+    @classmethod
+    def from_item(cls, item, now=None):
+        return cls(int(item['items_available']), item_fingerprint(item), now if now is not None else time.time())
+
+    @classmethod
+    def from_row(cls, row):
+        # rows written before the compact format hold the whole item payload
+        if isinstance(row, dict):
+            return cls.from_item(row)
+        return cls(*row)
+
+    def to_row(self):
+        self.stored_last_seen = self.last_seen
+        return [self.items_available, self.fingerprint, self.last_seen, self.last_restock]
+
+    def update(self, item, now=None):
+        self.items_available = int(item['items_available'])
+        self.fingerprint = item_fingerprint(item)
+        self.last_seen = now if now is not None else time.time()
+
+
+def item_fingerprint(item) -> int:
+    """Checksum of the fields shown in a message, changes whenever the formatted text would"""
+    return zlib.crc32(json.dumps([
+        item['items_available'],
+        item.get('pickup_interval'),
+        item['store']['store_name'],
+        item['store']['store_location']['address']['address_line'],
+        item['item'].get('item_price', {}).get('code'),
+        item['item'].get('taxation_policy'),
+        item['item'].get('sales_taxes'),
+        item['item'].get('price_including_taxes'),
+        item['item'].get('value_including_taxes'),
+        item['item'].get('price_excluding_taxes'),
+        item['item'].get('value_excluding_taxes'),
+    ], sort_keys=True).encode())
+
+
+class ItemCache:
+    """Bounded LRU of the last payload seen per item, used to format messages"""
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def put(self, item_id, item):
+        with self.lock:
+            self.items[item_id] = item
+            self.items.move_to_end(item_id)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def get(self, item_id):
+        with self.lock:
+            item = self.items.get(item_id)
+            if item is not None:
+                self.items.move_to_end(item_id)
+            return item
+
+    def discard(self, item_id):
+        with self.lock:
+            self.items.pop(item_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
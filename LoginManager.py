@@ -0,0 +1,132 @@
+import asyncio
+import datetime
+from http import HTTPStatus
+
+import tgtg
+from tgtg.exceptions import TgtgAPIError, TgtgLoginError, TgtgPollingError
+
+
+class LoginManager:
+    """
+    Pending email logins as tasks on the event loop: one per chat, at most max_pending at once,
+    and at most max_concurrent tgtg requests in flight. Waiting for the confirmation link holds no thread.
+    """
+
+    def __init__(self, max_concurrent=4, max_pending=100):
+        self.max_concurrent = max_concurrent
+        self.max_pending = max_pending
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.logins = {}
+
+    @property
+    def pending(self) -> int:
+        return len(self.logins)
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.logins) >= self.max_pending
+
+    def is_pending(self, chat_id) -> bool:
+        return chat_id in self.logins
+
+    def reset(self):
+        """Recreate the semaphore on the running event loop, the one of a previous loop cannot be waited on"""
+        self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        # the login tasks were cancelled with their loop
+        self.logins = {chat_id: task for chat_id, task in self.logins.items() if not task.done()}
+
+    def start(self, chat_id, coroutine) -> bool:
+        """Run the login coroutine of a chat, False if one is already pending or too many are"""
+        if self.is_pending(chat_id) or self.is_full:
+            coroutine.close()
+            return False
+
+        task = asyncio.create_task(coroutine, name=f'login-{chat_id}')
+        self.logins[chat_id] = task
+        task.add_done_callback(lambda _: self.logins.pop(chat_id, None))
+        return True
+
+    def cancel(self, chat_id) -> bool:
+        task = self.logins.get(chat_id)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    async def request(self, client, function, *args):
+        async with self.semaphore:
+            return await client.run(function, client.client, *args)
+
+    async def get_credentials(self, client):
+        """Same as TgtgClient.get_credentials, with the polling waits on the event loop"""
+        polling_id = await self.request(client, request_login_email)
+
+        for _ in range(tgtg.MAX_POLLING_TRIES):
+            if await self.request(client, poll_login, polling_id):
+                return {
+                    "access_token": client.access_token,
+                    "refresh_token": client.refresh_token,
+                    "user_id": client.user_id,
+                    "cookie": client.cookie,
+                }
+            await asyncio.sleep(tgtg.POLLING_WAIT_TIME)
+
+        raise TgtgPollingError(
+            f"Max retries ({tgtg.MAX_POLLING_TRIES * tgtg.POLLING_WAIT_TIME} seconds) reached. Try again."
+        )
+
+
+# The two steps below mirror TgtgClient.login and TgtgClient.start_polling of tgtg 0.17
+
+def request_login_email(client) -> str:
+    response = client.session.post(
+        client._get_url(tgtg.AUTH_BY_EMAIL_ENDPOINT),
+        headers=client._headers,
+        json={
+            "device_type": client.device_type,
+            "email": client.email,
+        },
+        proxies=client.proxies,
+        timeout=client.timeout,
+    )
+    if response.status_code == HTTPStatus.OK:
+        first_login_response = response.json()
+        if first_login_response["state"] == "TERMS":
+            raise TgtgPollingError(
+                f"This email {client.email} is not linked to a tgtg account. "
+                "Please signup with this email first."
+            )
+        elif first_login_response["state"] == "WAIT":
+            return first_login_response["polling_id"]
+        raise TgtgLoginError(response.status_code, response.content)
+    elif response.status_code == HTTPStatus.TOO_MANY_REQUESTS:
+        raise TgtgAPIError(response.status_code, "Too many requests. Try again later.")
+    raise TgtgLoginError(response.status_code, response.content)
+
+
+def poll_login(client, polling_id) -> bool:
+    """One confirmation check, True once the link was opened and the client holds its tokens"""
+    response = client.session.post(
+        client._get_url(tgtg.AUTH_POLLING_ENDPOINT),
+        headers=client._headers,
+        json={
+            "device_type": client.device_type,
+            "email": client.email,
+            "request_polling_id": polling_id,
+        },
+        proxies=client.proxies,
+        timeout=client.timeout,
+    )
+    if response.status_code == HTTPStatus.ACCEPTED:
+        return False
+    elif response.status_code == HTTPStatus.OK:
+        login_response = response.json()
+        client.access_token = login_response["access_token"]
+        client.refresh_token = login_response["refresh_token"]
+        client.last_time_token_refreshed = datetime.datetime.now()
+        client.user_id = login_response["startup_data"]["user"]["user_id"]
+        client.cookie = response.headers["Set-Cookie"]
+        return True
+    elif response.status_code == HTTPStatus.TOO_MANY_REQUESTS:
+        raise TgtgAPIError(response.status_code, "Too many requests. Try again later.")
+    raise TgtgLoginError(response.status_code, response.content)
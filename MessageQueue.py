@@ -0,0 +1,265 @@
+import time
+import heapq
+import asyncio
+import itertools
+from collections import deque
+
+from telebot.asyncio_helper import ApiTelegramException
+
+from Metrics import TELEGRAM_SEND_SECONDS, TELEGRAM_SEND_ERRORS, TELEGRAM_QUEUE_SECONDS
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now=None) -> float:
+        """Seconds until a token is available, 0 if one is available right now"""
+        now = now if now is not None else time.monotonic()
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now=None):
+        now = now if now is not None else time.monotonic()
+        self.refill(now)
+        self.tokens -= 1
+
+
+class MessageDispatcher:
+    """
+    Outbound Telegram queue. Messages are sent by priority from sender tasks, within a global rate
+    and a per-chat rate, and retried after the delay Telegram asks for on 429 Too Many Requests.
+    Each chat has its own queue. A chat that can send now is in the ready heap by its most urgent message, a chat held
+    back by its rate is parked in the waiting heap until then, so a send never walks over the blocked chats.
+    """
+
+    def __init__(self, bot, messages_per_second=30, chat_messages_per_second=1, senders=4, max_retries=3):
+        self.bot = bot
+        self.chat_messages_per_second = chat_messages_per_second
+        self.senders = senders
+        self.max_retries = max_retries
+
+        self.global_bucket = TokenBucket(messages_per_second)
+        self.chat_buckets = {}
+        self.chat_retry_at = {}
+        self.chats_in_flight = set()
+
+        # chat_id -> heap of (priority, order, enqueued_at, retries, chat_id, kwargs)
+        self.chat_queues = {}
+        # (priority, order, chat_id) of the head of the ready chats, older entries of a chat are skipped when popped
+        self.ready = []
+        # (ready_at, chat_id) of the chats waiting for their rate
+        self.waiting = []
+        # chat_id -> 'ready' or 'waiting', chats in flight or with nothing queued are in neither
+        self.scheduled = {}
+        self.depth = 0
+        self.swept_at = time.monotonic()
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.tasks = []
+        self.closing = False
+
+        self.sent = 0
+        self.failed = 0
+        self.send_latencies = deque(maxlen=1000)
+
+    def start(self):
+        """Start the sender tasks on the running event loop"""
+        self.wakeup = asyncio.Event()
+        self.closing = False
+        self.tasks = [asyncio.create_task(self.run(), name=f'sender-{number}') for number in range(self.senders)]
+
+    async def stop(self, timeout=30):
+        """
+        Stop the senders, the messages being sent get up to timeout seconds to finish. Those cut off are queued again
+        for checkpoint(), Telegram may have them already but an alert sent twice beats a lost one.
+        """
+        self.closing = True
+        self.notify()
+        if self.tasks:
+            _, pending = await asyncio.wait(self.tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def drain(self, timeout) -> bool:
+        """Wait until the queued messages are sent or timeout seconds passed, True if none is left"""
+        deadline = time.monotonic() + timeout
+        while (self.depth or self.chats_in_flight) and self.tasks and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        return not self.depth
+
+    def set_rates(self, messages_per_second, chat_messages_per_second):
+        self.global_bucket.rate = messages_per_second
+        self.global_bucket.capacity = max(1.0, messages_per_second)
+        if chat_messages_per_second != self.chat_messages_per_second:
+            self.chat_messages_per_second = chat_messages_per_second
+            self.chat_buckets = {}
+
+    def checkpoint(self) -> list:
+        """The queued messages in sending order as json values, keyboards as their Telegram json"""
+        messages = []
+        for priority, order, enqueued_at, retries, chat_id, kwargs in sorted(message for queue in self.chat_queues.values()
+                                                                             for message in queue):
+            kwargs = dict(kwargs)
+            if hasattr(kwargs.get('reply_markup'), 'to_json'):
+                kwargs['reply_markup'] = kwargs['reply_markup'].to_json()
+            messages.append({'chat_id': chat_id, 'priority': priority, 'kwargs': kwargs})
+        return messages
+
+    def restore(self, messages):
+        """Queue the messages of a checkpoint, bot.send_message takes the keyboards as json"""
+        for message in messages:
+            self.enqueue(message['chat_id'], message['priority'], **message['kwargs'])
+
+    def enqueue(self, chat_id, priority=PRIORITY_NORMAL, **kwargs):
+        """Queue a bot.send_message call, kwargs are passed to it"""
+        self.__push((priority, next(self.counter), time.monotonic(), 0, chat_id, kwargs))
+        self.notify()
+
+    def __push(self, message):
+        chat_id = message[4]
+        queue = self.chat_queues.setdefault(chat_id, [])
+        heapq.heappush(queue, message)
+        self.depth += 1
+        state = self.scheduled.get(chat_id)
+        if state == 'ready' and queue[0] is message:
+            heapq.heappush(self.ready, (message[0], message[1], chat_id))
+        elif state is None and chat_id not in self.chats_in_flight:
+            self.__schedule(chat_id, time.monotonic())
+
+    def __schedule(self, chat_id, now):
+        """Put a chat with queued messages in the ready heap, or in the waiting heap until its rate allows a send"""
+        queue = self.chat_queues.get(chat_id)
+        if not queue:
+            self.chat_queues.pop(chat_id, None)
+            self.scheduled.pop(chat_id, None)
+            return
+        wait = max(self.__chat_bucket(chat_id).wait_time(now), self.chat_retry_at.get(chat_id, 0) - now)
+        if wait > 0:
+            self.scheduled[chat_id] = 'waiting'
+            heapq.heappush(self.waiting, (now + wait, chat_id))
+        else:
+            self.scheduled[chat_id] = 'ready'
+            heapq.heappush(self.ready, (queue[0][0], queue[0][1], chat_id))
+
+    def notify(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    @property
+    def queue_depth(self) -> int:
+        return self.depth
+
+    def stats(self) -> dict:
+        latencies = sorted(self.send_latencies)
+        return {
+            'queue_depth': self.queue_depth,
+            'sent': self.sent,
+            'failed': self.failed,
+            'latency_avg': sum(latencies) / len(latencies) if latencies else 0.0,
+            'latency_p95': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            'latency_max': latencies[-1] if latencies else 0.0,
+        }
+
+    def __chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_messages_per_second, 1)
+        return bucket
+
+    def __next_message(self):
+        """Pop the most urgent message that can be sent now, or return how long to wait for one"""
+        now = time.monotonic()
+        global_wait = self.global_bucket.wait_time(now)
+        if global_wait:
+            return None, global_wait
+
+        while self.waiting and self.waiting[0][0] <= now:
+            _, chat_id = heapq.heappop(self.waiting)
+            if self.scheduled.get(chat_id) == 'waiting':
+                self.__schedule(chat_id, now)
+        if now - self.swept_at >= 60:
+            self.__evict_idle_chats(now)
+
+        while self.ready:
+            priority, order, chat_id = heapq.heappop(self.ready)
+            queue = self.chat_queues.get(chat_id)
+            if self.scheduled.get(chat_id) != 'ready' or not queue or queue[0][1] != order:
+                continue
+            message = heapq.heappop(queue)
+            self.depth -= 1
+            del self.scheduled[chat_id]
+            self.global_bucket.consume(now)
+            self.__chat_bucket(chat_id).consume(now)
+            self.chats_in_flight.add(chat_id)
+            return message, None
+
+        return None, self.waiting[0][0] - now if self.waiting else None
+
+    def __evict_idle_chats(self, now):
+        """Forget the rates of the chats with nothing queued, a full bucket is what a new chat starts with anyway"""
+        self.swept_at = now
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if (chat_id not in self.chat_queues and chat_id not in self.chats_in_flight
+                    and bucket.wait_time(now) == 0 and bucket.tokens >= bucket.capacity):
+                del self.chat_buckets[chat_id]
+        for chat_id, retry_at in list(self.chat_retry_at.items()):
+            if retry_at <= now:
+                del self.chat_retry_at[chat_id]
+
+    async def run(self):
+        while not self.closing:
+            message, wait = self.__next_message()
+            while message is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                if self.closing:
+                    return
+                message, wait = self.__next_message()
+
+            priority, order, enqueued_at, retries, chat_id, kwargs = message
+            try:
+                with TELEGRAM_SEND_SECONDS.time():
+                    await self.bot.send_message(chat_id, **kwargs)
+                self.sent += 1
+                self.send_latencies.append(time.monotonic() - enqueued_at)
+                TELEGRAM_QUEUE_SECONDS.observe(self.send_latencies[-1])
+            except asyncio.CancelledError:
+                self.__push(message)
+                raise
+            except ApiTelegramException as err:
+                TELEGRAM_SEND_ERRORS.inc(err.error_code)
+                if err.error_code == 429 and retries < self.max_retries:
+                    retry_after = err.result_json.get('parameters', {}).get('retry_after', 1)
+                    print(f"[{chat_id}] Telegram flood limit, retry after {retry_after}s")
+                    self.chat_retry_at[chat_id] = time.monotonic() + retry_after
+                    self.__push((priority, order, enqueued_at, retries + 1, chat_id, kwargs))
+                else:
+                    self.failed += 1
+                    print(f"[{chat_id}] Cannot send message: {err}")
+            except Exception as err:
+                TELEGRAM_SEND_ERRORS.inc('error')
+                self.failed += 1
+                print(f"[{chat_id}] Unexpected {err=}, {type(err)=}")
+            finally:
+                self.chats_in_flight.discard(chat_id)
+                self.__schedule(chat_id, time.monotonic())
+                self.notify()
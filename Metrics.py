@@ -0,0 +1,145 @@
+"""Prometheus text format metrics, served on a local port by MetricsServer"""
+import time
+import bisect
+from contextlib import contextmanager
+
+from aiohttp import web
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def format_labels(self, labels, extra=()):
+        pairs = list(zip(self.labelnames, labels)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+    def series(self):
+        # labels may mix ints (status codes) and strings
+        return sorted(self.values.items(), key=lambda series: tuple(map(str, series[0])))
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        yield from self.samples()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.series():
+            yield f'{self.name}{self.format_labels(labels)} {value}'
+
+
+class Gauge(Metric):
+    """Value read from a callback when scraped"""
+    type = 'gauge'
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self.function = None
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            yield f'{self.name} {self.function()}'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value: float, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            # per bucket counts (last one is +Inf), sum
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        for labels, (counts, total) in self.series():
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{self.format_labels(labels, [("le", bucket)])} {cumulative}'
+            yield f'{self.name}_sum{self.format_labels(labels)} {total}'
+            yield f'{self.name}_count{self.format_labels(labels)} {cumulative}'
+
+
+REGISTRY = []
+
+POLL_BATCH_SECONDS = Histogram('tgtg_poll_batch_seconds', 'Duration of a poll batch')
+POLL_BATCH_USERS = Counter('tgtg_poll_users_total', 'Users polled')
+TGTG_REQUEST_SECONDS = Histogram('tgtg_request_seconds', 'TGTG API request latency', ('endpoint', 'status'))
+TGTG_API_ERRORS = Counter('tgtg_api_errors_total', 'TGTG API errors handled', ('status',))
+TOKEN_REFRESHES = Counter('tgtg_token_refreshes_total', 'Access token refreshes', ('result',))
+NOTIFICATIONS = Counter('tgtg_notifications_total', 'Item alerts sent or added to a digest', ('status',))
+TELEGRAM_SEND_SECONDS = Histogram('tgtg_telegram_send_seconds', 'Telegram sendMessage latency')
+TELEGRAM_SEND_ERRORS = Counter('tgtg_telegram_send_errors_total', 'Telegram sendMessage errors', ('code',))
+TELEGRAM_QUEUE_SECONDS = Histogram('tgtg_telegram_queue_seconds', 'Time from enqueue to sent')
+STORAGE_WRITE_SECONDS = Histogram('tgtg_storage_write_seconds', 'Duration of a storage save', ('table',))
+OUTBOUND_QUEUE = Gauge('tgtg_outbound_queue_messages', 'Messages waiting to be sent')
+CONNECTED_CLIENTS = Gauge('tgtg_connected_clients', 'TGTG clients connected')
+USERS = Gauge('tgtg_users', 'Logged in users')
+TGTG_REQUEST_RATE = Gauge('tgtg_request_rate', 'Current TGTG requests per second budget')
+TGTG_CIRCUIT_OPEN = Gauge('tgtg_circuit_open', '1 while TGTG requests are paused')
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+class MetricsServer:
+    def __init__(self, host='127.0.0.1', port=9100):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle(self, request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        print(f'Metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
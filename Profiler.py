@@ -0,0 +1,39 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+
+class SamplingProfiler:
+    """
+    Samples the call stacks of threads from another thread, the profiled threads are never interrupted.
+    thread_ids None samples every thread but the sampling one: the event loop runs in MainThread, the blocking TGTG
+    requests in the tgtg executor threads.
+    The result is in the folded format of flamegraph.pl and speedscope: one "thread;outer;...;inner count" line per stack.
+    """
+
+    def __init__(self, thread_ids=None, interval=0.005):
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.samples = 0
+
+    def sample(self, seconds) -> str:
+        sampling_thread_id = threading.get_ident()
+        counts = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampling_thread_id or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                counts[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        return ''.join(f'{stack} {count}\n' for stack, count in counts.most_common())
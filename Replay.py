@@ -0,0 +1,185 @@
+"""
+Plays a capture recorded with capture_file back through the poller's change detection and formatting, offline and in
+virtual time, and reports how long the pipeline took.
+
+    python Replay.py data/capture.jsonl.gz --profile replay.prof
+
+Responses recorded within --batch-gap seconds of each other form one poll batch, as the poller fetched them.
+"""
+import os
+import sys
+import json
+import time
+import types
+import asyncio
+import argparse
+import cProfile
+import pstats
+import tempfile
+from datetime import datetime
+
+from Capture import read_capture
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class VirtualClock:
+    """Stands in for the time module of the bot modules, time() returns the time of the replayed responses"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def install(self, *modules):
+        clock = types.SimpleNamespace(**{name: getattr(time, name) for name in dir(time) if not name.startswith('__')})
+        clock.time = lambda: self.now
+        for module in modules:
+            module.time = clock
+
+
+class ReplayBot:
+    async def set_my_commands(self, *args, **kwargs):
+        pass
+
+
+class ReplayClient:
+    """Answers get_items with the last recorded response of its user"""
+
+    def __init__(self, responses, user_id):
+        self.responses = responses
+        self.user_id = user_id
+        self.response_bytes = 0
+        self.last_elapsed = 0.0
+
+    async def get_items(self, **kwargs):
+        return self.responses.get(self.user_id, [])
+
+
+def batches(records, batch_gap):
+    """Group the records in poll batches: close in time, one response per user"""
+    batch = []
+    users = set()
+    for record in records:
+        if batch and (record['t'] - batch[0]['t'] > batch_gap or record['user'] in users):
+            yield batch
+            batch = []
+            users = set()
+        batch.append(record)
+        users.add(record['user'])
+    if batch:
+        yield batch
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0
+
+
+async def replay(args):
+    # imported here so the working directory (data folder) is the temporary one
+    import ItemState
+    import History
+    import SubscriberIndex
+    import TooGoodToGo as TooGoodToGoModule
+    from Metrics import NOTIFICATIONS
+
+    clock = VirtualClock()
+    clock.install(TooGoodToGoModule, ItemState, History, SubscriberIndex)
+
+    tooGoodToGo = TooGoodToGoModule.TooGoodToGo(ReplayBot(), {'timezone': args.timezone})
+    responses = {}
+
+    async def connect(user_id):
+        return ReplayClient(responses, user_id)
+
+    tooGoodToGo.connect = connect
+    # formatted and counted, not sent
+    tooGoodToGo.dispatcher.enqueue = lambda chat_id, priority=None, **kwargs: None
+
+    durations = []
+    records = 0
+    first_time = None
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+
+    for batch in batches(read_capture(args.capture), args.batch_gap):
+        for record in batch:
+            user_id = record['user']
+            responses[user_id] = record['items']
+            if user_id not in tooGoodToGo.users_login_data:
+                tooGoodToGo.users_login_data[user_id] = {'telegram_username': user_id,
+                                                         'last_time_token_refreshed': datetime.now()}
+                tooGoodToGo.users_settings_data[user_id] = {status: 1 for status in TooGoodToGoModule.TooGoodToGo.ITEM_STATUS}
+                tooGoodToGo.update_eligible_users(user_id)
+
+        if args.speed and first_time is not None:
+            await asyncio.sleep(max(0.0, (batch[0]['t'] - clock.now) / args.speed))
+        clock.now = batch[0]['t']
+        first_time = clock.now if first_time is None else first_time
+
+        batch_started = time.perf_counter()
+        await tooGoodToGo.poll_users([record['user'] for record in batch])
+        durations.append(time.perf_counter() - batch_started)
+        records += len(batch)
+
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    virtual_seconds = clock.now - first_time if first_time is not None else 0
+    return {
+        'records': records,
+        'users': len(tooGoodToGo.users_login_data),
+        'items': len(tooGoodToGo.available_items_favorites),
+        'poll_batches': len(durations),
+        'virtual_seconds': round(virtual_seconds, 1),
+        'wall_seconds': round(elapsed, 3),
+        'speedup': round(virtual_seconds / elapsed, 1) if elapsed else 0,
+        'batch_seconds_avg': round(sum(durations) / len(durations), 5) if durations else 0,
+        'batch_seconds_p95': round(percentile(durations, 0.95), 5),
+        'batch_seconds_max': round(max(durations, default=0), 5),
+        'notifications': {status: count for (status,), count in NOTIFICATIONS.values.items()},
+        'cpu_seconds': round(cpu, 2),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', help='capture file written with capture_file')
+    parser.add_argument('--speed', type=float, default=0, help='virtual seconds per second, 0 for as fast as possible')
+    parser.add_argument('--batch-gap', type=float, default=5, help='seconds between responses of one poll batch')
+    parser.add_argument('--timezone', default='UTC', help='timezone of the bot, used by the restock predictions')
+    parser.add_argument('--profile', help='write cProfile stats to this file and print the top functions')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+    args.capture = os.path.abspath(args.capture)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    working_directory = os.getcwd()
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        with tempfile.TemporaryDirectory() as data_directory:
+            os.chdir(data_directory)
+            if profiler:
+                profiler.enable()
+            report = asyncio.run(replay(args))
+            if profiler:
+                profiler.disable()
+    finally:
+        os.chdir(working_directory)
+
+    for key, value in report.items():
+        print(f'{key:24} {value}')
+
+    if profiler:
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import time
+import random
+import asyncio
+
+from MessageQueue import TokenBucket
+
+
+class CircuitOpenError(Exception):
+    """TGTG failed too many times in a row, requests are not sent until the circuit half-opens"""
+
+
+class RequestBudget:
+    """
+    Process-wide budget of the TGTG requests. Requests wait for a token of a bucket whose rate is halved on
+    429 Too Many Requests and raised a little on every success, so it settles at the highest rate TGTG accepts.
+    429, 5xx and network errors delay the next requests with exponential backoff and jitter, and after
+    breaker_failures of them in a row the circuit opens: requests fail fast for breaker_seconds (doubled every time
+    it opens again), then one probe request is let through and closes it on success.
+    """
+
+    def __init__(self, requests_per_second=10, min_requests_per_second=0.5, backoff_seconds=1, max_backoff_seconds=300,
+                 breaker_failures=10, breaker_seconds=60, max_breaker_seconds=1800):
+        self.max_rate = requests_per_second
+        self.min_rate = min(min_requests_per_second, requests_per_second) if requests_per_second else 0
+        self.bucket = TokenBucket(requests_per_second) if requests_per_second else None
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.breaker_failures = breaker_failures
+        self.breaker_seconds = breaker_seconds
+        self.max_breaker_seconds = max_breaker_seconds
+
+        self.failures = 0
+        self.backoff_until = 0.0
+        self.rate_decreased_at = 0.0
+        self.opened = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate if self.bucket else 0.0
+
+    def set_rate(self, rate):
+        self.bucket.rate = rate
+        self.bucket.capacity = max(1.0, rate)
+
+    def is_open(self) -> bool:
+        return self.open_until > 0 and (self.probing or time.monotonic() < self.open_until)
+
+    def open_seconds_left(self) -> float:
+        return max(0.0, self.open_until - time.monotonic())
+
+    async def acquire(self):
+        """Wait for the backoff and a token, raise CircuitOpenError while the circuit is open"""
+        if self.open_until:
+            if self.is_open():
+                raise CircuitOpenError(f"TGTG requests paused for {self.open_seconds_left():.0f}s")
+            # half-open, this request is the probe
+            self.probing = True
+
+        while True:
+            now = time.monotonic()
+            wait = max(self.backoff_until - now, self.bucket.wait_time(now) if self.bucket else 0)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+
+        if self.bucket:
+            self.bucket.consume()
+
+    def release(self):
+        """A request cancelled before its answer tells nothing about the API, the next one probes if this one did"""
+        self.probing = False
+
+    def record(self, status):
+        """Outcome of a request: 200, the HTTP status of a tgtg error, 'error' for a network error, else 'rejected'"""
+        now = time.monotonic()
+        if not (status == 429 or status == 'error' or (isinstance(status, int) and status >= 500)):
+            # a 4xx other than 429 is about the user, not the API health
+            if self.open_until:
+                print('TGTG circuit closed')
+            self.failures = 0
+            self.backoff_until = 0.0
+            self.opened = 0
+            self.open_until = 0.0
+            self.probing = False
+            if status == 200 and self.bucket and self.bucket.rate < self.max_rate:
+                self.set_rate(min(self.max_rate, self.bucket.rate + self.max_rate / 100))
+            return
+
+        self.failures += 1
+        if status == 429 and self.bucket and now - self.rate_decreased_at >= 1:
+            # the requests in flight get the 429 too, one decrease per second
+            self.rate_decreased_at = now
+            self.set_rate(max(self.min_rate, self.bucket.rate / 2))
+
+        delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** min(self.failures - 1, 30))
+        self.backoff_until = max(self.backoff_until, now + random.uniform(delay / 2, delay))
+
+        if self.probing or (self.failures >= self.breaker_failures and now >= self.open_until):
+            self.opened += 1
+            open_seconds = min(self.max_breaker_seconds, self.breaker_seconds * 2 ** min(self.opened - 1, 30))
+            self.open_until = now + open_seconds
+            self.probing = False
+            print(f'TGTG circuit open for {open_seconds}s after {self.failures} failures, last status {status}')
@@ -0,0 +1,41 @@
+import heapq
+
+
+class PollScheduler:
+    """Min-heap of (next_due, user_id), one live entry per user"""
+
+    def __init__(self):
+        self.heap = []
+        self.due_at = {}
+
+    def schedule(self, user_id, due_at: float):
+        # rescheduling leaves the old heap entry behind, it is skipped when popped
+        self.due_at[user_id] = due_at
+        heapq.heappush(self.heap, (due_at, user_id))
+
+    def remove(self, user_id):
+        self.due_at.pop(user_id, None)
+
+    def pop_due(self, now: float, slack: float = 1.0) -> list:
+        """Pop every user due before now + slack, close deadlines are grouped in one batch"""
+        due_users = []
+        while self.heap and self.heap[0][0] <= now + slack:
+            due_at, user_id = heapq.heappop(self.heap)
+            if self.due_at.get(user_id) == due_at:
+                del self.due_at[user_id]
+                due_users.append(user_id)
+        return due_users
+
+    def next_due(self):
+        while self.heap:
+            due_at, user_id = self.heap[0]
+            if self.due_at.get(user_id) == due_at:
+                return due_at
+            heapq.heappop(self.heap)
+        return None
+
+    def __contains__(self, user_id):
+        return user_id in self.due_at
+
+    def __len__(self):
+        return len(self.due_at)
@@ -0,0 +1,106 @@
+import time
+import bisect
+import sqlite3
+import hashlib
+from pathlib import Path
+from zlib import crc32
+
+
+def stable_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+def shard_of(user_id, shard_count: int) -> int:
+    return crc32(str(user_id).encode()) % shard_count
+
+
+class HashRing:
+    """Consistent hash ring, a node joining or leaving only moves the keys next to its points"""
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.set_nodes(nodes)
+
+    def set_nodes(self, nodes):
+        self.nodes = sorted(set(nodes))
+        points = sorted((stable_hash(f'{node}#{replica}'), node) for node in self.nodes for replica in range(self.replicas))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def node_for(self, key):
+        if not self.nodes:
+            return None
+        index = bisect.bisect(self.hashes, stable_hash(str(key))) % len(self.hashes)
+        return self.owners[index]
+
+
+class ShardCoordinator:
+    """
+    Ownership of the users of a sharded deployment. Users are split in shard_count shards by a hash of their id,
+    shards are placed on the live workers with a consistent hash ring. A worker polls the users of the shards it
+    holds a lease on, leases are renewed every heartbeat and taken over by the others once a dead worker's expire.
+    Workers, leases and the bot data share the sqlite database, so every worker needs the same data folder.
+    """
+
+    def __init__(self, worker_id: str, shard_count=64, lease_seconds=30, data_folder='data', file_name='tgtg.sqlite3'):
+        self.worker_id = worker_id
+        self.shard_count = shard_count
+        self.lease_seconds = lease_seconds
+        self.ring = HashRing()
+        self.shards = set()
+        # start of the last successful heartbeat, the leases it renewed run out lease_seconds later
+        self.renewed_at = 0.0
+
+        path = Path(data_folder) / file_name
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                                          timeout=lease_seconds)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS shard_workers (worker TEXT PRIMARY KEY, expires_at REAL NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS shard_leases '
+                                '(shard INTEGER PRIMARY KEY, worker TEXT NOT NULL, expires_at REAL NOT NULL)')
+
+    def owns(self, user_id) -> bool:
+        return shard_of(user_id, self.shard_count) in self.shards
+
+    def lease_expired(self) -> bool:
+        """The shards are held on leases that ran out, other workers may have claimed them"""
+        return bool(self.shards) and time.time() >= self.renewed_at + self.lease_seconds
+
+    def heartbeat(self):
+        """Renew the worker and its leases, release the shards placed elsewhere and claim the free ones placed here"""
+        now = time.time()
+        expires_at = now + self.lease_seconds
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('INSERT INTO shard_workers (worker, expires_at) VALUES (?, ?) '
+                                    'ON CONFLICT(worker) DO UPDATE SET expires_at = excluded.expires_at',
+                                    (self.worker_id, expires_at))
+            self.connection.execute('DELETE FROM shard_workers WHERE expires_at < ?', (now,))
+            self.ring.set_nodes(worker for worker, in self.connection.execute('SELECT worker FROM shard_workers'))
+
+            placed = [shard for shard in range(self.shard_count) if self.ring.node_for(shard) == self.worker_id]
+            self.connection.execute('DELETE FROM shard_leases WHERE worker = ?', (self.worker_id,))
+            # a lease still held by a live worker is left to it, it releases the shard on its next heartbeat
+            self.connection.executemany('INSERT INTO shard_leases (shard, worker, expires_at) VALUES (?, ?, ?) '
+                                        'ON CONFLICT(shard) DO UPDATE SET worker = excluded.worker, '
+                                        'expires_at = excluded.expires_at WHERE shard_leases.expires_at < ?',
+                                        [(shard, self.worker_id, expires_at, now) for shard in placed])
+            shards = {shard for shard, in self.connection.execute('SELECT shard FROM shard_leases WHERE worker = ?',
+                                                                  (self.worker_id,))}
+
+        self.renewed_at = now
+        if shards != self.shards:
+            print(f'Worker {self.worker_id}: {len(shards)}/{self.shard_count} shards, {len(self.ring.nodes)} workers')
+        self.shards = shards
+
+    def release(self):
+        """Give the shards back right away on a clean shutdown"""
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('DELETE FROM shard_leases WHERE worker = ?', (self.worker_id,))
+            self.connection.execute('DELETE FROM shard_workers WHERE worker = ?', (self.worker_id,))
+        self.shards = set()
+
+    def close(self):
+        self.connection.close()
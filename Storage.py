@@ -0,0 +1,158 @@
+import os
+import json
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from datetime import datetime
+from pytz import utc
+
+TABLES = ('users_login_data', 'users_settings_data', 'available_items_favorites', 'geo_subscriptions', 'checkpoint')
+
+
+def open_storage(backend: str = 'sqlite', data_folder='data'):
+    if backend == 'json':
+        return JsonStorage(data_folder)
+    if backend == 'sqlite':
+        return SqliteStorage(data_folder)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+class JsonStorage:
+    """One json file per table, rewritten atomically on every save"""
+
+    def __init__(self, data_folder='data'):
+        self.data_folder = data_folder
+        self.lock = Lock()
+
+    def read(self, table: str, keys=None) -> dict:
+        with open(data_file(table, self.data_folder), 'r') as file:
+            data = json.load(file, cls=DateTimeDecoder)
+        if keys is not None:
+            return {key: data[key] for key in keys if key in data}
+        return data
+
+    def save(self, table: str, data: dict, keys=None):
+        """Rewrite the file with data, or with the rows of keys updated (keys missing from data are deleted)"""
+        path = data_file(table, self.data_folder)
+        tmp_path = path.with_suffix('.tmp')
+        with self.lock:
+            if keys is not None:
+                with open(path, 'r') as file:
+                    rows = json.load(file, cls=DateTimeDecoder)
+                for key in keys:
+                    if key in data:
+                        rows[key] = data[key]
+                    else:
+                        rows.pop(key, None)
+                data = rows
+            with open(tmp_path, 'w') as file:
+                json.dump(data, file, cls=DateTimeEncoder)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, path)
+
+    def close(self):
+        pass
+
+
+class SqliteStorage:
+    """Key/value rows per table in a WAL journaled sqlite database, saves only upsert the given keys"""
+
+    def __init__(self, data_folder='data', file_name='tgtg.sqlite3'):
+        path = Path(data_folder) / file_name
+        path.parent.mkdir(exist_ok=True, parents=True)
+
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+        for table in TABLES:
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+        self.migrate_json_files(data_folder)
+
+    def migrate_json_files(self, data_folder):
+        """One-shot import of the json files written by the previous storage"""
+        for table in TABLES:
+            json_path = Path(f'{data_folder}/{table}.json')
+            if not json_path.exists() or self.count(table):
+                continue
+
+            with open(json_path, 'r') as file:
+                data = json.load(file, cls=DateTimeDecoder)
+
+            self.save(table, data)
+            json_path.rename(json_path.with_suffix('.json.migrated'))
+            print(f'Migrated {len(data)} rows from {json_path}')
+
+    def count(self, table: str) -> int:
+        with self.lock:
+            return self.connection.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def read(self, table: str, keys=None) -> dict:
+        """Rows of keys (all rows when None)"""
+        with self.lock:
+            if keys is None:
+                rows = self.connection.execute(f'SELECT key, value FROM {table}').fetchall()
+            else:
+                keys = list(keys)
+                rows = self.connection.execute(f'SELECT key, value FROM {table} WHERE key IN ({",".join("?" * len(keys))})',
+                                               keys).fetchall()
+        return {key: json.loads(value, cls=DateTimeDecoder) for key, value in rows}
+
+    def save(self, table: str, data: dict, keys=None):
+        """Upsert the rows of keys (all rows when None), keys missing from data are deleted"""
+        if keys is None:
+            upserts = [(key, json.dumps(value, cls=DateTimeEncoder)) for key, value in data.items()]
+            with self.lock, self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.execute(f'DELETE FROM {table}')
+                self.connection.executemany(f'INSERT INTO {table} (key, value) VALUES (?, ?)', upserts)
+            return
+
+        upserts = []
+        deletes = []
+        for key in keys:
+            if key in data:
+                upserts.append((key, json.dumps(data[key], cls=DateTimeEncoder)))
+            else:
+                deletes.append((key,))
+
+        with self.lock, self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany(f'INSERT INTO {table} (key, value) VALUES (?, ?) '
+                                        'ON CONFLICT(key) DO UPDATE SET value = excluded.value', upserts)
+            self.connection.executemany(f'DELETE FROM {table} WHERE key = ?', deletes)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def data_file(data_file_name: str, data_folder='data', extension='json') -> Path:
+    data_path = Path(f'{data_folder}/{data_file_name}.{extension}')
+    if not data_path.exists():
+        data_path.parent.mkdir(exist_ok=True, parents=True)
+        data_path.write_text('{}')
+        print(f'Created {data_path}')
+    return data_path
+
+class DateTimeEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.astimezone(utc).isoformat()
+        return super().default(obj)
+
+class DateTimeDecoder(json.JSONDecoder):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, object_hook=self.object_hook, **kwargs)
+
+    def object_hook(self, obj):
+        for key, value in obj.items():
+            if key == 'last_time_token_refreshed':
+                obj[key] = datetime.fromisoformat(value) \
+                    .astimezone().replace(tzinfo=None)
+                    # tgtg model login uses local timezone naive datetime.now() to compare refresh token time
+                    # tgtg/__init__.py", line 121, in _refresh_token
+        return obj
@@ -0,0 +1,73 @@
+import time
+
+
+class SubscriberIndex:
+    """Inverted index of the favorites: item_id -> telegram users following it"""
+
+    def __init__(self):
+        self.item_subscribers = {}
+        self.user_favourites = {}
+        self.synced_at = {}
+
+    def sync(self, user_id, item_ids, now=None):
+        """Replace the known favorites of a user with a freshly fetched list"""
+        item_ids = set(item_ids)
+        old_item_ids = self.user_favourites.get(user_id, set())
+
+        for item_id in old_item_ids - item_ids:
+            subscribers = self.item_subscribers.get(item_id)
+            if subscribers is not None:
+                subscribers.discard(user_id)
+                if not subscribers:
+                    del self.item_subscribers[item_id]
+
+        for item_id in item_ids - old_item_ids:
+            self.item_subscribers.setdefault(item_id, set()).add(user_id)
+
+        self.user_favourites[user_id] = item_ids
+        self.synced_at[user_id] = now if now is not None else time.time()
+
+    def remove(self, user_id):
+        self.sync(user_id, ())
+        self.user_favourites.pop(user_id, None)
+        self.synced_at.pop(user_id, None)
+
+    def subscribers(self, item_id):
+        return self.item_subscribers.get(item_id, set())
+
+    def favourites(self, user_id):
+        return self.user_favourites.get(user_id, set())
+
+    def is_stale(self, user_id, max_age_seconds, now=None):
+        synced_at = self.synced_at.get(user_id)
+        if synced_at is None:
+            return True
+        now = now if now is not None else time.time()
+        return now - synced_at >= max_age_seconds
+
+    def select_fetchers(self, user_ids, max_age_seconds, now=None):
+        """
+        Choose which users' favorites have to be fetched so every item followed by user_ids is downloaded once.
+        Users with a stale favorites list are always fetched, the others are added largest list first until every item is covered.
+        """
+        now = now if now is not None else time.time()
+        fetchers = []
+        covered = set()
+        candidates = []
+
+        for user_id in user_ids:
+            if self.is_stale(user_id, max_age_seconds, now):
+                fetchers.append(user_id)
+                covered |= self.favourites(user_id)
+            else:
+                candidates.append(user_id)
+
+        # biggest favorites lists first, they cover the most items with a single request
+        candidates.sort(key=lambda user_id: len(self.favourites(user_id)), reverse=True)
+        for user_id in candidates:
+            favourites = self.favourites(user_id)
+            if not favourites <= covered:
+                fetchers.append(user_id)
+                covered |= favourites
+
+        return fetchers
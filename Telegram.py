@@ -1,21 +1,28 @@
+import io
 import re
+import sys
+import time
+import signal
+import atexit
 import configparser
 import asyncio
-from _thread import start_new_thread
+import subprocess
 from datetime import datetime
 
 from telebot import types
 from telebot.async_telebot import AsyncTeleBot
 
 from TooGoodToGo import TooGoodToGo
-
-import tgtg.exceptions
+from Webhook import WebhookServer
+from GeoIndex import CATEGORIES, parse_category
+from Profiler import SamplingProfiler
+from ConfigReloader import ConfigReloader
 
 config = configparser.ConfigParser(interpolation=None)
 config.read('config.ini')
 token = config['Telegram']['token']
 bot = AsyncTeleBot(token)
-tooGoodToGo = TooGoodToGo(token, config['Configuration'])
+tooGoodToGo = TooGoodToGo(bot, config['Configuration'])
 
 def log_command(chat_id: str, command: str, log: str = ''):
     print(f"[{chat_id}] /{command}{f': {log}' if log else ''}")
@@ -41,6 +48,8 @@ You do not need to enter a password._
 
 ℹ️ With */info* you can display all stores from your favorites where bags are currently available.
 
+📍 With */near* or by sharing a location you are notified of the bags around it, not only your favorites.
+
 _🌐 You can find more information about Too Good To Go_ [here](https://www.toogoodtogo.com/).
 
 *🌍 LET'S FIGHT food waste TOGETHER 🌎*
@@ -57,29 +66,34 @@ async def send_info(message):
                                text="🔑 You have to log in with your mail first!\nPlease enter */login email@example.com*\n*❗️️This is necessary if you want to use the bot❗️*",
                                parse_mode="Markdown")
         return None
-    tooGoodToGo.send_available_favourite_items_for_one_user(chat_id)
+    await tooGoodToGo.send_available_favourite_items_for_one_user(chat_id)
 
 
 @bot.message_handler(commands=['login'])
 async def send_login(message):
     chat_id = str(message.chat.id)
 
-    try:
-        if tooGoodToGo.update_credentials(chat_id, refresh=True):
-            log_command(chat_id, 'login', 'Logged in')
-            await bot.send_message(chat_id=chat_id, text="👍 You are logged in!")
-            return None
-    except tgtg.exceptions.TgtgAPIError as err:
-        tooGoodToGo.handle_api_error(err, chat_id)
-        await bot.send_message(chat_id, "❌ Cannot log in. Please try again later.")
+    # expired sessions are removed by the poller and the token refresher, stored credentials are valid
+    if tooGoodToGo.find_credentials_by_telegramUserID(chat_id):
+        log_command(chat_id, 'login', 'Logged in')
+        await bot.send_message(chat_id=chat_id, text="👍 You are logged in!")
         return None
         
     email = command_param_text(message.text)
 
-    if re.match(r"[^@]+@[^@]+\.[^@]+", email):
-        log_command(chat_id, 'login', email)
+    if tooGoodToGo.login_manager.is_pending(chat_id):
+        log_command(chat_id, 'login', 'Already pending')
+        await bot.send_message(chat_id=chat_id,
+                               text="⏳ A login is already waiting for your email confirmation."
+                                    "\nUse */cancel* to start again with another address.",
+                               parse_mode="Markdown")
+    elif tooGoodToGo.login_manager.is_full:
+        log_command(chat_id, 'login', f'Too many pending logins ({tooGoodToGo.login_manager.pending})')
+        await bot.send_message(chat_id, "❌ Too many logins at the moment. Please try again in a few minutes.")
+    elif re.match(r"[^@]+@[^@]+\.[^@]+", email):
+        log_command(chat_id, 'login', f'{email} ({tooGoodToGo.login_manager.pending + 1} pending)')
         telegram_username = message.from_user.username
-        start_new_thread(tooGoodToGo.new_user, (chat_id, telegram_username, email))
+        tooGoodToGo.login_manager.start(chat_id, tooGoodToGo.new_user(chat_id, telegram_username, email))
     else:
         log_command(chat_id, 'login', f'{email} (Invalid)')
         await bot.send_message(chat_id=chat_id,
@@ -90,6 +104,17 @@ async def send_login(message):
                                parse_mode="Markdown")
 
 
+@bot.message_handler(commands=['cancel'])
+async def send_cancel(message):
+    chat_id = str(message.chat.id)
+    if tooGoodToGo.login_manager.cancel(chat_id):
+        log_command(chat_id, 'cancel', 'Login cancelled')
+        await bot.send_message(chat_id, "🚫 Login cancelled.")
+    else:
+        log_command(chat_id, 'cancel', 'No pending login')
+        await bot.send_message(chat_id, "There is no pending login to cancel.")
+
+
 def inline_keyboard_markup(chat_id):
     inline_keyboard = types.InlineKeyboardMarkup(
         keyboard=[
@@ -113,6 +138,12 @@ def inline_keyboard_markup(chat_id):
                     callback_data='stock_increased'
                 )
             ],
+            [
+                types.InlineKeyboardButton(
+                    text=("🟢" if tooGoodToGo.users_settings_data[chat_id].get('digest') else '🔴') + ' Digest: one message per check',
+                    callback_data='digest'
+                )
+            ],
             [
                 types.InlineKeyboardButton(
                     text='✅ Activate all ✅',
@@ -152,7 +183,7 @@ async def back_callback(call: types.CallbackQuery):
     tooGoodToGo.users_settings_data[chat_id]["sold_out"] = 0 if settings else 1
     await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id,
                                         reply_markup=inline_keyboard_markup(chat_id))
-    tooGoodToGo.save_users_settings_data_to_txt()
+    tooGoodToGo.save_users_settings_data_to_txt(chat_id)
 
 
 @bot.callback_query_handler(func=lambda c: c.data == 'new_stock')
@@ -162,7 +193,7 @@ async def back_callback(call: types.CallbackQuery):
     tooGoodToGo.users_settings_data[chat_id]["new_stock"] = 0 if settings else 1
     await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id,
                                         reply_markup=inline_keyboard_markup(chat_id))
-    tooGoodToGo.save_users_settings_data_to_txt()
+    tooGoodToGo.save_users_settings_data_to_txt(chat_id)
 
 
 @bot.callback_query_handler(func=lambda c: c.data == 'stock_reduced')
@@ -172,7 +203,7 @@ async def back_callback(call: types.CallbackQuery):
     tooGoodToGo.users_settings_data[chat_id]["stock_reduced"] = 0 if settings else 1
     await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id,
                                         reply_markup=inline_keyboard_markup(chat_id))
-    tooGoodToGo.save_users_settings_data_to_txt()
+    tooGoodToGo.save_users_settings_data_to_txt(chat_id)
 
 
 @bot.callback_query_handler(func=lambda c: c.data == 'stock_increased')
@@ -182,15 +213,25 @@ async def back_callback(call: types.CallbackQuery):
     tooGoodToGo.users_settings_data[chat_id]["stock_increased"] = 0 if settings else 1
     await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id,
                                         reply_markup=inline_keyboard_markup(chat_id))
-    tooGoodToGo.save_users_settings_data_to_txt()
+    tooGoodToGo.save_users_settings_data_to_txt(chat_id)
+
+
+@bot.callback_query_handler(func=lambda c: c.data == 'digest')
+async def back_callback(call: types.CallbackQuery):
+    chat_id = str(call.message.chat.id)
+    settings = tooGoodToGo.users_settings_data[chat_id].get("digest")
+    tooGoodToGo.users_settings_data[chat_id]["digest"] = 0 if settings else 1
+    await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id,
+                                        reply_markup=inline_keyboard_markup(chat_id))
+    tooGoodToGo.save_users_settings_data_to_txt(chat_id)
 
 
 @bot.callback_query_handler(func=lambda c: c.data == 'activate_all')
 async def back_callback(call: types.CallbackQuery):
     chat_id = str(call.message.chat.id)
-    for key in tooGoodToGo.users_settings_data[chat_id].keys():
+    for key in TooGoodToGo.ITEM_STATUS:
         tooGoodToGo.users_settings_data[chat_id][key] = 1
-    tooGoodToGo.save_users_settings_data_to_txt()
+    tooGoodToGo.save_users_settings_data_to_txt(chat_id)
     await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id,
                                         reply_markup=inline_keyboard_markup(chat_id))
 
@@ -198,13 +239,111 @@ async def back_callback(call: types.CallbackQuery):
 @bot.callback_query_handler(func=lambda c: c.data == 'disable_all')
 async def back_callback(call: types.CallbackQuery):
     chat_id = str(call.message.chat.id)
-    for key in tooGoodToGo.users_settings_data[chat_id].keys():
+    for key in TooGoodToGo.ITEM_STATUS:
         tooGoodToGo.users_settings_data[chat_id][key] = 0
-    tooGoodToGo.save_users_settings_data_to_txt()
+    tooGoodToGo.save_users_settings_data_to_txt(chat_id)
     await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id,
                                         reply_markup=inline_keyboard_markup(chat_id))
 
 
+def format_subscription(subscription):
+    filters = ''
+    if subscription.get('max_price') is not None:
+        filters += f", up to {subscription['max_price']:g}"
+    if subscription.get('category'):
+        filters += f", {subscription['category'].lower().replace('_', ' ')} only"
+    return f"📍 Watching {subscription['radius_km']:g} km around {subscription['latitude']:.4f}, {subscription['longitude']:.4f}{filters}"
+
+NEAR_USAGE = ("📍 Share a location, or enter */near latitude longitude [radius km] [max price] [category]*\n"
+              f"The category is one of {', '.join(CATEGORIES)}.\n"
+              "Ex: */near 52.3731 4.8926 3 5 meals*\n"
+              "*/near off* stops the location alerts.")
+
+@bot.message_handler(commands=['near'])
+async def near(message):
+    chat_id = str(message.chat.id)
+    text = command_param_text(message.text)
+    log_command(chat_id, 'near', text)
+    if tooGoodToGo.find_credentials_by_telegramUserID(chat_id) is None:
+        await bot.send_message(chat_id=chat_id, text="🔑 You have to log in with your mail first!\nPlease enter */login email@example.com*",
+                               parse_mode="Markdown")
+        return
+
+    params = text.replace(',', ' ').split()
+    if not params:
+        subscription = tooGoodToGo.geo_index.subscriptions.get(chat_id)
+        await bot.send_message(chat_id=chat_id, text=(format_subscription(subscription) + "\n\n" if subscription else "") + NEAR_USAGE,
+                               parse_mode="Markdown")
+        return
+
+    if params[0].lower() == 'off':
+        tooGoodToGo.unsubscribe_location(chat_id)
+        await bot.send_message(chat_id=chat_id, text="📍 Location alerts stopped")
+        return
+
+    category = ' '.join(params[4:]) or None
+    if category:
+        try:
+            parse_category(category)
+        except ValueError:
+            await bot.send_message(chat_id=chat_id, text=f"Unknown category {category}, choose one of {', '.join(CATEGORIES)}")
+            return
+
+    try:
+        latitude, longitude = float(params[0]), float(params[1])
+        radius_km = float(params[2]) if len(params) > 2 else None
+        max_price = float(params[3]) if len(params) > 3 else None
+        subscription = tooGoodToGo.subscribe_location(chat_id, latitude, longitude, radius_km, max_price, category)
+    except (ValueError, IndexError):
+        await bot.send_message(chat_id=chat_id, text=NEAR_USAGE, parse_mode="Markdown")
+        return
+    await bot.send_message(chat_id=chat_id, text=format_subscription(subscription))
+
+@bot.message_handler(content_types=['location'])
+async def near_location(message):
+    chat_id = str(message.chat.id)
+    log_command(chat_id, 'near', 'location')
+    if tooGoodToGo.find_credentials_by_telegramUserID(chat_id) is None:
+        await bot.send_message(chat_id=chat_id, text="🔑 You have to log in with your mail first!\nPlease enter */login email@example.com*",
+                               parse_mode="Markdown")
+        return
+
+    # a new location keeps the radius and filters
+    subscription = tooGoodToGo.geo_index.subscriptions.get(chat_id) or {}
+    subscription = tooGoodToGo.subscribe_location(chat_id, message.location.latitude, message.location.longitude,
+                                                  subscription.get('radius_km'), subscription.get('max_price'),
+                                                  subscription.get('category'))
+    await bot.send_message(chat_id=chat_id, text=format_subscription(subscription))
+
+@bot.message_handler(commands=['stats'], func=lambda message: tooGoodToGo.is_admin(message.chat.id))
+async def stats(message):
+    chat_id = str(message.chat.id)
+    log_command(chat_id, 'stats')
+    await bot.send_message(chat_id=chat_id, text=tooGoodToGo.format_stats())
+
+# created by main() on the running loop
+profiling = None
+
+@bot.message_handler(commands=['profile'], func=lambda message: tooGoodToGo.is_admin(message.chat.id))
+async def profile(message):
+    chat_id = str(message.chat.id)
+    text = command_param_text(message.text)
+    log_command(chat_id, 'profile', text)
+    seconds = min(120, max(1, int(text))) if text.isdigit() else 10
+    if profiling.locked():
+        await bot.send_message(chat_id=chat_id, text="A profile is already running")
+        return
+
+    async with profiling:
+        await bot.send_message(chat_id=chat_id, text=f"🔬 Profiling every thread for {seconds}s")
+        # sampled from a thread of the default executor, the event loop and the tgtg requests run in the others
+        profiler = SamplingProfiler()
+        folded = await asyncio.get_running_loop().run_in_executor(None, profiler.sample, seconds)
+        document = io.BytesIO(folded.encode())
+        await bot.send_document(chat_id, document, visible_file_name=f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded",
+                                caption=f"{profiler.samples} samples, one root per thread: MainThread runs the event loop, "
+                                        f"tgtg_* the TGTG requests. Open with flamegraph.pl or speedscope.app")
+
 @bot.message_handler(commands=['silence', 'sleep'])
 async def silence(message):
     chat_id = str(message.chat.id)
@@ -237,10 +376,75 @@ def command_param_text(text):
         return ''
     return ' '.join(text_words[1:])
 
+async def start_webhook():
+    """The webhook server if one is configured and could be registered, else None to poll"""
+    if not tooGoodToGo.webhook_url:
+        return None
+    webhook = WebhookServer(bot, tooGoodToGo.webhook_url,
+                            host=tooGoodToGo.webhook_host,
+                            port=tooGoodToGo.webhook_port,
+                            path=tooGoodToGo.webhook_path,
+                            secret_token=tooGoodToGo.webhook_secret,
+                            max_concurrent_updates=tooGoodToGo.webhook_max_concurrent_updates)
+    try:
+        await webhook.start()
+        return webhook
+    except Exception as err:
+        print(f"Webhook unavailable, falling back to polling: {err=}")
+        return None
+
+async def main():
+    """Run until SIGTERM, SIGHUP reloads the Configuration section"""
+    global profiling
+    profiling = asyncio.Lock()
+    stopping = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    except NotImplementedError:
+        pass
+    config_reloader = ConfigReloader('config.ini', 'Configuration', tooGoodToGo.reload_config,
+                                     tooGoodToGo.config_reload_seconds, forward_to=workers)
+
+    webhook = None
+    updates = None
+    try:
+        await tooGoodToGo.start()
+        config_reloader.start()
+        webhook = await start_webhook()
+        if not webhook:
+            # a webhook left by a previous run makes getUpdates fail
+            await bot.delete_webhook()
+            updates = asyncio.create_task(bot.polling(non_stop=True), name='telegram-updates')
+        stopped = asyncio.create_task(stopping.wait())
+        await asyncio.wait([task for task in (updates, stopped) if task], return_when=asyncio.FIRST_COMPLETED)
+        if updates and updates.done():
+            updates.result()
+    finally:
+        if updates:
+            updates.cancel()
+            await asyncio.gather(updates, return_exceptions=True)
+        if webhook:
+            await webhook.stop()
+        await config_reloader.stop()
+        # sends or checkpoints the pending alerts, the next start resumes from there
+        await tooGoodToGo.stop()
+
+# sharded mode: this process keeps the commands, the polling runs in the worker processes
+workers = [subprocess.Popen([sys.executable, 'Worker.py', str(number)]) for number in range(tooGoodToGo.workers)]
+
+@atexit.register
+def stop_workers():
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.wait()
+
 print('TooGoodToGo bot started')
 while True:
     try:
-        asyncio.run(bot.polling())
+        asyncio.run(main())
+        print("SIGTERM received. Shutting Down")
+        break
     except KeyboardInterrupt:
         print("Keyboard interrupt received. Shutting Down")
         break
@@ -248,3 +452,5 @@ while True:
         print("An Exception occurred: ", e)
         with open("exceptions.log", 'a') as ex_file:
             print("An Exception occurred: ", e, file=ex_file)
+        # a failing start would otherwise restart in a tight loop
+        time.sleep(10)
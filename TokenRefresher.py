@@ -0,0 +1,91 @@
+import time
+import random
+import asyncio
+
+import tgtg
+
+from Metrics import TOKEN_REFRESHES
+from Scheduler import PollScheduler
+from RequestBudget import CircuitOpenError
+
+
+class TokenRefresher:
+    """
+    Refreshes the access tokens of the connected clients ahead of their expiry, at a random point of the
+    last margin_seconds so they are spread over time. persist() is called once per tick to save them in one write.
+    """
+
+    def __init__(self, clients: dict, persist, handle_api_error, margin_seconds=1800, retry_seconds=60, record_call=None):
+        self.clients = clients
+        self.persist = persist
+        self.handle_api_error = handle_api_error
+        # record_call(user_id, seconds, size) counts the refresh requests in the usage stats
+        self.record_call = record_call
+        self.margin_seconds = margin_seconds
+        self.retry_seconds = retry_seconds
+        self.scheduler = PollScheduler()
+        self.refreshed = 0
+
+    def due_at(self, client) -> float:
+        if client.last_time_token_refreshed is None:
+            return time.time()
+        # tgtg keeps naive local datetimes
+        expires_at = client.last_time_token_refreshed.timestamp() + client.access_token_lifetime
+        return expires_at - self.margin_seconds - random.uniform(0, self.margin_seconds)
+
+    async def run(self):
+        while True:
+            for user_id, client in list(self.clients.items()):
+                if user_id not in self.scheduler:
+                    self.scheduler.schedule(user_id, self.due_at(client))
+
+            due_users = [user_id for user_id in self.scheduler.pop_due(time.time()) if user_id in self.clients]
+            if due_users:
+                await asyncio.gather(*(self.refresh(user_id) for user_id in due_users))
+
+            try:
+                self.persist()
+            except Exception as err:
+                print(f"Unexpected {err=}, {type(err)=}")
+
+            next_due = self.scheduler.next_due()
+            await asyncio.sleep(max(1, min(60, next_due - time.time())) if next_due else 60)
+
+    async def refresh(self, user_id):
+        client = self.clients[user_id]
+        try:
+            await self.counted_refresh(user_id, client)
+            self.refreshed += 1
+            TOKEN_REFRESHES.inc('ok')
+            self.scheduler.schedule(user_id, self.due_at(client))
+        except tgtg.exceptions.TgtgAPIError as err:
+            TOKEN_REFRESHES.inc('error')
+            self.handle_api_error(err, user_id)
+            if user_id in self.clients:
+                self.scheduler.schedule(user_id, time.time() + self.retry_seconds)
+        except Exception as err:
+            TOKEN_REFRESHES.inc('error')
+            print(f"[{user_id}] Unexpected {err=}, {type(err)=}")
+            self.scheduler.schedule(user_id, time.time() + self.retry_seconds)
+
+    async def counted_refresh(self, user_id, client):
+        sent = True
+        try:
+            await client.run(force_refresh_token, client.client)
+        except CircuitOpenError:
+            sent = False
+            raise
+        finally:
+            if sent and self.record_call:
+                self.record_call(user_id, client.last_elapsed, client.response_bytes)
+
+
+def force_refresh_token(client):
+    """TgtgClient._refresh_token only refreshes expired tokens, forget the refresh time to make it refresh now"""
+    last_time_token_refreshed = client.last_time_token_refreshed
+    client.last_time_token_refreshed = None
+    try:
+        client._refresh_token()
+    except Exception:
+        client.last_time_token_refreshed = last_time_token_refreshed
+        raise
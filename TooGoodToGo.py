@@ -1,9 +1,10 @@
-import json
 import time
+import random
+import asyncio
+from functools import lru_cache
 from configparser import SectionProxy
 
-from pathlib import Path
-from _thread import start_new_thread
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pytz import timezone, utc
 from babel.numbers import format_currency
@@ -11,7 +12,25 @@ from babel.numbers import format_currency
 import tgtg
 
 from tgtg import TgtgClient
-from telebot import TeleBot, types
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+from AsyncTgtg import AsyncTgtgClient, shared_http_adapter
+from RequestBudget import RequestBudget, CircuitOpenError
+from LoginManager import LoginManager
+from Storage import open_storage
+from ItemState import ItemState, ItemCache, item_fingerprint
+from MessageQueue import MessageDispatcher, PRIORITY_HIGH, PRIORITY_NORMAL
+from History import StockHistory, RestockModel
+from Scheduler import PollScheduler
+from TokenRefresher import TokenRefresher
+from SubscriberIndex import SubscriberIndex
+from GeoIndex import GeoIndex, parse_category
+from Capture import CaptureWriter
+from UsageStats import UsageStats, CALLS, BYTES, SECONDS, NOTIFICATIONS as USER_NOTIFICATIONS
+from Sharding import ShardCoordinator
+from Metrics import (MetricsServer, POLL_BATCH_SECONDS, POLL_BATCH_USERS, TGTG_API_ERRORS, NOTIFICATIONS,
+                     STORAGE_WRITE_SECONDS, OUTBOUND_QUEUE, CONNECTED_CLIENTS, USERS, TGTG_REQUEST_RATE, TGTG_CIRCUIT_OPEN)
 
 class TooGoodToGo:
 
@@ -22,36 +41,286 @@ class TooGoodToGo:
         'stock_increased': 'Stock increased',
     }
 
+    # items per digest message
+    DIGEST_MAX_ITEMS = 8
+
+    # settings reload_config cannot change in a running process
+    RESTART_SETTINGS = ('tgtg_url', 'storage_backend', 'polling_concurrency', 'http_pool_size', 'max_concurrent_logins',
+                        'max_pending_logins', 'telegram_senders', 'history_max_file_mb', 'history_max_files',
+                        'history_days', 'workers', 'shard_count', 'shard_lease_seconds', 'metrics_port', 'metrics_host',
+                        'webhook_url', 'webhook_host', 'webhook_port', 'webhook_path', 'webhook_secret',
+                        'webhook_max_concurrent_updates', 'capture_file', 'geo_tile_km', 'config_reload_seconds')
+
     users_login_data = {}
     users_settings_data = {}
     available_items_favorites = {}
     connected_clients = {}
 
-    def __init__(self, bot_token: str, config: SectionProxy = {}):
-        self.bot = TeleBot(bot_token)
+    def __init__(self, bot: AsyncTeleBot, config: SectionProxy = {}, worker_number: int = None):
+        self.bot = bot
 
         self.__set_config(config)
 
+        # sharded mode: the front process handles the commands, the workers poll the users of their shards
+        self.shard = None
+        self.shard_keeper = None
+        self.is_front = self.workers > 0 and worker_number is None
+        # the checkpoint row of this process
+        self.process_name = 'main' if worker_number is None else f'worker-{worker_number}'
+        history_folder = 'data/history'
+        metrics_port = self.metrics_port
+        if worker_number is not None:
+            if self.storage_backend != 'sqlite':
+                raise ValueError("Workers share the sqlite database, set storage = sqlite")
+            self.shard = ShardCoordinator(f'worker-{worker_number}', self.shard_count, self.shard_lease_seconds)
+            history_folder = f'data/history/worker-{worker_number}'
+            if metrics_port:
+                metrics_port += worker_number + 1
+
+        self.dispatcher = MessageDispatcher(self.bot,
+                                            messages_per_second=self.get_telegram_messages_per_second(),
+                                            chat_messages_per_second=self.telegram_chat_messages_per_second,
+                                            senders=self.telegram_senders)
+
+        self.subscriber_index = SubscriberIndex()
+        self.geo_index = GeoIndex(self.geo_tile_km)
+        self.usage_stats = UsageStats(self.stats_cycles)
+        self.poll_scheduler = PollScheduler()
+        self.stock_history = StockHistory(history_folder, max_file_bytes=self.history_max_file_mb * 1024 * 1024,
+                                          max_files=self.history_max_files)
+        self.restock_model = RestockModel(self.timezone)
+        self.restock_model.load(self.stock_history, self.history_days)
+        self.item_cache = ItemCache(self.item_cache_size)
+        # (item_id, fingerprint, status) -> formatted text, one render per item change whatever the subscribers
+        self.render_cache = ItemCache(self.render_cache_size)
+        self.digests = {}
+        # logged in users with an alert enabled and not silenced, kept up to date by the login and settings saves
+        self.eligible_users = set()
+        # silenced users by silence_exp timestamp, woken up by the poller
+        self.silence_scheduler = PollScheduler()
+        # runs the blocking tgtg requests, bounds how many are in flight
+        self.tgtg_executor = ThreadPoolExecutor(max_workers=self.polling_concurrency,
+                                                thread_name_prefix='tgtg')
+        self.http_adapter = shared_http_adapter(max(self.http_pool_size, self.polling_concurrency))
+        # app version of the user agents, looked up once for every client
+        self.apk_version = None
+        self.apk_version_lock = asyncio.Lock()
+        self.request_budget = RequestBudget(self.tgtg_requests_per_second,
+                                            max_backoff_seconds=self.tgtg_backoff_max_seconds,
+                                            breaker_failures=self.circuit_breaker_failures,
+                                            breaker_seconds=self.circuit_breaker_seconds)
+        self.poller = None
+        self.geo_poller = None
+        # set by stop(), the pollers finish their batch and return
+        self.stopping = False
+        self.idle_waiters = set()
+        self.login_manager = LoginManager(self.max_concurrent_logins, self.max_pending_logins)
+        self.token_refresher = TokenRefresher(self.connected_clients, self.save_refreshed_credentials, self.handle_api_error,
+                                              margin_seconds=self.token_refresh_margin_minutes * 60,
+                                              record_call=self.usage_stats.record_call)
+        self.refresher = None
+        self.metrics_server = MetricsServer(self.metrics_host, metrics_port) if metrics_port else None
+        OUTBOUND_QUEUE.set_function(lambda: self.dispatcher.queue_depth)
+        CONNECTED_CLIENTS.set_function(lambda: len(self.connected_clients))
+        USERS.set_function(lambda: len(self.users_login_data))
+        TGTG_REQUEST_RATE.set_function(lambda: self.request_budget.rate)
+        TGTG_CIRCUIT_OPEN.set_function(lambda: int(self.request_budget.is_open()))
+
+        self.capture = CaptureWriter(self.capture_file) if self.capture_file else None
+
+        self.storage = open_storage(self.storage_backend)
+
         self.read_users_login_data_from_txt()
         self.read_users_settings_data_from_txt()
         self.read_available_items_favorites_from_txt()
-
-        start_new_thread(self.get_available_items_per_user, ())
-
-        self.bot.set_my_commands([
+        self.read_geo_subscriptions_from_txt()
+        self.update_eligible_users()
+
+    async def start(self):
+        """Start the poller and the message senders on the running event loop"""
+        self.stopping = False
+        # the locks of a previous asyncio.run() are bound to its closed loop
+        self.apk_version_lock = asyncio.Lock()
+        for client in self.connected_clients.values():
+            client.lock = asyncio.Lock()
+        self.login_manager.reset()
+        self.dispatcher.start()
+        if self.shard:
+            # own shards and their users before the first poll
+            await self.sync_shards(reload=True)
+            self.shard_keeper = asyncio.create_task(self.keep_shards(), name='shard-keeper')
+        self.restore_checkpoint()
+        if not self.is_front:
+            self.poller = asyncio.create_task(self.get_available_items_per_user(), name='poller')
+            self.refresher = asyncio.create_task(self.token_refresher.run(), name='token-refresher')
+            self.geo_poller = asyncio.create_task(self.poll_tiles_forever(), name='geo-poller')
+        if self.metrics_server:
+            await self.metrics_server.start()
+
+        if self.shard:
+            return
+
+        await self.bot.set_my_commands([
             types.BotCommand("/info", "favorite bags currently available"),
             types.BotCommand("/login", "log in with your email"),
+            types.BotCommand("/cancel", "cancel a pending login"),
             types.BotCommand("/settings", "set when you want to be notified"),
+            types.BotCommand("/near", "bags available around a location"),
             types.BotCommand("/help", "Help dialog"),
             types.BotCommand("/sleep", "Silence the bot for a while"),
         ])
-    
+
+    async def stop(self):
+        """
+        Let the running poll batches finish, send the queued alerts for up to shutdown_timeout_seconds, and checkpoint
+        what is left so the next process resumes without missing or repeating alerts
+        """
+        deadline = time.monotonic() + self.shutdown_timeout_seconds
+        self.stopping = True
+        self.wake_up()
+        # a batch saves its item states after queueing its alerts, cancelling it in between would repeat them
+        pollers = [task for task in (self.poller, self.geo_poller) if task]
+        if pollers:
+            await asyncio.wait(pollers, timeout=max(0.0, deadline - time.monotonic()))
+
+        for task in (self.poller, self.refresher, self.shard_keeper, self.geo_poller):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self.poller = None
+        self.geo_poller = None
+        self.refresher = None
+        self.shard_keeper = None
+
+        self.flush_digests(force=True)
+        if not await self.dispatcher.drain(max(0.0, deadline - time.monotonic())):
+            print(f"{self.dispatcher.queue_depth} messages left, they are sent by the next start")
+        await self.dispatcher.stop(max(0.0, deadline - time.monotonic()))
+        self.checkpoint()
+
+        if self.shard:
+            self.shard.release()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        if self.capture:
+            self.capture.flush()
+
+    def checkpoint(self):
+        """Save the item states and tokens not saved yet, the poll schedule and the unsent messages"""
+        try:
+            self.stock_history.flush()
+            # the counts are saved by every batch, only the last_seen times can be behind
+            unsaved_item_ids = [item_id for item_id, state in self.available_items_favorites.items()
+                                if state.last_seen != state.stored_last_seen]
+            if unsaved_item_ids:
+                self.save_available_items_favorites_to_txt(*unsaved_item_ids)
+            self.save_refreshed_credentials()
+            self.storage.save('checkpoint', {self.process_name: {
+                'saved_at': time.time(),
+                'apk_version': self.apk_version,
+                'poll_schedule': dict(self.poll_scheduler.due_at),
+                'pending_messages': self.dispatcher.checkpoint(),
+            }}, [self.process_name])
+            print(f"Checkpoint saved: {len(self.poll_scheduler)} scheduled users, "
+                  f"{self.dispatcher.queue_depth} pending messages")
+        except Exception as err:
+            print(f"Checkpoint failed {err=}, {type(err)=}")
+
+    def restore_checkpoint(self):
+        """Resume the poll schedule and send the messages left by the last stop, the checkpoint is used once"""
+        checkpoint = self.storage.read('checkpoint', [self.process_name]).get(self.process_name)
+        if not checkpoint:
+            return
+        # the app version is looked up again once a day
+        if checkpoint.get('apk_version') and time.time() - checkpoint['saved_at'] < 24 * 3600:
+            self.apk_version = self.apk_version or checkpoint['apk_version']
+        for user_id, due_at in checkpoint.get('poll_schedule', {}).items():
+            if user_id in self.users_login_data and user_id not in self.poll_scheduler:
+                self.poll_scheduler.schedule(user_id, due_at)
+        self.dispatcher.restore(checkpoint.get('pending_messages', []))
+        self.storage.save('checkpoint', {}, [self.process_name])
+        print(f"Checkpoint restored: {len(self.poll_scheduler)} scheduled users, "
+              f"{len(checkpoint.get('pending_messages', []))} pending messages")
+
+    def reload_config(self, config: SectionProxy):
+        """Apply a changed config to the running process, see RESTART_SETTINGS for what needs a restart"""
+        running = dict(self.__dict__)
+        try:
+            self.__set_config(config)
+        except Exception:
+            self.__dict__.update(running)
+            raise
+
+        needs_restart = [name for name in TooGoodToGo.RESTART_SETTINGS if getattr(self, name) != running[name]]
+        if (self.request_budget.bucket is None) != (self.tgtg_requests_per_second == 0):
+            needs_restart.append('tgtg_requests_per_second')
+        for name in needs_restart:
+            print(f"{name} changes at the next restart")
+            setattr(self, name, running[name])
+
+        if str(self.timezone) != str(running['timezone']):
+            self.restock_model = RestockModel(self.timezone)
+            self.restock_model.load(self.stock_history, self.history_days)
+        self.dispatcher.set_rates(self.get_telegram_messages_per_second(), self.telegram_chat_messages_per_second)
+        if self.request_budget.bucket and self.tgtg_requests_per_second:
+            self.request_budget.max_rate = self.tgtg_requests_per_second
+            self.request_budget.set_rate(min(self.request_budget.rate, self.tgtg_requests_per_second))
+        self.request_budget.max_backoff_seconds = self.tgtg_backoff_max_seconds
+        self.request_budget.breaker_failures = self.circuit_breaker_failures
+        self.request_budget.breaker_seconds = self.circuit_breaker_seconds
+        self.token_refresher.margin_seconds = self.token_refresh_margin_minutes * 60
+        self.item_cache.max_size = self.item_cache_size
+        self.render_cache.max_size = self.render_cache_size
+        # the cached texts show the pickup times in the old zone and format
+        if str(self.timezone) != str(running['timezone']) or self.date_format != running['date_format']:
+            self.render_cache.clear()
+        self.usage_stats.resize(self.stats_cycles)
+
+        # users waiting for a longer interval than the new settings give are polled sooner
+        now = time.time()
+        for user_id, due_at in list(self.poll_scheduler.due_at.items()):
+            if user_id in self.users_login_data:
+                latest_due_at = now + self.get_user_interval_seconds(user_id, now)
+                if due_at > latest_due_at:
+                    self.poll_scheduler.schedule(user_id, latest_due_at)
+        self.wake_up()
+        print('Config reloaded')
+
+    def get_telegram_messages_per_second(self):
+        # the Telegram rate limit is per bot, shared by the front process and the workers
+        if self.shard or self.is_front:
+            return self.telegram_messages_per_second / (self.workers + 1)
+        return self.telegram_messages_per_second
+
+    async def idle(self, seconds):
+        """Sleep for up to seconds, cut short by stop() and reload_config()"""
+        if self.stopping:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.idle_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.idle_waiters.discard(waiter)
+
+    def wake_up(self):
+        for waiter in self.idle_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
     def __set_config(self, config: SectionProxy):
         self.timezone = timezone(config.get('timezone', 'UTC'))
         print('timezone', self.timezone)
 
         self.language = config.get('language', 'en-GB')
         print('language', self.language)
+
+        # the TGTG API, can point to a stand-in server for benchmarks
+        self.tgtg_url = config.get('tgtg_url', tgtg.BASE_URL)
+        print('tgtg_url', self.tgtg_url)
         
         self.date_format = config.get('date_format', '%a %d.%m at %H:%M')
         print('date_format', self.date_format)
@@ -62,6 +331,18 @@ class TooGoodToGo:
 
         tgtg.MAX_POLLING_TRIES = (self.login_timeout_minutes * 60) // tgtg.POLLING_WAIT_TIME
 
+        # min 1 default 4, tgtg requests in flight for logins
+        self.max_concurrent_logins = max(1, int(config.get('max_concurrent_logins', 4)))
+        print('max_concurrent_logins', self.max_concurrent_logins)
+
+        # min 1 max 120 default 30, tokens are refreshed at a random time of their last minutes of validity
+        self.token_refresh_margin_minutes = max(1, min(120, int(config.get('token_refresh_margin_minutes', 30))))
+        print('token_refresh_margin_minutes', self.token_refresh_margin_minutes)
+
+        # min 1 default 100, logins waiting for the email confirmation
+        self.max_pending_logins = max(1, int(config.get('max_pending_logins', 100)))
+        print('max_pending_logins', self.max_pending_logins)
+
         # min 5 default 60
         self.interval_seconds = max(5, int(config.get('interval_seconds', 60)))
         print('interval_seconds', self.interval_seconds)
@@ -77,11 +358,190 @@ class TooGoodToGo:
         self.low_hours_end = max(0, min(23, int(config.get('low_hours_end', 6))))
         print('Low hours', self.low_hours_start, '-', self.low_hours_end)
 
-    def send_message(self, telegram_user_id, message, parse_mode=None):
-        self.bot.send_message(telegram_user_id, text=message, parse_mode=parse_mode)
+        # min 5 max self.interval_seconds default self.interval_seconds / 3
+        self.hot_interval_seconds = max(5, min(self.interval_seconds, int(config.get('hot_interval_seconds', self.interval_seconds // 3))))
+        print('hot_interval_seconds', self.hot_interval_seconds)
+
+        # min self.interval_seconds max self.low_hours_interval_seconds default 2 * self.interval_seconds
+        self.cold_interval_seconds = max(self.interval_seconds, min(self.low_hours_interval_seconds, int(config.get('cold_interval_seconds', 2 * self.interval_seconds))))
+        print('cold_interval_seconds', self.cold_interval_seconds)
+
+        # min 5 max 180 default 30, minutes around the expected restock time when items are polled at hot_interval_seconds
+        self.hot_window_minutes = max(5, min(180, int(config.get('hot_window_minutes', 30))))
+        print('hot_window_minutes', self.hot_window_minutes)
+
+        # min 1 default 8
+        self.polling_concurrency = max(1, int(config.get('polling_concurrency', 8)))
+        print('polling_concurrency', self.polling_concurrency)
 
-    def send_message_with_link(self, telegram_user_id, message, item_id):
-        self.bot.send_message(telegram_user_id, text=message, reply_markup=types.InlineKeyboardMarkup(
+        # min 1 default 16, keep-alive connections shared by all the tgtg clients
+        self.http_pool_size = max(1, int(config.get('http_pool_size', 16)))
+        print('http_pool_size', self.http_pool_size)
+
+        # min self.interval_seconds default 900
+        self.favorites_sync_interval_seconds = max(self.interval_seconds, int(config.get('favorites_sync_interval_seconds', 900)))
+        print('favorites_sync_interval_seconds', self.favorites_sync_interval_seconds)
+
+        # min 10 default 1000
+        self.item_cache_size = max(10, int(config.get('item_cache_size', 1000)))
+        print('item_cache_size', self.item_cache_size)
+
+        # min 10 default 2000
+        self.render_cache_size = max(10, int(config.get('render_cache_size', 2000)))
+        print('render_cache_size', self.render_cache_size)
+
+        # min 1 default 72
+        self.item_state_ttl_hours = max(1, int(config.get('item_state_ttl_hours', 72)))
+        print('item_state_ttl_hours', self.item_state_ttl_hours)
+
+        # min 1 default 30, Telegram allows about 30 messages per second
+        self.telegram_messages_per_second = max(1, int(config.get('telegram_messages_per_second', 30)))
+        print('telegram_messages_per_second', self.telegram_messages_per_second)
+
+        # min 0.05 default 1
+        self.telegram_chat_messages_per_second = max(0.05, float(config.get('telegram_chat_messages_per_second', 1)))
+        print('telegram_chat_messages_per_second', self.telegram_chat_messages_per_second)
+
+        # min 1 default 4
+        self.telegram_senders = max(1, int(config.get('telegram_senders', 4)))
+        print('telegram_senders', self.telegram_senders)
+
+        # min 0 max 3600 default 0, 0 sends the digests at the end of every poll cycle
+        self.digest_window_seconds = max(0, min(3600, int(config.get('digest_window_seconds', 0))))
+        print('digest_window_seconds', self.digest_window_seconds)
+
+        # min 1 default 16
+        self.history_max_file_mb = max(1, int(config.get('history_max_file_mb', 16)))
+        print('history_max_file_mb', self.history_max_file_mb)
+
+        # min 1 default 24
+        self.history_max_files = max(1, int(config.get('history_max_files', 24)))
+        print('history_max_files', self.history_max_files)
+
+        # min 7 default 90, days of history used to predict the restock times
+        self.history_days = max(7, int(config.get('history_days', 90)))
+        print('history_days', self.history_days)
+
+        # min 0 default 60, age of the poller data /info answers from without fetching again
+        self.info_cache_seconds = max(0, int(config.get('info_cache_seconds', 60)))
+        print('info_cache_seconds', self.info_cache_seconds)
+
+        # sqlite or json, default sqlite
+        self.storage_backend = config.get('storage', 'sqlite')
+        print('storage', self.storage_backend)
+
+        # min 0 (unlimited) default 10, process-wide TGTG request rate, halved on 429 and raised back on success
+        self.tgtg_requests_per_second = max(0.0, float(config.get('tgtg_requests_per_second', 10)))
+        print('tgtg_requests_per_second', self.tgtg_requests_per_second)
+
+        # min 1 default 60, longest backoff after 429 or 5xx responses
+        self.tgtg_backoff_max_seconds = max(1, int(config.get('tgtg_backoff_max_seconds', 60)))
+        print('tgtg_backoff_max_seconds', self.tgtg_backoff_max_seconds)
+
+        # min 1 default 10, failures in a row that pause the TGTG requests
+        self.circuit_breaker_failures = max(1, int(config.get('circuit_breaker_failures', 10)))
+        print('circuit_breaker_failures', self.circuit_breaker_failures)
+
+        # min 1 default 60, first pause of the TGTG requests, doubled while the failures go on
+        self.circuit_breaker_seconds = max(1, int(config.get('circuit_breaker_seconds', 60)))
+        print('circuit_breaker_seconds', self.circuit_breaker_seconds)
+
+        # default empty (long polling), public https url Telegram sends the updates to, e.g. https://bot.example.com
+        self.webhook_url = config.get('webhook_url', '')
+        print('webhook_url', self.webhook_url)
+
+        # default 0.0.0.0 and 8443, where the webhook server listens (behind the reverse proxy of webhook_url)
+        self.webhook_host = config.get('webhook_host', '0.0.0.0')
+        self.webhook_port = int(config.get('webhook_port', 8443))
+        print('webhook_listen', f'{self.webhook_host}:{self.webhook_port}')
+
+        # default /telegram
+        self.webhook_path = config.get('webhook_path', '/telegram')
+        print('webhook_path', self.webhook_path)
+
+        # default empty (a random one every start), checked on every update
+        self.webhook_secret = config.get('webhook_secret', '')
+
+        # min 1 default 32, updates handled at once
+        self.webhook_max_concurrent_updates = max(1, int(config.get('webhook_max_concurrent_updates', 32)))
+        print('webhook_max_concurrent_updates', self.webhook_max_concurrent_updates)
+
+        # default empty, comma separated Telegram ids allowed to use /stats and /profile
+        self.admin_ids = {admin_id.strip() for admin_id in config.get('admin_ids', '').split(',') if admin_id.strip()}
+        print('admin_ids', self.admin_ids)
+
+        # min 1 default 10, poll batches /stats reports on
+        self.stats_cycles = max(1, int(config.get('stats_cycles', 10)))
+        print('stats_cycles', self.stats_cycles)
+
+        # default empty (off), gzip file the favorites fetched by the poller are appended to, played back by Replay.py
+        self.capture_file = config.get('capture_file', '')
+        print('capture_file', self.capture_file)
+
+        # min 1 default 5, side of the map tiles location subscriptions share one query per cycle for
+        self.geo_tile_km = max(1.0, float(config.get('geo_tile_km', 5)))
+        print('geo_tile_km', self.geo_tile_km)
+
+        # min 30 default 120, how often each tile with subscribers is queried
+        self.geo_interval_seconds = max(30, int(config.get('geo_interval_seconds', 120)))
+        print('geo_interval_seconds', self.geo_interval_seconds)
+
+        # min 1 default 20, largest radius of a location subscription
+        self.geo_max_radius_km = max(1.0, float(config.get('geo_max_radius_km', 20)))
+        print('geo_max_radius_km', self.geo_max_radius_km)
+
+        # min 0.1 default 2, radius of a location shared without one
+        self.geo_default_radius_km = min(self.geo_max_radius_km, max(0.1, float(config.get('geo_default_radius_km', 2))))
+        print('geo_default_radius_km', self.geo_default_radius_km)
+
+        # min 1 default 50 and 3, items per page and pages fetched per tile
+        self.geo_page_size = max(1, int(config.get('geo_page_size', 50)))
+        self.geo_max_pages = max(1, int(config.get('geo_max_pages', 3)))
+        print('geo_pages', f'{self.geo_max_pages} x {self.geo_page_size}')
+
+        # default 0 (one process), worker processes polling the users in sharded mode
+        self.workers = max(0, int(config.get('workers', 0)))
+        if self.workers and self.storage_backend != 'sqlite':
+            # each worker would rewrite the json files with the users of its own shards only
+            print('workers need storage = sqlite, running in one process')
+            self.workers = 0
+        print('workers', self.workers)
+
+        # min 1 default 64, users are split in shards, shards are spread over the workers
+        self.shard_count = max(1, int(config.get('shard_count', 64)))
+        print('shard_count', self.shard_count)
+
+        # min 5 default 30, a dead worker's shards are taken over once its leases expire
+        self.shard_lease_seconds = max(5, int(config.get('shard_lease_seconds', 30)))
+        print('shard_lease_seconds', self.shard_lease_seconds)
+
+        # min 5 default 30, how often workers reload the logins and settings changed by the front process
+        self.shard_reload_seconds = max(5, int(config.get('shard_reload_seconds', 30)))
+        print('shard_reload_seconds', self.shard_reload_seconds)
+
+        # min 0 (SIGHUP only) default 10, how often config.ini is checked for changes
+        self.config_reload_seconds = max(0, int(config.get('config_reload_seconds', 10)))
+        print('config_reload_seconds', self.config_reload_seconds)
+
+        # min 0 default 8, time to finish the running poll batch and send the queued messages when stopping,
+        # keep it under the time the process manager waits before killing the bot (10 seconds for docker stop)
+        self.shutdown_timeout_seconds = max(0, int(config.get('shutdown_timeout_seconds', 8)))
+        print('shutdown_timeout_seconds', self.shutdown_timeout_seconds)
+
+        # default 0 (disabled), port of the Prometheus metrics endpoint
+        self.metrics_port = max(0, int(config.get('metrics_port', 0)))
+        print('metrics_port', self.metrics_port)
+
+        # default 127.0.0.1
+        self.metrics_host = config.get('metrics_host', '127.0.0.1')
+        print('metrics_host', self.metrics_host)
+
+    # Messages are queued and sent by the dispatcher threads
+    def send_message(self, telegram_user_id, message, parse_mode=None, priority=PRIORITY_HIGH):
+        self.dispatcher.enqueue(telegram_user_id, priority, text=message, parse_mode=parse_mode)
+
+    def send_message_with_link(self, telegram_user_id, message, item_id, priority=PRIORITY_NORMAL):
+        self.dispatcher.enqueue(telegram_user_id, priority, text=message, reply_markup=types.InlineKeyboardMarkup(
             keyboard=[
                 [
                     types.InlineKeyboardButton(
@@ -93,29 +553,93 @@ class TooGoodToGo:
             ])
         )
 
+    def send_digest(self, telegram_user_id, entries):
+        """Send several item messages as few messages, each with one "Open in app" button per item"""
+        priority = PRIORITY_HIGH if any(status == 'new_stock' for _, _, _, status in entries) else PRIORITY_NORMAL
+
+        chunks = [[]]
+        chunk_length = 0
+        for entry in entries:
+            entry_length = len(entry[2]) + 2
+            # Telegram messages are limited to 4096 characters
+            if chunks[-1] and (len(chunks[-1]) >= TooGoodToGo.DIGEST_MAX_ITEMS or chunk_length + entry_length > 4096):
+                chunks.append([])
+                chunk_length = 0
+            chunks[-1].append(entry)
+            chunk_length += entry_length
+
+        for chunk in chunks:
+            self.dispatcher.enqueue(telegram_user_id, priority,
+                                    text='\n\n'.join(item_text for _, _, item_text, _ in chunk),
+                                    reply_markup=types.InlineKeyboardMarkup(
+                keyboard=[
+                    [
+                        types.InlineKeyboardButton(
+                            text=f"Open {store_name} 📱",
+                            callback_data="open_app",
+                            url="https://share.toogoodtogo.com/item/" + item_id
+                        )
+                    ] for item_id, store_name, _, _ in chunk
+                ])
+            )
+
     def read_users_login_data_from_txt(self):
-        with open(data_file('users_login_data'), 'r') as file:
-            self.users_login_data = json.load(file, cls=DateTimeDecoder)
+        self.users_login_data = self.storage.read('users_login_data')
 
-    def save_users_login_data_to_txt(self):
-        with open(data_file('users_login_data'), 'w') as file:
-            json.dump(self.users_login_data, file, cls=DateTimeEncoder)
+    def save_users_login_data_to_txt(self, *user_ids):
+        with STORAGE_WRITE_SECONDS.time('users_login_data'):
+            self.storage.save('users_login_data', self.users_login_data, user_ids or None)
+        self.update_eligible_users(*user_ids)
 
     def read_users_settings_data_from_txt(self):
-        with open(data_file('users_settings_data'), 'r') as file:
-            self.users_settings_data = json.load(file)
+        self.users_settings_data = self.storage.read('users_settings_data')
 
-    def save_users_settings_data_to_txt(self):
-        with open(data_file('users_settings_data'), 'w') as file:
-            json.dump(self.users_settings_data, file)
+    def save_users_settings_data_to_txt(self, *user_ids):
+        with STORAGE_WRITE_SECONDS.time('users_settings_data'):
+            self.storage.save('users_settings_data', self.users_settings_data, user_ids or None)
+        self.update_eligible_users(*user_ids)
 
     def read_available_items_favorites_from_txt(self):
-        with open(data_file('available_items_favorites'), 'r') as file:
-            self.available_items_favorites = json.load(file)
+        rows = self.storage.read('available_items_favorites')
+        self.available_items_favorites = {item_id: ItemState.from_row(row) for item_id, row in rows.items()}
 
-    def save_available_items_favorites_to_txt(self):
-        with open(data_file('available_items_favorites'), 'w') as file:
-            json.dump(self.available_items_favorites, file)
+    def save_available_items_favorites_to_txt(self, *item_ids):
+        if item_ids:
+            rows = {item_id: self.available_items_favorites[item_id].to_row() for item_id in item_ids
+                    if item_id in self.available_items_favorites}
+        else:
+            rows = {item_id: state.to_row() for item_id, state in self.available_items_favorites.items()}
+        with STORAGE_WRITE_SECONDS.time('available_items_favorites'):
+            self.storage.save('available_items_favorites', rows, item_ids or None)
+
+    def read_geo_subscriptions_from_txt(self):
+        self.geo_index.clear()
+        for user_id, subscription in self.storage.read('geo_subscriptions').items():
+            if self.shard is None or self.shard.owns(user_id):
+                self.geo_index.subscribe(user_id, subscription)
+
+    def save_geo_subscriptions_to_txt(self, *user_ids):
+        with STORAGE_WRITE_SECONDS.time('geo_subscriptions'):
+            self.storage.save('geo_subscriptions', self.geo_index.subscriptions, user_ids or None)
+
+    def subscribe_location(self, user_id, latitude, longitude, radius_km=None, max_price=None, category=None):
+        """Alert the user of the bags within radius_km of a location, the radius is capped to geo_max_radius_km"""
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError(f"Invalid location {latitude}, {longitude}")
+        subscription = {
+            'latitude': latitude,
+            'longitude': longitude,
+            'radius_km': min(self.geo_max_radius_km, max(0.1, radius_km or self.geo_default_radius_km)),
+            'max_price': max_price,
+            'category': parse_category(category) if category else None,
+        }
+        self.geo_index.subscribe(user_id, subscription)
+        self.save_geo_subscriptions_to_txt(user_id)
+        return subscription
+
+    def unsubscribe_location(self, user_id):
+        self.geo_index.unsubscribe(user_id)
+        self.save_geo_subscriptions_to_txt(user_id)
 
     def add_user(self, login_client, telegram_user_id, telegram_username, credentials):
         credentials['email'] = login_client.email
@@ -123,20 +647,23 @@ class TooGoodToGo:
         credentials['last_time_token_refreshed'] = login_client.last_time_token_refreshed
 
         self.users_login_data[telegram_user_id] = credentials
-        self.save_users_login_data_to_txt()
+        self.save_users_login_data_to_txt(telegram_user_id)
 
         if telegram_user_id not in self.users_settings_data:
             self.users_settings_data[telegram_user_id] = {
                 'sold_out': 0,
                 'new_stock': 1,
                 'stock_reduced': 0,
-                'stock_increased': 0
+                'stock_increased': 0,
+                'digest': 0
             }
-            self.save_users_settings_data_to_txt()
+            self.save_users_settings_data_to_txt(telegram_user_id)
 
-    # Get the credentials
-    def new_user(self, telegram_user_id, telegram_username, email):
-        client = TgtgClient(email=email, language=self.language)
+    # Get the credentials, run through self.login_manager
+    async def new_user(self, telegram_user_id, telegram_username, email):
+        client = AsyncTgtgClient(TgtgClient(url=self.tgtg_url, email=email, language=self.language,
+                                            user_agent=await self.get_user_agent()),
+                                 self.tgtg_executor, self.http_adapter, self.request_budget)
 
         self.send_message(telegram_user_id, "📩 Please open your mail account."
                                     "\nYou will receive an email with a confirmation link."
@@ -145,9 +672,9 @@ class TooGoodToGo:
                                     "\n_You do not need to enter a password._", parse_mode="markdown")
 
         try:
-            credentials = client.get_credentials() # login
+            credentials = await self.login_manager.get_credentials(client) # login
             self.add_user(client, telegram_user_id, telegram_username, credentials)
-            self.connect(telegram_user_id)
+            await self.connect(telegram_user_id)
             self.send_message(telegram_user_id, "✅ You are now logged in!")
         except tgtg.exceptions.TgtgPollingError as err:
             if 'Max retries' in str(err):
@@ -161,37 +688,106 @@ class TooGoodToGo:
             print(f"Unexpected {err=}, {type(err)=}")
             self.send_message(telegram_user_id, "❌ An error happened while logging in. Please try again.")
     
-    # Save refreshed tokens and cookies
-    def update_credentials(self, telegram_user_id, refresh=False, client=None):
+    # Copy refreshed tokens and cookies of a client in the login data, True if they changed
+    def update_credentials(self, telegram_user_id, client=None):
         if not client:
             client = self.get_client(telegram_user_id)
 
             if not client:
                 return False
 
-        if refresh:
-            client.login() # tokens may need to be refreshed
-        
         user_credentials = self.find_credentials_by_telegramUserID(telegram_user_id)
 
-        if user_credentials and user_credentials['last_time_token_refreshed'] < client.last_time_token_refreshed:
+        if (user_credentials and client.last_time_token_refreshed
+                and user_credentials['last_time_token_refreshed'] < client.last_time_token_refreshed):
             user_credentials['last_time_token_refreshed'] = client.last_time_token_refreshed
             user_credentials['access_token'] = client.access_token
             user_credentials['refresh_token'] = client.refresh_token
             user_credentials['cookie'] = client.cookie
 
-            self.save_users_login_data_to_txt()
-
             print(f"{telegram_user_id} token refreshed")
+            return True
         
-        return True
+        return False
+
+    # Called by the token refresher, saves every refreshed client in one write
+    def save_refreshed_credentials(self):
+        refreshed_user_ids = [user_id for user_id, client in list(self.connected_clients.items())
+                              if self.update_credentials(user_id, client)]
+        if refreshed_user_ids:
+            self.save_users_login_data_to_txt(*refreshed_user_ids)
+
+    async def sync_shards(self, reload=False):
+        """Workers: renew the shard leases, reload the users when the shards changed or reload is set"""
+        loop = asyncio.get_running_loop()
+        shards = self.shard.shards
+        await loop.run_in_executor(None, self.shard.heartbeat)
+        if not reload and shards == self.shard.shards:
+            return
+
+        users_login_data = await loop.run_in_executor(None, self.storage.read, 'users_login_data')
+        self.users_settings_data = await loop.run_in_executor(None, self.storage.read, 'users_settings_data')
+        self.users_login_data = {user_id: credentials for user_id, credentials in users_login_data.items()
+                                 if self.shard.owns(user_id)}
+        self.update_eligible_users()
+        self.read_geo_subscriptions_from_txt()
+
+        for user_id, client in list(self.connected_clients.items()):
+            credentials = self.users_login_data.get(user_id)
+            # logged out, moved to another worker, or logged in again through the front process
+            if credentials is None or (client.last_time_token_refreshed
+                                       and credentials['last_time_token_refreshed'] > client.last_time_token_refreshed):
+                self.connected_clients.pop(user_id, None)
+            if credentials is None:
+                self.subscriber_index.remove(user_id)
+
+    async def keep_shards(self):
+        reloaded_at = time.time()
+        while True:
+            await asyncio.sleep(self.shard_lease_seconds / 3)
+            try:
+                reload = time.time() - reloaded_at >= self.shard_reload_seconds
+                await self.sync_shards(reload)
+                if reload:
+                    reloaded_at = time.time()
+            except Exception as err:
+                print(f"Unexpected {err=}, {type(err)=}")
+                self.drop_expired_shards()
+
+    def drop_expired_shards(self):
+        """Workers: stop polling the shards whose leases could not be renewed, until a heartbeat succeeds again"""
+        if not self.shard.lease_expired():
+            return
+        print(f"Shard leases expired, pausing {len(self.users_login_data)} users until the next heartbeat")
+        for user_id in self.users_login_data:
+            self.subscriber_index.remove(user_id)
+        self.shard.shards = set()
+        self.users_login_data = {}
+        self.update_eligible_users()
+        self.geo_index.clear()
+        # the tokens are rotated on refresh, the worker taking the shards over refreshes them from now on
+        self.connected_clients.clear()
+
+    def reload_credentials(self, user_id):
+        """Front process: take the tokens last refreshed by a worker, they are rotated on every refresh"""
+        credentials = self.storage.read('users_login_data', [user_id]).get(user_id)
+        known_credentials = self.users_login_data.get(user_id)
+        if credentials is None:
+            self.users_login_data.pop(user_id, None)
+            self.connected_clients.pop(user_id, None)
+        elif known_credentials is None or credentials['last_time_token_refreshed'] > known_credentials['last_time_token_refreshed']:
+            self.users_login_data[user_id] = credentials
+            self.connected_clients.pop(user_id, None)
 
     # Look if the user is already logged in
     def find_credentials_by_telegramUserID(self, user_id):
         return self.users_login_data.get(user_id)
 
     # Checks if a connection already exists, or if it has to be created initially.
-    def connect(self, user_id):
+    async def connect(self, user_id):
+        if self.is_front:
+            self.reload_credentials(user_id)
+
         client = self.get_client(user_id)
 
         if not client:
@@ -201,50 +797,121 @@ class TooGoodToGo:
                 return None
             
             print(f"Connect {user_id}")
-            client = TgtgClient(user_id=user_credentials["user_id"],
-                                access_token=user_credentials["access_token"],
-                                refresh_token=user_credentials["refresh_token"],
-                                last_time_token_refreshed=user_credentials["last_time_token_refreshed"],
-                                cookie=user_credentials["cookie"],
-                                language=self.language)
+            client = AsyncTgtgClient(TgtgClient(url=self.tgtg_url,
+                                                user_id=user_credentials["user_id"],
+                                                access_token=user_credentials["access_token"],
+                                                refresh_token=user_credentials["refresh_token"],
+                                                last_time_token_refreshed=user_credentials["last_time_token_refreshed"],
+                                                cookie=user_credentials["cookie"],
+                                                language=self.language,
+                                                user_agent=await self.get_user_agent()),
+                                     self.tgtg_executor, self.http_adapter, self.request_budget)
             self.connected_clients[user_id] = client
-            time.sleep(2)
 
         return client
+
+    async def get_user_agent(self):
+        """A user agent of the latest app version, TgtgClient would look the version up on Google Play for each client"""
+        if self.apk_version is None:
+            async with self.apk_version_lock:
+                if self.apk_version is None:
+                    loop = asyncio.get_running_loop()
+                    try:
+                        lookup = loop.run_in_executor(self.tgtg_executor, tgtg.get_last_apk_version)
+                        self.apk_version = await asyncio.wait_for(lookup, 10)
+                    except Exception as err:
+                        print(f"Failed to get last version {err=}")
+                        self.apk_version = tgtg.DEFAULT_APK_VERSION
+                    print('Using version', self.apk_version)
+        return random.choice(tgtg.USER_AGENTS).format(self.apk_version)
+
+    def get_user_priority(self, user_id):
+        """Sort key of the users in a batch: new stock alerts first, then the most recently refreshed sessions"""
+        last_time_token_refreshed = self.users_login_data[user_id].get('last_time_token_refreshed')
+        return (not self.users_settings_data[user_id].get('new_stock'),
+                -last_time_token_refreshed.timestamp() if last_time_token_refreshed else 0)
     
     def get_client(self, user_id):
         return self.connected_clients.get(user_id)
 
-    def get_favourite_items(self, telegram_user_id):
-        client = self.connect(telegram_user_id)
+    async def counted_get_items(self, user_id, client, **kwargs):
+        """client.get_items, counted in the usage stats of the user"""
+        sent = True
+        try:
+            return await client.get_items(**kwargs)
+        except CircuitOpenError:
+            sent = False
+            raise
+        finally:
+            # failed and timed out calls are usually the costliest, they are counted too
+            if sent:
+                self.usage_stats.record_call(user_id, client.last_elapsed, client.response_bytes)
+
+    async def get_favourite_items(self, telegram_user_id):
+        client = await self.connect(telegram_user_id)
 
         if not client:
             return None
 
-        favourite_items = client.get_items(favorites_only=True)
+        # tokens are refreshed ahead of time by self.token_refresher
+        favourite_items = await self.counted_get_items(telegram_user_id, client, favorites_only=True)
+
+        # no token refresher in the front process, save a refresh done by the request for the worker
+        if self.is_front and self.update_credentials(telegram_user_id, client):
+            self.save_users_login_data_to_txt(telegram_user_id)
+
+        for item in favourite_items:
+            self.item_cache.put(item['item']['item_id'], item)
 
-        self.update_credentials(telegram_user_id, client=client)
+        if self.capture:
+            self.capture.write(telegram_user_id, favourite_items)
+
+        return favourite_items
+
+    def get_cached_favourite_items(self, telegram_user_id):
+        """Favorites of a user from the poller data if all of them were fetched in the last info_cache_seconds, else None"""
+        if self.subscriber_index.is_stale(telegram_user_id, self.favorites_sync_interval_seconds):
+            return None
+
+        expiry = time.time() - self.info_cache_seconds
+        favourite_items = []
+        for item_id in self.subscriber_index.favourites(telegram_user_id):
+            item_state = self.available_items_favorites.get(item_id)
+            item = self.item_cache.get(item_id)
+            if item_state is None or item is None or item_state.last_seen < expiry:
+                return None
+            favourite_items.append(item)
 
         return favourite_items
 
     # /info command
-    def send_available_favourite_items_for_one_user(self, user_id):
+    async def send_available_favourite_items_for_one_user(self, user_id):
         try:
             available_items = []
-            favourite_items = self.get_favourite_items(user_id)
+            restock_hints = []
+            favourite_items = self.get_cached_favourite_items(user_id)
+            if favourite_items is None:
+                favourite_items = await self.get_favourite_items(user_id)
             for item in favourite_items:
+                item_id = item['item']['item_id']
+                restock_hint = self.format_restock_hint(item_id)
                 if item['items_available'] > 0:
-                    item_id = item['item']['item_id']
                     item_text = self.format_item(item)
+                    if restock_hint:
+                        item_text += '\n' + restock_hint
                     self.send_message_with_link(user_id, item_text, item_id)
                     available_items.append(item_id)
+                elif restock_hint:
+                    restock_hints.append(f"🍽 {item['store']['store_name'].strip()}\n{restock_hint}")
             if not favourite_items:
                 self.send_message(user_id, "You do not have any favorites to track yet")
             elif not available_items:
-                self.send_message(user_id, "Currently all your favorites are sold out 😕")
+                self.send_message(user_id, "\n\n".join(["Currently all your favorites are sold out 😕"] + restock_hints))
         except tgtg.exceptions.TgtgAPIError as err:
             self.send_message(user_id, "❌ Cannot retrieve your favourites. Please try again later.")
             self.handle_api_error(err, user_id)
+        except CircuitOpenError:
+            self.send_message(user_id, "❌ TooGoodToGo is not answering right now. Please try again in a few minutes.")
         except Exception as err:
             print(f"Unexpected {err=}, {type(err)=}")
             self.send_message(user_id, "❌ An error happened trying to retrieve your favourites. Please try again.")
@@ -252,6 +919,7 @@ class TooGoodToGo:
     def handle_api_error(self, err, user_id, client=None):
         if len(err.args) == 2:
             status, message = err.args
+            TGTG_API_ERRORS.inc(status)
 
             if status in [401, 403]:
                 print(f"API Unauthorized [{status}]: {message}")
@@ -265,15 +933,19 @@ class TooGoodToGo:
                     user_credentials = self.find_credentials_by_telegramUserID(user_id)
 
                     if user_credentials:
-                        del self.connected_clients[user_id]
+                        self.connected_clients.pop(user_id, None)
                         del self.users_login_data[user_id]
-                        self.save_users_login_data_to_txt()
+                        self.save_users_login_data_to_txt(user_id)
+                        self.subscriber_index.remove(user_id)
                         print("Expired user login data:", user_id)
                         
                         self.send_message(user_id, f"Hello, {user_credentials['telegram_username']}, your session expired, please /login again to continue receiving notifications.")
+            elif status == 429 or status >= 500:
+                print(f"API throttled [{status}], backing off {max(0.0, self.request_budget.backoff_until - time.monotonic()):.0f}s")
             else:
                 print(f"API Error [{status}]: {message}")
         else:
+            TGTG_API_ERRORS.inc('unknown')
             print(f"Unexpected API Error: {err=}")
 
     def __get_tax_percentage(self, item):
@@ -293,8 +965,7 @@ class TooGoodToGo:
         else:
             item_price = self.__get_currency(item['item']['price_including_taxes'])
 
-        item_price_string = format_currency(item_price, item_price_code)
-        return item_price_string
+        return format_price(item_price, item_price_code)
 
     def __get_value(self, item):
         item_price_code = item['item']['item_price']['code']
@@ -305,15 +976,30 @@ class TooGoodToGo:
         else:
             item_price = self.__get_currency(item['item']['value_including_taxes'])
 
-        item_price_string = format_currency(item_price, item_price_code)
-        return item_price_string
+        return format_price(item_price, item_price_code)
 
     def __get_currency(self, price_map):
         currency_decimals = price_map['decimals']
         currency_minor_units = int(price_map['minor_units'])
         return currency_minor_units / (10 ** currency_decimals)
     
-    def format_item(self, item, status = None, user_id = None) -> str:
+    def format_item(self, item, status = None, user_id = None, fingerprint = None) -> str:
+        item_id = item['item']['item_id']
+        if fingerprint is None:
+            fingerprint = item_fingerprint(item)
+
+        render_key = (item_id, fingerprint, status)
+        item_text = self.render_cache.get(render_key)
+        if item_text is None:
+            item_text = self.__render_item(item, status)
+            self.render_cache.put(render_key, item_text)
+
+        if status and user_id:
+            print(f"[{user_id}] {self.format_status(status)} 🥡 {item['items_available']} 🍽  {item['store']['store_name'].strip()} ({item_id})")
+
+        return item_text
+
+    def __render_item(self, item, status = None) -> str:
         store_name = item['store']['store_name'].strip()
         store_name_text = f"🍽 {store_name}"
         store_address_line = f"🧭 {item['store']['store_location']['address']['address_line']}"
@@ -330,66 +1016,334 @@ class TooGoodToGo:
             item_text += '\n' + store_pickup_text
         
         if status:
-            status = self.format_status(status)
-            item_text += '\n' + status
-            if user_id:
-                item_id = item['item']['item_id']
-                print(f"[{user_id}] {status} {store_items_available_text} 🍽  {store_name} ({item_id})")
+            item_text += '\n' + self.format_status(status)
         
         return item_text
 
     def format_status(self, status: str) -> str:
         return TooGoodToGo.ITEM_STATUS[status]
 
-    def get_available_items_per_user(self):
-        """Loop through all users and see if the number of their favorite bags has changed"""
-        while True:
-            changed_items_status = {}
-            available_items_before = len(self.available_items_favorites)
-            
-            for user_id in self.users_login_data:
+    async def get_available_items_per_user(self):
+        """Poll the users as they become due and see if the number of their favorite bags has changed"""
+        while not self.stopping:
+            if self.shard:
+                # the heartbeat may hang on a locked database longer than the leases last
+                self.drop_expired_shards()
+            now = time.time()
+            for user_id in list(self.users_login_data):
+                if user_id not in self.poll_scheduler:
+                    self.poll_scheduler.schedule(user_id, now)
+
+            # TGTG keeps failing, wait for the circuit to half-open instead of failing every user
+            if self.request_budget.is_open():
+                await self.idle(max(1, self.request_budget.open_seconds_left()))
+                continue
+
+            due_users = [user_id for user_id in self.poll_scheduler.pop_due(now) if user_id in self.users_login_data]
+            if due_users:
                 try:
-                    user_settings = self.users_settings_data[user_id]
+                    await self.poll_users(due_users)
+                except Exception as err:
+                    print(f"Unexpected {err=}, {type(err)=}")
+
+                now = time.time()
+                for user_id in due_users:
+                    if user_id in self.users_login_data:
+                        self.poll_scheduler.schedule(user_id, now + self.get_user_interval_seconds(user_id, now))
+                if self.stopping:
+                    break
+
+            # wait until the next user is due, new users are picked up at least every interval_seconds
+            next_due = self.poll_scheduler.next_due()
+            wait_seconds = self.interval_seconds if next_due is None else min(self.interval_seconds, next_due - time.time())
+            await self.idle(max(1, wait_seconds))
+
+    async def poll_users(self, due_users):
+        """Fetch the favorites of the due users and notify the changes"""
+        self.usage_stats.start_cycle()
+        started = time.perf_counter()
+        with POLL_BATCH_SECONDS.time():
+            fetched = await self.__poll_users(due_users)
+        self.usage_stats.end_cycle(time.perf_counter() - started, len(due_users), fetched)
+
+    async def __poll_users(self, due_users):
+        changed_items_status = {}
+        available_items_before = set(self.available_items_favorites)
+        self.evict_stale_item_states()
+
+        self.wake_silenced_users()
+        eligible_users = self.eligible_users
+
+        # each item is downloaded once per batch: only the users needed to cover all followed items are fetched,
+        # the favorites of everyone else are synced every favorites_sync_interval_seconds
+        # the tgtg executor runs the requests in order, after a restart every user is stale and fetched in this order
+        due_users = sorted(eligible_users.intersection(due_users), key=self.get_user_priority)
+        fetchers = self.subscriber_index.select_fetchers(due_users, self.favorites_sync_interval_seconds)
+
+        # favorites are fetched concurrently (bounded by the tgtg executor), each result is processed
+        # without awaiting so changed_items_status and available_items_favorites stay consistent
+        await asyncio.gather(*(self.poll_user(user_id, changed_items_status, eligible_users) for user_id in fetchers))
+        POLL_BATCH_USERS.inc(amount=len(fetchers))
+
+        self.flush_digests()
 
-                    # if any alert is enabled for this user
-                    if not self.is_silenced(user_id) and any(setting == 1 for setting in user_settings.values()):
-                        favourite_items = self.get_favourite_items(user_id)
-
-                        for item in favourite_items:
-                            item_id = item['item']['item_id']
-                            status = changed_items_status.get(item_id)
-
-                            if status is None and item_id in self.available_items_favorites:
-                                old_items_available = int(self.available_items_favorites[item_id]['items_available'])
-                                new_items_available = int(item['items_available'])
-                                if new_items_available == 0 and old_items_available > 0:  # Sold out (x -> 0)
-                                    status = 'sold_out'
-                                elif old_items_available == 0 and new_items_available > 0:  # New Bag available (0 -> x)
-                                    status = 'new_stock'
-                                elif new_items_available < old_items_available:  # Reduced stock available (x -> x-1)
-                                    status = 'stock_reduced'
-                                elif new_items_available > old_items_available:  # Increased stock available (x -> x+1)
-                                    status = 'stock_increased'
-
-                            if status:
-                                changed_items_status[item_id] = status
-
-                                if user_settings[status]:
-                                    item_text = self.format_item(item, status, user_id)
-                                    self.send_message_with_link(user_id, item_text, item_id)
-                            
-                            self.available_items_favorites[item_id] = item
-                except tgtg.exceptions.TgtgAPIError as err:
-                    self.handle_api_error(err, user_id)
-            
+        try:
+            self.stock_history.flush()
+            self.save_item_states(changed_items_status, available_items_before)
+            if self.capture:
+                self.capture.flush()
+        except Exception as err:
+            print(f"Unexpected {err=}, {type(err)=}")
+
+        if self.dispatcher.queue_depth:
+            print('Outbound messages', self.dispatcher.stats())
+
+        return len(fetchers)
+
+    async def poll_user(self, user_id, changed_items_status, eligible_users):
+        try:
+            favourite_items = await self.get_favourite_items(user_id)
+            if favourite_items is not None:
+                self.subscriber_index.sync(user_id, (item['item']['item_id'] for item in favourite_items))
+                self.process_favourite_items(favourite_items, changed_items_status, eligible_users)
+        except tgtg.exceptions.TgtgAPIError as err:
+            self.handle_api_error(err, user_id)
+        except CircuitOpenError:
+            # opened during this batch, the user is polled again at its next interval
+            pass
+        except Exception as err:
+            print(f"[{user_id}] Unexpected {err=}, {type(err)=}")
+
+    async def poll_tiles_forever(self):
+        while not self.stopping:
+            if self.request_budget.is_open():
+                await self.idle(max(1, self.request_budget.open_seconds_left()))
+                continue
             try:
-                if changed_items_status or len(self.available_items_favorites) != available_items_before:
-                    self.save_available_items_favorites_to_txt()
+                await self.poll_tiles()
             except Exception as err:
                 print(f"Unexpected {err=}, {type(err)=}")
-            
-            # wait until next check
-            time.sleep(self.get_interval_seconds())
+            if self.stopping:
+                break
+            await self.idle(self.geo_interval_seconds)
+
+    async def poll_tiles(self):
+        """Query every tile with an eligible location subscriber once, and notify the changes"""
+        tiles = self.geo_index.active_tiles(self.eligible_users)
+        if not tiles:
+            return
+
+        changed_items_status = {}
+        available_items_before = set(self.available_items_favorites)
+        eligible_users = self.eligible_users
+        await asyncio.gather(*(self.poll_tile(tile, subscribers, changed_items_status, eligible_users)
+                               for tile, subscribers in tiles.items()))
+
+        self.flush_digests()
+        self.stock_history.flush()
+        self.save_item_states(changed_items_status, available_items_before)
+
+    async def poll_tile(self, tile, subscribers, changed_items_status, eligible_users):
+        # the query runs with the session of one of the tile subscribers, a connected one if any
+        user_id = min(subscribers, key=lambda user_id: (user_id not in self.connected_clients, user_id))
+        latitude, longitude, radius = self.geo_index.tile_query(tile)
+        try:
+            client = await self.connect(user_id)
+            if not client:
+                return
+            items = []
+            for page in range(1, self.geo_max_pages + 1):
+                page_items = await self.counted_get_items(user_id, client, favorites_only=False,
+                                                          latitude=latitude, longitude=longitude, radius=radius,
+                                                          page_size=self.geo_page_size, page=page)
+                items += page_items
+                if len(page_items) < self.geo_page_size:
+                    break
+            for item in items:
+                self.item_cache.put(item['item']['item_id'], item)
+            self.process_favourite_items(items, changed_items_status, eligible_users)
+        except tgtg.exceptions.TgtgAPIError as err:
+            self.handle_api_error(err, user_id)
+        except CircuitOpenError:
+            pass
+        except Exception as err:
+            print(f"[{user_id}] Unexpected {err=}, {type(err)=}")
+
+    def get_user_interval_seconds(self, user_id, now=None):
+        """Seconds until the next poll of a user: the shortest interval of their favorites, the low hours interval at night"""
+        interval_seconds = self.get_interval_seconds()
+        if interval_seconds != self.interval_seconds:
+            return interval_seconds
+
+        favourites = self.subscriber_index.favourites(user_id)
+        if not favourites:
+            return self.interval_seconds
+
+        now = now if now is not None else time.time()
+        return min(self.get_item_interval_seconds(item_id, now) for item_id in favourites)
+
+    def get_item_interval_seconds(self, item_id, now):
+        """Hot around the expected restock window, cold the rest of the day, the default without a known restock time"""
+        restock_window = self.predict_restock_window(item_id)
+        if restock_window is None:
+            return self.interval_seconds
+
+        start, end = restock_window
+        now_time = datetime.fromtimestamp(now, self.timezone)
+        now_minute = now_time.hour * 60 + now_time.minute
+        hot_minutes = (end - start) % (24 * 60) + 2 * self.hot_window_minutes
+        if hot_minutes >= 24 * 60 or (now_minute - start + self.hot_window_minutes) % (24 * 60) <= hot_minutes:
+            return self.hot_interval_seconds
+        return self.cold_interval_seconds
+
+    def predict_restock_window(self, item_id):
+        """(start, end) minutes of the day (configured timezone) the item is usually restocked, None if unknown"""
+        restock_window = self.restock_model.predict(item_id)
+        if restock_window is not None:
+            return restock_window
+
+        # not enough history yet, fall back to the time of the last restock
+        item_state = self.available_items_favorites.get(item_id)
+        if item_state is None or not item_state.last_restock:
+            return None
+        last_restock = datetime.fromtimestamp(item_state.last_restock, self.timezone)
+        restock_minute = last_restock.hour * 60 + last_restock.minute
+        return restock_minute, restock_minute
+
+    def format_restock_hint(self, item_id):
+        restock_window = self.restock_model.predict(item_id)
+        if restock_window is None:
+            return None
+        start, end = restock_window
+        return f"📈 Usually available from {start // 60:02d}:{start % 60:02d} to {end // 60:02d}:{end % 60:02d}"
+
+    def process_favourite_items(self, favourite_items, changed_items_status, eligible_users):
+        """Compare fetched items with the last known state and notify the changes to every subscriber, by favorite or location"""
+        for item in favourite_items:
+            item_id = item['item']['item_id']
+
+            # already handled this cycle through another subscriber
+            if item_id in changed_items_status:
+                continue
+
+            status = None
+            item_state = self.available_items_favorites.get(item_id)
+            if item_state is not None:
+                old_items_available = item_state.items_available
+                status = self.get_item_status(old_items_available, int(item['items_available']))
+                item_state.update(item)
+                if status:
+                    self.stock_history.append(item_id, old_items_available, item_state.items_available, status, item_state.last_seen)
+                if status == 'new_stock':
+                    item_state.last_restock = item_state.last_seen
+                    self.restock_model.add(item_id, item_state.last_seen)
+            else:
+                self.available_items_favorites[item_id] = ItemState.from_item(item)
+
+            changed_items_status[item_id] = status
+
+            if status:
+                fan_out_started = time.perf_counter()
+                subscribers = self.subscriber_index.subscribers(item_id)
+                if self.geo_index.tiles:
+                    subscribers = subscribers | self.geo_index.matches(item)
+                for user_id in subscribers & eligible_users:
+                    user_settings = self.users_settings_data[user_id]
+                    if user_settings[status]:
+                        item_text = self.format_item(item, status, user_id, self.available_items_favorites[item_id].fingerprint)
+                        NOTIFICATIONS.inc(status)
+                        self.usage_stats.record_notification(user_id)
+                        if user_settings.get('digest'):
+                            self.add_to_digest(user_id, item, item_text, status)
+                        else:
+                            priority = PRIORITY_HIGH if status == 'new_stock' else PRIORITY_NORMAL
+                            self.send_message_with_link(user_id, item_text, item_id, priority)
+                self.usage_stats.record_item(item_id, time.perf_counter() - fan_out_started)
+
+    def is_admin(self, user_id):
+        return str(user_id) in self.admin_ids
+
+    def format_stats(self, top=5):
+        """/stats: batch timings, TGTG cost per user and fan-out time per item over the last stats_cycles batches"""
+        cycles = self.usage_stats.finished_cycles()
+        durations = [cycle['duration'] for cycle in cycles]
+        lines = [f"📊 Last {len(cycles)} poll batches"]
+        if cycles:
+            last = cycles[-1]
+            lines.append(f"⏱ avg {sum(durations) / len(durations):.2f}s, max {max(durations):.2f}s, "
+                         f"last {last['duration']:.2f}s ({last['fetched']} fetched / {last['due']} due)")
+        lines.append(f"👥 {len(self.users_login_data)} users, {len(self.eligible_users)} eligible, "
+                     f"{len(self.connected_clients)} connected, {len(self.geo_index)} by location")
+        lines.append(f"📨 {self.dispatcher.queue_depth} queued, TGTG budget {self.request_budget.rate:.1f}/s"
+                     + (", circuit open" if self.request_budget.is_open() else ""))
+
+        users = self.usage_stats.user_totals()
+        if users:
+            calls = sum(usage[CALLS] for usage in users.values())
+            size = sum(usage[BYTES] for usage in users.values())
+            notifications = sum(usage[USER_NOTIFICATIONS] for usage in users.values())
+            lines.append(f"🌐 {calls} TGTG calls, {size / 1024:.0f} KiB, {notifications} notifications")
+            lines.append("")
+            lines.append("🐢 Slowest users (calls, KiB, avg s, notifications)")
+            for user_id, usage in sorted(users.items(), key=lambda entry: entry[1][SECONDS], reverse=True)[:top]:
+                lines.append(f"{user_id}: {usage[CALLS]}, {usage[BYTES] / 1024:.0f}, "
+                             f"{usage[SECONDS] / max(1, usage[CALLS]):.2f}, {usage[USER_NOTIFICATIONS]}")
+
+        items = self.usage_stats.item_totals()
+        if items:
+            lines.append("")
+            lines.append("🐢 Slowest items to notify (changes, ms)")
+            for item_id, (count, seconds) in sorted(items.items(), key=lambda entry: entry[1][1], reverse=True)[:top]:
+                lines.append(f"{item_id}: {count}, {seconds * 1000:.1f}")
+        return "\n".join(lines)
+
+    def add_to_digest(self, user_id, item, item_text, status):
+        digest = self.digests.setdefault(user_id, {'created_at': time.time(), 'entries': []})
+        digest['entries'].append((item['item']['item_id'], item['store']['store_name'].strip(), item_text, status))
+
+    def flush_digests(self, force=False):
+        """Send the digests whose coalescing window is over, new stock is never held back longer than a cycle"""
+        now = time.time()
+        for user_id, digest in list(self.digests.items()):
+            if (force or now - digest['created_at'] >= self.digest_window_seconds
+                    or any(status == 'new_stock' for _, _, _, status in digest['entries'])):
+                del self.digests[user_id]
+                self.send_digest(user_id, digest['entries'])
+
+    def has_alerts_enabled(self, user_id):
+        user_settings = self.users_settings_data[user_id]
+        return any(user_settings.get(status) == 1 for status in TooGoodToGo.ITEM_STATUS)
+
+    def save_item_states(self, changed_items_status, available_items_before):
+        """Write the rows of new, changed or evicted items, and of those whose stored last_seen is over an hour old"""
+        changed_item_ids = [item_id for item_id, status in changed_items_status.items()
+                            if status or item_id not in available_items_before]
+        changed_item_ids += [item_id for item_id in available_items_before
+                             if item_id not in self.available_items_favorites]
+        changed_item_ids += [item_id for item_id, state in self.available_items_favorites.items()
+                             if item_id in available_items_before and state.last_seen - state.stored_last_seen >= 3600]
+        if changed_item_ids:
+            self.save_available_items_favorites_to_txt(*changed_item_ids)
+
+    def evict_stale_item_states(self):
+        """Forget the items nobody has fetched for item_state_ttl_hours"""
+        expiry = time.time() - self.item_state_ttl_hours * 3600
+        for item_id, state in list(self.available_items_favorites.items()):
+            if state.last_seen < expiry:
+                del self.available_items_favorites[item_id]
+                self.item_cache.discard(item_id)
+
+    @staticmethod
+    def get_item_status(old_items_available: int, new_items_available: int):
+        if new_items_available == 0 and old_items_available > 0:  # Sold out (x -> 0)
+            return 'sold_out'
+        elif old_items_available == 0 and new_items_available > 0:  # New Bag available (0 -> x)
+            return 'new_stock'
+        elif new_items_available < old_items_available:  # Reduced stock available (x -> x-1)
+            return 'stock_reduced'
+        elif new_items_available > old_items_available:  # Increased stock available (x -> x+1)
+            return 'stock_increased'
+        return None
     
     def get_interval_seconds(self):
         low_hours = False
@@ -414,55 +1368,66 @@ class TooGoodToGo:
         return self.interval_seconds
     
     def __format_datetime(self, datetime_str: str) -> str:
-        return (datetime.strptime(datetime_str, '%Y-%m-%dT%H:%M:%SZ')
-                .replace(tzinfo=utc)
-                .astimezone(self.timezone)
-                .strftime(self.date_format))
+        return format_pickup_datetime(datetime_str, self.timezone, self.date_format)
 
     def silence_for_user(self, chat_id, secs=0, minutes=0, hours=0, days=0):
         now = datetime.now()
         exp = now + timedelta(seconds=secs, minutes=minutes, hours=hours, days=days)
 
         self.users_settings_data[chat_id]['silence_exp'] = exp.isoformat()
-        self.save_users_settings_data_to_txt()
+        self.save_users_settings_data_to_txt(chat_id)
 
 
     def is_silenced(self, chat_id):
-        silence_exp_string = self.users_settings_data[chat_id].get('silence_exp')
-        if silence_exp_string is None:
-            return False
-        silence_exp = datetime.fromisoformat(silence_exp_string)
-        if silence_exp < datetime.now():
-            print(f"{chat_id} Silence has expired. Exp: {silence_exp_string}")
-            del self.users_settings_data[chat_id]['silence_exp']
-            self.save_users_settings_data_to_txt()
-            return False
-        return True
-
-
-def data_file(data_file_name: str, data_folder='data', extension='json') -> Path:
-    data_path = Path(f'{data_folder}/{data_file_name}.{extension}')
-    if not data_path.exists():
-        data_path.parent.mkdir(exist_ok=True, parents=True)
-        data_path.write_text('{}')
-        print(f'Created {data_path}')
-    return data_path
-
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.astimezone(utc).isoformat()
-        return super().default(obj)
-
-class DateTimeDecoder(json.JSONDecoder):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, object_hook=self.object_hook, **kwargs)
-
-    def object_hook(self, obj):
-        for key, value in obj.items():
-            if key == 'last_time_token_refreshed':
-                obj[key] = datetime.fromisoformat(value) \
-                    .astimezone().replace(tzinfo=None)
-                    # tgtg model login uses local timezone naive datetime.now() to compare refresh token time
-                    # tgtg/__init__.py", line 121, in _refresh_token
-        return obj
+        return chat_id in self.silence_scheduler
+
+    def update_eligible_users(self, *user_ids):
+        """Recompute whether the users (all of them when none given) can receive alerts"""
+        if not user_ids:
+            self.eligible_users.clear()
+            self.silence_scheduler = PollScheduler()
+            user_ids = list(self.users_login_data)
+
+        now = time.time()
+        for user_id in user_ids:
+            self.eligible_users.discard(user_id)
+            self.silence_scheduler.remove(user_id)
+            user_settings = self.users_settings_data.get(user_id)
+            if user_id not in self.users_login_data or not user_settings:
+                continue
+
+            silence_exp_string = user_settings.get('silence_exp')
+            if silence_exp_string is not None:
+                silence_exp = datetime.fromisoformat(silence_exp_string).timestamp()
+                if silence_exp > now:
+                    self.silence_scheduler.schedule(user_id, silence_exp)
+                    continue
+
+            if self.has_alerts_enabled(user_id):
+                self.eligible_users.add(user_id)
+
+    def wake_silenced_users(self):
+        """Make the users whose silence is over eligible again"""
+        woken_user_ids = self.silence_scheduler.pop_due(time.time(), slack=0)
+        for user_id in woken_user_ids:
+            print(f"{user_id} Silence has expired")
+            # the settings are written by the front process, a worker's copy may be stale
+            if self.shard is None:
+                self.users_settings_data[user_id].pop('silence_exp', None)
+        if woken_user_ids and self.shard is None:
+            self.save_users_settings_data_to_txt(*woken_user_ids)
+        elif woken_user_ids:
+            self.update_eligible_users(*woken_user_ids)
+
+
+# pickup times and prices repeat across items and cycles, resolving them once saves the strptime and babel lookups
+@lru_cache(maxsize=4096)
+def format_pickup_datetime(datetime_str: str, tz, date_format: str) -> str:
+    return (datetime.strptime(datetime_str, '%Y-%m-%dT%H:%M:%SZ')
+            .replace(tzinfo=utc)
+            .astimezone(tz)
+            .strftime(date_format))
+
+@lru_cache(maxsize=4096)
+def format_price(amount: float, currency: str) -> str:
+    return format_currency(amount, currency)
@@ -0,0 +1,73 @@
+import time
+from collections import deque
+
+# per user: TGTG calls, response bytes, seconds waiting for TGTG, notifications
+CALLS, BYTES, SECONDS, NOTIFICATIONS = range(4)
+
+
+class UsageStats:
+    """TGTG cost and notifications per user, fan-out time per item and batch timings over the last poll batches"""
+
+    def __init__(self, cycles=10):
+        self.cycles = deque(maxlen=cycles)
+
+    def resize(self, cycles):
+        self.cycles = deque(self.cycles, maxlen=cycles)
+
+    @property
+    def current(self):
+        if not self.cycles:
+            self.start_cycle()
+        return self.cycles[-1]
+
+    def start_cycle(self):
+        self.cycles.append({'started_at': time.time(), 'duration': None, 'due': 0, 'fetched': 0, 'users': {}, 'items': {}})
+
+    def end_cycle(self, duration, due, fetched):
+        cycle = self.current
+        cycle['duration'] = duration
+        cycle['due'] = due
+        cycle['fetched'] = fetched
+
+    def user(self, user_id):
+        usage = self.current['users'].get(user_id)
+        if usage is None:
+            usage = self.current['users'][user_id] = [0, 0, 0.0, 0]
+        return usage
+
+    def record_call(self, user_id, seconds, size):
+        usage = self.user(user_id)
+        usage[CALLS] += 1
+        usage[BYTES] += size
+        usage[SECONDS] += seconds
+
+    def record_notification(self, user_id):
+        self.user(user_id)[NOTIFICATIONS] += 1
+
+    def record_item(self, item_id, seconds):
+        usage = self.current['items'].get(item_id)
+        if usage is None:
+            usage = self.current['items'][item_id] = [0, 0.0]
+        usage[0] += 1
+        usage[1] += seconds
+
+    def user_totals(self) -> dict:
+        totals = {}
+        for cycle in self.cycles:
+            for user_id, usage in cycle['users'].items():
+                total = totals.setdefault(user_id, [0, 0, 0.0, 0])
+                for index, value in enumerate(usage):
+                    total[index] += value
+        return totals
+
+    def item_totals(self) -> dict:
+        totals = {}
+        for cycle in self.cycles:
+            for item_id, (count, seconds) in cycle['items'].items():
+                total = totals.setdefault(item_id, [0, 0.0])
+                total[0] += count
+                total[1] += seconds
+        return totals
+
+    def finished_cycles(self) -> list:
+        return [cycle for cycle in self.cycles if cycle['duration'] is not None]
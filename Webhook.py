@@ -0,0 +1,77 @@
+import hmac
+import asyncio
+import secrets
+
+from aiohttp import web
+from telebot import types
+
+
+class WebhookServer:
+    """
+    Receives the bot updates from Telegram on an aiohttp server instead of long polling getUpdates.
+    Telegram sends the secret token set with the webhook in every request, others are refused.
+    Updates are answered right away and handled as tasks, at most max_concurrent_updates at once.
+    """
+
+    def __init__(self, bot, url: str, host='0.0.0.0', port=8443, path='/telegram', secret_token=None,
+                 max_concurrent_updates=32):
+        self.bot = bot
+        self.url = url.rstrip('/') + path
+        self.host = host
+        self.port = port
+        self.path = path
+        # a new one every start when not configured, Telegram gets it with setWebhook
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+        self.max_concurrent_updates = max_concurrent_updates
+        self.semaphore = None
+        self.tasks = set()
+        self.runner = None
+
+    async def handle(self, request):
+        # compared as bytes, compare_digest refuses str with non-ASCII characters
+        secret_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode()
+        if not hmac.compare_digest(secret_token, self.secret_token.encode()):
+            return web.Response(status=403)
+
+        # not json, or json that is not an update
+        try:
+            update = types.Update.de_json(await request.json())
+        except Exception:
+            return web.Response(status=400)
+
+        task = asyncio.create_task(self.process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def process(self, update):
+        async with self.semaphore:
+            try:
+                await self.bot.process_new_updates([update])
+            except Exception as err:
+                print(f"Unexpected {err=}, {type(err)=}")
+
+    async def start(self):
+        """Listen and register the webhook, raises if either fails so the caller can fall back to polling"""
+        self.semaphore = asyncio.Semaphore(self.max_concurrent_updates)
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, self.host, self.port).start()
+            # Telegram accepts 1 to 100 connections
+            await self.bot.set_webhook(url=self.url, secret_token=self.secret_token,
+                                       max_connections=min(100, max(1, self.max_concurrent_updates)))
+        except Exception:
+            await self.stop()
+            raise
+        print(f'Webhook {self.url} on {self.host}:{self.port}')
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,48 @@
+import sys
+import signal
+import asyncio
+import configparser
+
+from telebot.async_telebot import AsyncTeleBot
+
+from TooGoodToGo import TooGoodToGo
+from ConfigReloader import ConfigReloader
+
+
+def run_worker(number: int):
+    """Poll the users of the shards held by this worker and send their alerts, commands are left to the front process"""
+    config = configparser.ConfigParser(interpolation=None)
+    config.read('config.ini')
+    bot = AsyncTeleBot(config['Telegram']['token'])
+    tooGoodToGo = TooGoodToGo(bot, config['Configuration'], worker_number=number)
+
+    async def main():
+        stopping = asyncio.Event()
+        try:
+            # terminated by the front process, give the shards back before exiting
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+        except NotImplementedError:
+            pass
+
+        # SIGHUP is passed on by the front process, the file watch covers workers on other hosts
+        config_reloader = ConfigReloader('config.ini', 'Configuration', tooGoodToGo.reload_config,
+                                         tooGoodToGo.config_reload_seconds)
+        try:
+            await tooGoodToGo.start()
+            config_reloader.start()
+            await stopping.wait()
+        finally:
+            await config_reloader.stop()
+            await tooGoodToGo.stop()
+            await bot.close_session()
+
+    print(f'TooGoodToGo worker {number} started')
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print(f'Worker {number} shutting down')
+
+
+# Started by Telegram.py for the local workers, run `python3 Worker.py <number>` on other hosts sharing the data folder
+if __name__ == '__main__':
+    run_worker(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
@@ -0,0 +1,93 @@
+import sys
+import asyncio
+from pathlib import Path
+from datetime import datetime
+
+import pytest
+
+# the bot modules live flat in the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from TooGoodToGo import TooGoodToGo
+
+
+def make_item(item_id, items_available=1, store_name='Bakery', latitude=52.37, longitude=4.89,
+              category='BAKED_GOODS', minor_units=399):
+    """An item of the TGTG responses, with the fields the bot reads"""
+    price = {'code': 'EUR', 'minor_units': minor_units, 'decimals': 2}
+    return {
+        'item': {'item_id': item_id, 'item_price': price, 'price_including_taxes': price,
+                 'value_including_taxes': {'code': 'EUR', 'minor_units': minor_units * 3, 'decimals': 2},
+                 'taxation_policy': 'PRICE_INCLUDES_TAXES', 'item_category': category},
+        'store': {'store_name': f'{store_name} ',
+                  'store_location': {'address': {'address_line': 'Main street 1'},
+                                     'location': {'latitude': latitude, 'longitude': longitude}}},
+        'items_available': items_available,
+        'pickup_interval': {'start': '2024-01-01T17:00:00Z', 'end': '2024-01-01T18:00:00Z'},
+    }
+
+
+class FakeClient:
+    """Answers get_items with the items the test gave TGTG for its user, or for any location"""
+
+    def __init__(self, poller, user_id):
+        self.poller = poller
+        self.user_id = user_id
+        self.response_bytes = 0
+        self.last_elapsed = 0.0
+
+    async def get_items(self, favorites_only=True, **kwargs):
+        self.poller.fetched.append(self.user_id)
+        if favorites_only:
+            return [self.poller.items[item_id] for item_id in self.poller.favourites.get(self.user_id, [])]
+        return list(self.poller.items.values())
+
+
+class Poller:
+    """TooGoodToGo with TGTG and Telegram replaced: items and favourites are what TGTG answers, sent what would be sent"""
+
+    def __init__(self, bot: TooGoodToGo):
+        self.bot = bot
+        self.items = {}
+        self.favourites = {}
+        self.fetched = []
+        self.sent = []
+
+        async def connect(user_id):
+            return FakeClient(self, user_id)
+
+        bot.connect = connect
+        bot.dispatcher.enqueue = lambda chat_id, priority=None, **kwargs: self.sent.append((chat_id, kwargs['text']))
+
+    def add_user(self, user_id, item_ids, **settings):
+        self.favourites[user_id] = list(item_ids)
+        self.bot.users_login_data[user_id] = {'telegram_username': user_id, 'last_time_token_refreshed': datetime.now()}
+        self.bot.users_settings_data[user_id] = {status: 1 for status in TooGoodToGo.ITEM_STATUS} | {'digest': 0}
+        self.bot.users_settings_data[user_id].update(settings)
+        self.bot.update_eligible_users(user_id)
+
+    def set_stock(self, item_id, items_available, **kwargs):
+        """Add an item, or change the stock of one keeping its other fields"""
+        if item_id in self.items and not kwargs:
+            self.items[item_id] = dict(self.items[item_id], items_available=items_available)
+        else:
+            self.items[item_id] = make_item(item_id, items_available, **kwargs)
+
+    def poll(self, *user_ids):
+        """Run one poll batch of the users, all of them when none given, and return what it sent"""
+        self.fetched = []
+        self.sent = []
+        asyncio.run(self.bot.poll_users(list(user_ids or self.bot.users_login_data)))
+        return self.sent
+
+
+@pytest.fixture
+def poller(tmp_path, monkeypatch):
+    # the data folder is created in the working directory
+    monkeypatch.chdir(tmp_path)
+    bot = TooGoodToGo(None, {})
+    yield Poller(bot)
+    TooGoodToGo.connected_clients.clear()
+    bot.stock_history.close()
+    bot.storage.close()
+    bot.tgtg_executor.shutdown()
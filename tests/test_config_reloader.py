@@ -0,0 +1,110 @@
+import os
+import signal
+import asyncio
+
+import pytest
+
+from ConfigReloader import ConfigReloader
+
+
+def write_config(path, interval_seconds):
+    path.write_text(f"[Telegram]\ntoken = x\n\n[Configuration]\ninterval_seconds = {interval_seconds}\n")
+    # a new mtime even within the file system time resolution
+    modified_at = os.stat(path).st_mtime_ns
+    os.utime(path, ns=(modified_at + 10 ** 9, modified_at + 10 ** 9))
+
+
+def test_reload_applies_the_section(tmp_path):
+    path = tmp_path / 'config.ini'
+    write_config(path, 60)
+    applied = []
+
+    ConfigReloader(str(path), 'Configuration', lambda section: applied.append(dict(section))).reload()
+
+    assert applied == [{'interval_seconds': '60'}]
+
+
+def test_unreadable_or_rejected_configs_keep_the_running_values(tmp_path):
+    applied = []
+    ConfigReloader(str(tmp_path / 'missing.ini'), 'Configuration', applied.append).reload()
+    assert applied == []
+
+    path = tmp_path / 'config.ini'
+    write_config(path, 'often')
+
+    def apply(section):
+        int(section['interval_seconds'])
+
+    # reported, not raised
+    ConfigReloader(str(path), 'Configuration', apply).reload()
+
+
+def test_file_changes_are_picked_up(tmp_path):
+    path = tmp_path / 'config.ini'
+    write_config(path, 60)
+    applied = []
+
+    async def main():
+        reloader = ConfigReloader(str(path), 'Configuration', lambda section: applied.append(section['interval_seconds']),
+                                  check_seconds=0.01)
+        reloader.start()
+        await asyncio.sleep(0.05)
+        write_config(path, 30)
+        await asyncio.sleep(0.05)
+        await reloader.stop()
+        return reloader
+
+    reloader = asyncio.run(main())
+    assert applied == ['30']
+    assert reloader.watcher is None
+
+
+class Process:
+    def __init__(self, running=True):
+        self.running = running
+        self.signals = []
+
+    def poll(self):
+        return None if self.running else 0
+
+    def send_signal(self, number):
+        self.signals.append(number)
+
+
+def test_sighup_reloads_and_is_passed_on_to_the_live_children(tmp_path):
+    path = tmp_path / 'config.ini'
+    write_config(path, 60)
+    applied = []
+    live, dead = Process(), Process(running=False)
+
+    async def main():
+        reloader = ConfigReloader(str(path), 'Configuration', lambda section: applied.append(section['interval_seconds']),
+                                  check_seconds=0, forward_to=[live, dead])
+        reloader.start()
+        os.kill(os.getpid(), signal.SIGHUP)
+        await asyncio.sleep(0.05)
+        await reloader.stop()
+
+    asyncio.run(main())
+    assert applied == ['60']
+    assert live.signals == [signal.SIGHUP] and dead.signals == []
+
+
+def test_reload_config_applies_the_live_settings_only(poller):
+    bot = poller.bot
+
+    bot.reload_config({'interval_seconds': '120', 'telegram_messages_per_second': '10', 'storage': 'json'})
+
+    assert bot.interval_seconds == 120
+    assert bot.dispatcher.global_bucket.rate == 10
+    assert bot.storage_backend == 'sqlite'
+
+
+def test_reload_config_keeps_the_running_values_on_errors(poller):
+    bot = poller.bot
+    interval_seconds = bot.interval_seconds
+
+    with pytest.raises(Exception):
+        bot.reload_config({'interval_seconds': '120', 'timezone': 'Nowhere/Nowhere'})
+
+    assert bot.interval_seconds == interval_seconds
@@ -0,0 +1,65 @@
+def test_changes_of_a_batch_are_sent_as_one_digest(poller):
+    for item_id in ('a', 'b', 'c'):
+        poller.set_stock(item_id, 1, store_name=f'Store {item_id}')
+    poller.add_user('digest', ['a', 'b', 'c'], digest=1)
+    poller.add_user('single', ['a', 'b', 'c'])
+    poller.poll()
+
+    poller.set_stock('a', 0)
+    poller.set_stock('b', 2)
+    sent = poller.poll()
+
+    digests = [text for chat_id, text in sent if chat_id == 'digest']
+    assert len(digests) == 1
+    assert 'Store a' in digests[0] and 'Store b' in digests[0] and 'Store c' not in digests[0]
+    assert len([chat_id for chat_id, _ in sent if chat_id == 'single']) == 2
+
+
+def test_digest_window_holds_changes_but_not_new_stock(poller):
+    poller.bot.digest_window_seconds = 600
+    poller.set_stock('a', 2)
+    poller.set_stock('b', 0)
+    poller.add_user('u1', ['a', 'b'], digest=1)
+    poller.poll()
+
+    poller.set_stock('a', 1)
+    assert poller.poll() == []
+
+    # new stock flushes the digest, with the change held so far
+    poller.set_stock('b', 1)
+    sent = poller.poll()
+    assert len(sent) == 1
+    assert 'Stock reduced' in sent[0][1] and 'New stock' in sent[0][1]
+
+
+def test_held_digests_are_sent_once_the_window_is_over_or_on_stop(poller):
+    poller.bot.digest_window_seconds = 600
+    poller.set_stock('a', 2)
+    poller.add_user('u1', ['a'], digest=1)
+    poller.add_user('u2', ['a'], digest=1)
+    poller.poll()
+    poller.set_stock('a', 1)
+    poller.poll()
+
+    poller.bot.digests['u1']['created_at'] -= 600
+    poller.bot.flush_digests()
+    assert [chat_id for chat_id, _ in poller.sent] == ['u1']
+
+    poller.bot.flush_digests(force=True)
+    assert [chat_id for chat_id, _ in poller.sent] == ['u1', 'u2']
+    assert poller.bot.digests == {}
+
+
+def test_long_digests_are_split(poller):
+    item_ids = [str(number) for number in range(20)]
+    for item_id in item_ids:
+        poller.set_stock(item_id, 1)
+    poller.add_user('u1', item_ids, digest=1)
+    poller.poll()
+
+    for item_id in item_ids:
+        poller.set_stock(item_id, 0)
+    sent = poller.poll()
+
+    assert len(sent) == 3
+    assert sum(text.count('Sold out') for _, text in sent) == 20
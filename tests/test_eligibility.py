@@ -0,0 +1,52 @@
+import time
+
+
+def test_users_without_alerts_or_logins_are_not_eligible(poller):
+    poller.add_user('u1', [])
+    poller.add_user('u2', [])
+    assert poller.bot.eligible_users == {'u1', 'u2'}
+
+    for status in ('sold_out', 'new_stock', 'stock_reduced', 'stock_increased'):
+        poller.bot.users_settings_data['u1'][status] = 0
+    poller.bot.save_users_settings_data_to_txt('u1')
+    del poller.bot.users_login_data['u2']
+    poller.bot.update_eligible_users('u2')
+
+    assert poller.bot.eligible_users == set()
+
+
+def test_silenced_users_wake_up_once_the_silence_is_over(poller):
+    poller.set_stock('a', 1)
+    poller.add_user('u1', ['a'])
+    poller.add_user('u2', ['a'])
+    poller.poll()
+
+    poller.bot.silence_for_user('u1', secs=0.2)
+    poller.bot.silence_for_user('u2', hours=1)
+    assert poller.bot.is_silenced('u1') and poller.bot.is_silenced('u2')
+    assert poller.bot.eligible_users == set()
+
+    # nobody to alert, nobody is fetched
+    poller.set_stock('a', 0)
+    assert poller.poll() == []
+    assert poller.fetched == []
+
+    time.sleep(0.25)
+    assert [chat_id for chat_id, _ in poller.poll()] == ['u1']
+    assert poller.bot.eligible_users == {'u1'}
+    # the end of the silence is saved, it does not come back on a restart
+    assert 'silence_exp' not in poller.bot.storage.read('users_settings_data', ['u1'])['u1']
+    assert 'silence_exp' in poller.bot.storage.read('users_settings_data', ['u2'])['u2']
+
+
+def test_full_recompute_matches_the_incremental_updates(poller):
+    for number in range(10):
+        poller.add_user(f'u{number}', [], sold_out=number % 2)
+    poller.bot.silence_for_user('u3', hours=1)
+    poller.bot.silence_for_user('u4', hours=1)
+    incremental = set(poller.bot.eligible_users)
+
+    poller.bot.update_eligible_users()
+
+    assert poller.bot.eligible_users == incremental
+    assert incremental == {f'u{number}' for number in range(10) if number not in (3, 4)}
@@ -0,0 +1,104 @@
+import math
+import asyncio
+
+import pytest
+
+from GeoIndex import GeoIndex, KM_PER_DEGREE, distance_km, parse_category
+from conftest import make_item
+
+
+def test_tiles_of_a_circle_cover_it():
+    index = GeoIndex(tile_km=5)
+    tiles = set(index.tiles_of(52.37, 4.89, 6))
+
+    # points 5.9 km away all around the center
+    for angle in range(0, 360, 15):
+        latitude = 52.37 + 5.9 / KM_PER_DEGREE * math.sin(math.radians(angle))
+        longitude = 4.89 + 5.9 / (KM_PER_DEGREE * math.cos(math.radians(52.37))) * math.cos(math.radians(angle))
+        assert distance_km(52.37, 4.89, latitude, longitude) <= 6
+        assert index.tile_of(latitude, longitude) in tiles
+    assert len(tiles) <= 16
+
+
+def test_tile_query_circle_holds_the_tile():
+    index = GeoIndex(tile_km=5)
+    tile = index.tile_of(60.17, 24.94)
+    latitude, longitude, radius = index.tile_query(tile)
+
+    assert index.tile_of(latitude, longitude) == tile
+    for row_offset in (0, 0.999):
+        for column_offset in (0, 0.999):
+            corner_latitude = (tile[0] + row_offset) * index.latitude_step
+            corner_longitude = (tile[1] + column_offset) * index.longitude_step(tile[0])
+            assert distance_km(latitude, longitude, corner_latitude, corner_longitude) <= radius
+
+
+def test_unsubscribe_drops_the_empty_tiles():
+    index = GeoIndex()
+    index.subscribe('u1', {'latitude': 52.37, 'longitude': 4.89, 'radius_km': 3})
+    index.subscribe('u2', {'latitude': 52.37, 'longitude': 4.89, 'radius_km': 3})
+    index.subscribe('u1', {'latitude': 48.85, 'longitude': 2.35, 'radius_km': 3})
+
+    assert index.active_tiles({'u1'}).keys().isdisjoint(index.active_tiles({'u2'}).keys())
+
+    index.unsubscribe('u1')
+    index.unsubscribe('u2')
+    assert index.tiles == {} and len(index) == 0
+
+
+def test_items_match_the_radius_price_and_category():
+    index = GeoIndex()
+    index.subscribe('any', {'latitude': 52.37, 'longitude': 4.89, 'radius_km': 3})
+    index.subscribe('cheap', {'latitude': 52.37, 'longitude': 4.89, 'radius_km': 3, 'max_price': 3.5})
+    index.subscribe('meals', {'latitude': 52.37, 'longitude': 4.89, 'radius_km': 3, 'category': 'MEAL'})
+    index.subscribe('far', {'latitude': 52.09, 'longitude': 5.12, 'radius_km': 3})
+
+    assert index.matches(make_item('1', category='MEAL', minor_units=300)) == {'any', 'cheap', 'meals'}
+    assert index.matches(make_item('2', minor_units=500)) == {'any'}
+    assert index.matches(make_item('3', latitude=52.39, longitude=4.89, minor_units=300)) == {'any', 'cheap'}
+    assert index.matches(make_item('4', latitude=52.50, longitude=4.89)) == set()
+
+
+def test_categories():
+    assert parse_category('meals') == 'MEAL'
+    assert parse_category('Bakery') == 'BAKED_GOODS'
+    assert parse_category('baked goods') == 'BAKED_GOODS'
+    with pytest.raises(ValueError):
+        parse_category('pizza')
+
+
+def test_one_query_per_tile_alerts_the_location_subscribers(poller):
+    bot = poller.bot
+    poller.set_stock('near', 0)
+    poller.set_stock('far', 0, latitude=48.85, longitude=2.35)
+    poller.add_user('u1', [])
+    poller.add_user('u2', [])
+    poller.add_user('u3', [])
+    bot.subscribe_location('u1', 52.37, 4.89, 2)
+    bot.subscribe_location('u2', 52.37, 4.89, 2, category='bakery')
+    bot.subscribe_location('u3', 52.37, 4.89, 2, category='meals')
+    asyncio.run(bot.poll_tiles())
+    queries = len(poller.fetched)
+    assert queries == len(bot.geo_index.active_tiles(bot.eligible_users))
+
+    poller.set_stock('near', 2)
+    poller.set_stock('far', 2)
+    poller.fetched = []
+    asyncio.run(bot.poll_tiles())
+
+    assert len(poller.fetched) == queries
+    assert sorted(chat_id for chat_id, _ in poller.sent) == ['u1', 'u2']
+    assert bot.item_cache.get('near')['items_available'] == 2
+
+
+def test_location_subscriptions_are_saved(poller):
+    poller.bot.subscribe_location('u1', 52.37, 4.89, 1000, category='groceries')
+    poller.bot.read_geo_subscriptions_from_txt()
+
+    subscription = poller.bot.geo_index.subscriptions['u1']
+    assert subscription['radius_km'] == poller.bot.geo_max_radius_km
+    assert subscription['category'] == 'GROCERIES'
+    with pytest.raises(ValueError):
+        poller.bot.subscribe_location('u1', 52.37, 4.89, category='pizza')
+    with pytest.raises(ValueError):
+        poller.bot.subscribe_location('u1', 95, 4.89)
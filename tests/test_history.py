@@ -0,0 +1,106 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from History import StockHistory, RestockModel, RECORD, item_key
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = StockHistory(tmp_path / 'history', max_file_bytes=RECORD.size * 4, max_files=2)
+    yield history
+    history.close()
+
+
+def at(day, hour, minute=0):
+    return datetime(2024, 1, day, hour, minute, tzinfo=timezone.utc).timestamp()
+
+
+def test_records_round_trip_and_filter(history):
+    history.append('1001', 0, 3, 'new_stock', timestamp=100)
+    history.append('1002', 3, 0, 'sold_out', timestamp=200)
+    history.append('1001', 3, 1, 'stock_reduced', timestamp=300)
+
+    assert list(history.records()) == [(100, 1001, 0, 3, 'new_stock'), (200, 1002, 3, 0, 'sold_out'),
+                                       (300, 1001, 3, 1, 'stock_reduced')]
+    assert [record[0] for record in history.records(since=200, item_id='1001')] == [300]
+
+
+def test_files_rotate_and_the_oldest_are_dropped(history):
+    for timestamp in range(10):
+        history.append('1', 0, 1, 'new_stock', timestamp=timestamp)
+
+    assert len(history.files()) == 2
+    assert [record[0] for record in history.records()] == [4, 5, 6, 7, 8, 9]
+
+
+def test_torn_record_is_dropped_on_open(tmp_path):
+    history = StockHistory(tmp_path)
+    history.append('1', 0, 1, 'new_stock', timestamp=1)
+    history.close()
+    with open(history.files()[-1], 'ab') as file:
+        file.write(b'\x00' * 5)
+
+    history = StockHistory(tmp_path)
+    history.append('1', 1, 0, 'sold_out', timestamp=2)
+    try:
+        assert [record[4] for record in history.records()] == ['new_stock', 'sold_out']
+    finally:
+        history.close()
+
+
+def test_item_keys():
+    assert item_key('123') == 123
+    assert item_key('abc') == item_key('abc') != item_key('abd')
+
+
+def test_restock_window_around_the_usual_time():
+    model = RestockModel(timezone.utc)
+    for day in range(1, 8):
+        model.add('1', at(day, 17, day))
+
+    assert model.predict('1') == (17 * 60, 17 * 60 + 15)
+
+
+def test_restock_window_needs_min_events():
+    model = RestockModel(timezone.utc, min_events=3)
+    model.add('1', at(1, 17))
+    model.add('1', at(2, 17))
+
+    assert model.predict('1') is None
+    assert model.predict('2') is None
+
+
+def test_recent_restocks_weigh_more():
+    model = RestockModel(timezone.utc, half_life_days=1)
+    for day in range(1, 5):
+        model.add('1', at(day, 9))
+    for day in range(10, 13):
+        model.add('1', at(day, 18))
+
+    assert model.predict('1') == (18 * 60, 18 * 60 + 15)
+
+
+def test_no_window_without_a_peak():
+    spread = RestockModel(timezone.utc)
+    every_bucket = RestockModel(timezone.utc)
+    for day in range(1, 8):
+        for hour in range(0, 24, 2):
+            spread.add('1', at(day, hour))
+        for quarter in range(96):
+            every_bucket.add('1', at(day, quarter // 4, quarter % 4 * 15))
+
+    assert spread.predict('1') is None
+    assert every_bucket.predict('1') is None
+
+
+def test_model_loads_the_new_stock_records(history):
+    for day in range(1, 4):
+        history.append('1', 0, 2, 'new_stock', timestamp=at(day, 12))
+        history.append('1', 2, 0, 'sold_out', timestamp=at(day, 13))
+    model = RestockModel(timezone.utc)
+
+    model.load(history, days=100000)
+
+    assert model.events[1] == 3
+    assert model.predict('1') == (12 * 60, 12 * 60 + 15)
@@ -0,0 +1,119 @@
+import asyncio
+
+from telebot import types
+from telebot.asyncio_helper import ApiTelegramException
+
+from MessageQueue import MessageDispatcher, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+
+
+class Bot:
+    def __init__(self, flood_limited=(), delay=0.0):
+        self.sent = []
+        self.flood_limited = set(flood_limited)
+        self.delay = delay
+
+    async def send_message(self, chat_id, **kwargs):
+        await asyncio.sleep(self.delay)
+        if chat_id in self.flood_limited:
+            self.flood_limited.discard(chat_id)
+            raise ApiTelegramException('sendMessage', None, {'error_code': 429, 'description': 'Too Many Requests',
+                                                             'parameters': {'retry_after': 0.05}})
+        self.sent.append((chat_id, kwargs['text']))
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+
+def test_sends_by_priority_then_order():
+    async def main():
+        bot = Bot()
+        dispatcher = MessageDispatcher(bot, messages_per_second=1000, chat_messages_per_second=1000, senders=1)
+        dispatcher.enqueue('a', PRIORITY_LOW, text='a low')
+        dispatcher.enqueue('b', PRIORITY_NORMAL, text='b normal 1')
+        dispatcher.enqueue('c', PRIORITY_NORMAL, text='c normal 2')
+        dispatcher.enqueue('a', PRIORITY_HIGH, text='a high')
+        dispatcher.start()
+        assert await dispatcher.drain(5)
+        await dispatcher.stop()
+        return bot.sent
+
+    assert run(main()) == [('a', 'a high'), ('b', 'b normal 1'), ('c', 'c normal 2'), ('a', 'a low')]
+
+
+def test_rate_limited_chat_does_not_hold_back_the_others():
+    async def main():
+        bot = Bot()
+        dispatcher = MessageDispatcher(bot, messages_per_second=1000, chat_messages_per_second=2, senders=2)
+        for number in range(3):
+            dispatcher.enqueue('busy', PRIORITY_HIGH, text=f'busy {number}')
+        for number in range(20):
+            dispatcher.enqueue(f'chat {number}', PRIORITY_LOW, text='once')
+        dispatcher.start()
+        await asyncio.sleep(0.2)
+        sent = list(bot.sent)
+        await dispatcher.stop()
+        return sent, dispatcher
+
+    sent, dispatcher = run(main())
+    assert sum(1 for chat_id, _ in sent if chat_id == 'busy') == 1
+    assert sum(1 for chat_id, _ in sent if chat_id != 'busy') == 20
+    assert dispatcher.queue_depth == 2
+
+
+def test_flood_limited_message_is_retried():
+    async def main():
+        bot = Bot(flood_limited=['a'])
+        dispatcher = MessageDispatcher(bot, messages_per_second=1000, chat_messages_per_second=1000, senders=1)
+        dispatcher.start()
+        dispatcher.enqueue('a', text='retried')
+        dispatcher.enqueue('b', text='other')
+        assert await dispatcher.drain(5)
+        await dispatcher.stop()
+        return bot.sent, dispatcher
+
+    sent, dispatcher = run(main())
+    assert sent == [('b', 'other'), ('a', 'retried')]
+    assert dispatcher.failed == 0
+
+
+def test_drain_times_out_with_messages_left():
+    async def main():
+        dispatcher = MessageDispatcher(Bot(), messages_per_second=1000, chat_messages_per_second=1, senders=1)
+        dispatcher.start()
+        for number in range(3):
+            dispatcher.enqueue('a', text=str(number))
+        drained = await dispatcher.drain(0.2)
+        await dispatcher.stop()
+        return drained, dispatcher.queue_depth
+
+    assert run(main()) == (False, 2)
+
+
+def test_checkpoint_keeps_cut_off_sends_and_restores_in_order():
+    markup = types.InlineKeyboardMarkup(keyboard=[[types.InlineKeyboardButton(text='Open', url='https://example.com')]])
+
+    async def main():
+        dispatcher = MessageDispatcher(Bot(delay=10), messages_per_second=1000, chat_messages_per_second=1000, senders=1)
+        dispatcher.start()
+        dispatcher.enqueue('a', PRIORITY_NORMAL, text='in flight', reply_markup=markup)
+        await asyncio.sleep(0.05)
+        dispatcher.enqueue('b', PRIORITY_LOW, text='queued')
+        dispatcher.enqueue('c', PRIORITY_HIGH, text='urgent')
+        await dispatcher.stop(timeout=0.05)
+        return dispatcher.checkpoint()
+
+    messages = run(main())
+    assert [message['kwargs']['text'] for message in messages] == ['urgent', 'in flight', 'queued']
+    assert messages[1]['kwargs']['reply_markup'] == markup.to_json()
+
+    async def restore():
+        bot = Bot()
+        dispatcher = MessageDispatcher(bot, messages_per_second=1000, chat_messages_per_second=1000, senders=1)
+        dispatcher.restore(messages)
+        dispatcher.start()
+        assert await dispatcher.drain(5)
+        await dispatcher.stop()
+        return bot.sent
+
+    assert run(restore()) == [('c', 'urgent'), ('a', 'in flight'), ('b', 'queued')]
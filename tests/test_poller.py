@@ -0,0 +1,61 @@
+from TooGoodToGo import TooGoodToGo
+
+
+def test_shared_items_are_fetched_once_and_sent_to_every_subscriber(poller):
+    poller.set_stock('a', 1)
+    poller.set_stock('b', 1)
+    poller.add_user('u1', ['a', 'b'])
+    poller.add_user('u2', ['b'])
+    # first seen items are not alerted, every user is fetched to learn the favorites
+    assert poller.poll() == []
+    assert sorted(poller.fetched) == ['u1', 'u2']
+
+    poller.set_stock('b', 0)
+    sent = poller.poll()
+
+    # u1 covers the favorites of u2
+    assert poller.fetched == ['u1']
+    assert sorted(chat_id for chat_id, _ in sent) == ['u1', 'u2']
+    assert all(text.endswith('Sold out') for _, text in sent)
+
+
+def test_alerts_go_to_the_eligible_subscribers_with_the_status_enabled(poller):
+    poller.set_stock('a', 1)
+    poller.add_user('u1', ['a'])
+    poller.add_user('u2', ['a'], sold_out=0)
+    poller.add_user('u3', ['a'], sold_out=0, new_stock=0, stock_reduced=0, stock_increased=0)
+    poller.poll()
+    assert 'u3' not in poller.bot.eligible_users
+
+    poller.set_stock('a', 0)
+
+    assert [chat_id for chat_id, _ in poller.poll()] == ['u1']
+
+
+def test_stock_changes_are_detected(poller):
+    poller.set_stock('a', 0)
+    poller.add_user('u1', ['a'])
+    poller.poll()
+
+    statuses = []
+    for items_available in (2, 2, 1, 3, 0):
+        poller.set_stock('a', items_available)
+        statuses.append([text.splitlines()[-1] for _, text in poller.poll()])
+
+    assert statuses == [['New stock'], [], ['Stock reduced'], ['Stock increased'], ['Sold out']]
+
+
+def test_item_states_survive_a_restart(poller):
+    poller.set_stock('a', 2)
+    poller.add_user('u1', ['a'])
+    poller.poll()
+    poller.bot.storage.close()
+
+    restarted = TooGoodToGo(None, {})
+    try:
+        assert restarted.available_items_favorites['a'].items_available == 2
+        assert restarted.available_items_favorites['a'].fingerprint == poller.bot.available_items_favorites['a'].fingerprint
+    finally:
+        restarted.stock_history.close()
+        restarted.storage.close()
+        restarted.tgtg_executor.shutdown()
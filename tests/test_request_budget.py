@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+import requests
+from tgtg.exceptions import TgtgAPIError, TgtgLoginError, TgtgPollingError
+
+from AsyncTgtg import AsyncTgtgClient
+from RequestBudget import RequestBudget, CircuitOpenError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('RequestBudget.time.monotonic', clock.monotonic)
+    monkeypatch.setattr('MessageQueue.time.monotonic', clock.monotonic)
+    return clock
+
+
+def make_budget():
+    return RequestBudget(10, breaker_failures=3, breaker_seconds=60, max_breaker_seconds=240)
+
+
+def test_breaker_opens_after_failures_in_a_row(clock):
+    budget = make_budget()
+    budget.record('error')
+    budget.record(503)
+    assert not budget.is_open()
+
+    budget.record(429)
+
+    assert budget.is_open()
+    assert budget.open_seconds_left() == 60
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(budget.acquire())
+
+
+def test_user_errors_do_not_count_as_failures(clock):
+    budget = make_budget()
+    for _ in range(5):
+        budget.record(401)
+
+    assert not budget.is_open()
+    assert budget.failures == 0
+
+
+def test_half_open_probe_success_closes_the_breaker(clock):
+    budget = make_budget()
+    for _ in range(3):
+        budget.record('error')
+    clock.now += 61
+    budget.backoff_until = 0.0
+
+    asyncio.run(budget.acquire())
+    # only the probe goes out until it is answered
+    assert budget.probing and budget.is_open()
+
+    budget.record(200)
+
+    assert not budget.is_open()
+    assert budget.failures == 0 and budget.opened == 0
+
+
+def test_half_open_probe_failure_reopens_for_longer(clock):
+    budget = make_budget()
+    for _ in range(3):
+        budget.record('error')
+    clock.now += 61
+    budget.backoff_until = 0.0
+
+    asyncio.run(budget.acquire())
+    budget.record('error')
+
+    assert budget.is_open()
+    assert budget.open_seconds_left() == 120
+    assert not budget.probing
+
+
+def test_released_probe_lets_the_next_request_probe(clock):
+    budget = make_budget()
+    for _ in range(3):
+        budget.record('error')
+    clock.now += 61
+    budget.backoff_until = 0.0
+
+    asyncio.run(budget.acquire())
+    budget.release()
+
+    assert not budget.is_open()
+    assert budget.open_until
+
+
+def test_rate_halves_on_429_and_recovers_on_success(clock):
+    budget = make_budget()
+    budget.record(429)
+    assert budget.rate == 5
+
+    # the requests in flight get the 429 too, once per second
+    budget.record(429)
+    assert budget.rate == 5
+
+    budget.record(200)
+    assert budget.rate == pytest.approx(5.1)
+
+
+class Client:
+    session = requests.Session()
+
+
+def failing(error):
+    def call():
+        raise error
+    return call
+
+
+@pytest.mark.parametrize('error, failures', [
+    (requests.ConnectionError(), 1),
+    (requests.Timeout(), 1),
+    (TgtgAPIError(503, b''), 1),
+    (TgtgAPIError(429, b''), 1),
+    (TgtgAPIError(403, b''), 0),
+    (TgtgAPIError('ERROR', b''), 0),
+    (TgtgLoginError(401, b''), 0),
+    (TgtgPollingError('This email is not linked to a tgtg account'), 0),
+    (KeyError('items'), 0),
+])
+def test_only_transport_errors_5xx_and_429_are_failures(clock, error, failures):
+    budget = make_budget()
+    client = AsyncTgtgClient(Client(), budget=budget)
+
+    with pytest.raises(type(error)):
+        asyncio.run(client.run(failing(error)))
+
+    assert budget.failures == failures
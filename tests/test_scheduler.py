@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+
+from Scheduler import PollScheduler
+
+
+def test_users_pop_in_due_order():
+    scheduler = PollScheduler()
+    scheduler.schedule('late', 30.0)
+    scheduler.schedule('early', 10.0)
+    scheduler.schedule('middle', 20.0)
+
+    assert scheduler.next_due() == 10.0
+    assert scheduler.pop_due(25.0, slack=0) == ['early', 'middle']
+    assert scheduler.pop_due(25.0, slack=0) == []
+    assert len(scheduler) == 1
+
+
+def test_close_deadlines_are_grouped_by_the_slack():
+    scheduler = PollScheduler()
+    scheduler.schedule('a', 10.0)
+    scheduler.schedule('b', 10.5)
+    scheduler.schedule('c', 12.0)
+
+    assert scheduler.pop_due(10.0) == ['a', 'b']
+
+
+def test_rescheduled_and_removed_users_pop_once():
+    scheduler = PollScheduler()
+    scheduler.schedule('a', 10.0)
+    scheduler.schedule('b', 10.0)
+    scheduler.schedule('a', 50.0)
+    scheduler.remove('b')
+
+    assert scheduler.next_due() == 50.0
+    assert scheduler.pop_due(20.0) == []
+    assert scheduler.pop_due(50.0) == ['a']
+    assert 'a' not in scheduler
+
+
+def at(hour, minute=0):
+    return datetime(2024, 1, 1, hour, minute, tzinfo=timezone.utc).timestamp()
+
+
+def test_items_are_polled_hot_around_their_restock_time(poller):
+    bot = poller.bot
+    for day in range(5):
+        bot.restock_model.add('a', at(17) + day * 86400)
+
+    assert bot.get_item_interval_seconds('a', at(16, 45)) == bot.hot_interval_seconds
+    assert bot.get_item_interval_seconds('a', at(17, 40)) == bot.hot_interval_seconds
+    assert bot.get_item_interval_seconds('a', at(12)) == bot.cold_interval_seconds
+    assert bot.get_item_interval_seconds('unknown', at(12)) == bot.interval_seconds
+
+
+def test_users_are_polled_at_the_shortest_interval_of_their_favorites(poller):
+    bot = poller.bot
+    bot.get_interval_seconds = lambda: bot.interval_seconds
+    poller.set_stock('a', 1)
+    poller.set_stock('b', 1)
+    poller.add_user('u1', ['a', 'b'])
+    poller.poll()
+    for day in range(5):
+        bot.restock_model.add('a', at(17) + day * 86400)
+        bot.restock_model.add('b', at(8) + day * 86400)
+
+    assert bot.get_user_interval_seconds('u1', at(12)) == bot.cold_interval_seconds
+    assert bot.get_user_interval_seconds('u1', at(8)) == bot.hot_interval_seconds
@@ -0,0 +1,128 @@
+import pytest
+
+from Sharding import HashRing, ShardCoordinator
+from TooGoodToGo import TooGoodToGo
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('Sharding.time.time', clock.time)
+    return clock
+
+
+@pytest.fixture
+def coordinators(tmp_path, clock):
+    coordinators = {}
+
+    def make(worker_id):
+        coordinators[worker_id] = ShardCoordinator(worker_id, shard_count=16, lease_seconds=30, data_folder=tmp_path)
+        return coordinators[worker_id]
+
+    yield make
+    for coordinator in coordinators.values():
+        coordinator.close()
+
+
+def test_a_new_node_only_takes_keys_over():
+    ring = HashRing(['a', 'b', 'c'])
+    before = {key: ring.node_for(key) for key in range(1000)}
+
+    ring.set_nodes(['a', 'b', 'c', 'd'])
+
+    moved = [key for key in before if ring.node_for(key) != before[key]]
+    assert moved and all(ring.node_for(key) == 'd' for key in moved)
+    assert len(moved) < 500
+
+
+def test_workers_split_the_shards(coordinators):
+    first, second = coordinators('w1'), coordinators('w2')
+    first.heartbeat()
+    assert first.shards == set(range(16))
+
+    # w1 keeps the shards placed on w2 until its next heartbeat releases them
+    second.heartbeat()
+    first.heartbeat()
+    second.heartbeat()
+
+    assert first.shards and second.shards
+    assert first.shards.isdisjoint(second.shards)
+    assert first.shards | second.shards == set(range(16))
+    assert all(first.owns(user_id) != second.owns(user_id) for user_id in map(str, range(100)))
+
+
+def test_shards_of_a_dead_worker_are_taken_over(coordinators, clock):
+    first, second = coordinators('w1'), coordinators('w2')
+    for coordinator in (first, second, first, second):
+        coordinator.heartbeat()
+
+    clock.now += 31
+    first.heartbeat()
+
+    assert first.shards == set(range(16))
+    assert second.lease_expired()
+    assert not first.lease_expired()
+
+
+def test_released_shards_are_taken_over_at_once(coordinators):
+    first, second = coordinators('w1'), coordinators('w2')
+    for coordinator in (first, second, first, second):
+        coordinator.heartbeat()
+
+    second.release()
+    first.heartbeat()
+
+    assert first.shards == set(range(16))
+    assert second.shards == set()
+
+
+def make_bot(config, worker_number=None):
+    bot = TooGoodToGo(None, config, worker_number=worker_number)
+    bot.stock_history.close()
+    bot.storage.close()
+    bot.tgtg_executor.shutdown()
+    return bot
+
+
+def test_workers_need_sqlite(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(ValueError):
+        make_bot({'storage': 'json', 'workers': 2}, worker_number=0)
+
+
+def test_telegram_rate_is_split_between_the_processes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = {'workers': 2, 'telegram_messages_per_second': 30}
+
+    front = make_bot(config)
+    worker = make_bot(config, worker_number=0)
+    worker.shard.close()
+
+    assert front.get_telegram_messages_per_second() == 10
+    assert worker.get_telegram_messages_per_second() == 10
+    assert make_bot({'telegram_messages_per_second': 30}).get_telegram_messages_per_second() == 30
+
+
+def test_expired_leases_pause_the_users(poller, clock):
+    bot = poller.bot
+    bot.shard = ShardCoordinator('w1', shard_count=4, lease_seconds=30)
+    bot.shard.heartbeat()
+    poller.set_stock('a', 1)
+    poller.add_user('u1', ['a'])
+    poller.poll()
+    assert bot.eligible_users == {'u1'}
+
+    clock.now += 31
+    bot.drop_expired_shards()
+
+    assert bot.users_login_data == {} and bot.eligible_users == set()
+    assert bot.subscriber_index.subscribers('a') == set()
+    bot.shard.close()
@@ -0,0 +1,88 @@
+import time
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from TooGoodToGo import TooGoodToGo
+
+
+class Bot:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.sent = []
+
+    async def set_my_commands(self, commands):
+        pass
+
+    async def send_message(self, chat_id, **kwargs):
+        await asyncio.sleep(self.delay)
+        self.sent.append((chat_id, kwargs['text']))
+
+
+@pytest.fixture
+def make_bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bots = []
+
+    def make(telegram_bot, **config):
+        bot = TooGoodToGo(telegram_bot, config)
+        bots.append(bot)
+        return bot
+
+    yield make
+    TooGoodToGo.connected_clients.clear()
+    for bot in bots:
+        bot.stock_history.close()
+        bot.storage.close()
+        bot.tgtg_executor.shutdown()
+
+
+def test_stop_does_not_wait_for_the_idle_pollers(make_bot):
+    bot = make_bot(Bot())
+
+    async def main():
+        await bot.start()
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        await bot.stop()
+        return time.monotonic() - started
+
+    assert asyncio.run(main()) < 1
+    assert bot.poller is None and bot.geo_poller is None
+    # stopped, the pollers would return at once
+    assert asyncio.run(asyncio.wait_for(bot.idle(60), 1)) is None
+
+
+def test_unsent_messages_and_the_schedule_survive_a_restart(make_bot):
+    slow = Bot(delay=10)
+    bot = make_bot(slow, shutdown_timeout_seconds='0')
+    bot.users_login_data['u1'] = {'telegram_username': 'u1', 'last_time_token_refreshed': datetime.now()}
+    bot.save_users_login_data_to_txt('u1')
+
+    async def stop_with_messages_queued():
+        await bot.start()
+        bot.stopping = True
+        bot.poll_scheduler.schedule('u1', 1234.0)
+        for number in range(3):
+            bot.send_message('u1', f'alert {number}')
+        await asyncio.sleep(0.05)
+        await bot.stop()
+
+    asyncio.run(stop_with_messages_queued())
+    assert slow.sent == []
+
+    fast = Bot()
+    restarted = make_bot(fast, telegram_chat_messages_per_second='30')
+
+    async def restart():
+        await restarted.start()
+        schedule = dict(restarted.poll_scheduler.due_at)
+        # the checkpoint is used once
+        assert restarted.storage.read('checkpoint', ['main']) == {}
+        assert await restarted.dispatcher.drain(5)
+        await restarted.stop()
+        return schedule
+
+    assert asyncio.run(restart())['u1'] == 1234.0
+    assert fast.sent == [('u1', 'alert 0'), ('u1', 'alert 1'), ('u1', 'alert 2')]
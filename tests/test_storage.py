@@ -0,0 +1,62 @@
+from datetime import datetime
+
+import pytest
+
+from Storage import JsonStorage, SqliteStorage
+
+
+@pytest.fixture(params=[JsonStorage, SqliteStorage], ids=['json', 'sqlite'])
+def storage(request, tmp_path):
+    storage = request.param(str(tmp_path))
+    yield storage
+    storage.close()
+
+
+def test_full_save_replaces_the_table(storage):
+    storage.save('users_settings_data', {'1': {'sold_out': 1}, '2': {'sold_out': 0}})
+    storage.save('users_settings_data', {'3': {'sold_out': 1}})
+
+    assert storage.read('users_settings_data') == {'3': {'sold_out': 1}}
+
+
+def test_partial_save_keeps_the_other_rows(storage):
+    storage.save('available_items_favorites', {'1': [1, 0, 0.0, 0.0], '2': [2, 0, 0.0, 0.0], '3': [3, 0, 0.0, 0.0]})
+
+    # data may hold more rows than keys, only the rows of keys are written
+    storage.save('available_items_favorites', {'2': [5, 0, 0.0, 0.0], '4': [4, 0, 0.0, 0.0]}, ['2'])
+
+    assert storage.read('available_items_favorites') == {'1': [1, 0, 0.0, 0.0], '2': [5, 0, 0.0, 0.0],
+                                                         '3': [3, 0, 0.0, 0.0]}
+
+
+def test_partial_save_deletes_keys_missing_from_data(storage):
+    storage.save('users_login_data', {'1': {'user_id': '1'}, '2': {'user_id': '2'}})
+
+    storage.save('users_login_data', {}, ['1', 'unknown'])
+
+    assert storage.read('users_login_data') == {'2': {'user_id': '2'}}
+
+
+def test_read_keys(storage):
+    storage.save('users_login_data', {'1': {'user_id': '1'}, '2': {'user_id': '2'}})
+
+    assert storage.read('users_login_data', ['2', 'unknown']) == {'2': {'user_id': '2'}}
+
+
+def test_datetimes_round_trip(storage):
+    refreshed = datetime(2024, 5, 1, 12, 30, 15)
+    storage.save('users_login_data', {'1': {'last_time_token_refreshed': refreshed}}, ['1'])
+
+    assert storage.read('users_login_data')['1']['last_time_token_refreshed'] == refreshed
+
+
+def test_sqlite_migrates_the_json_files(tmp_path):
+    json_storage = JsonStorage(str(tmp_path))
+    json_storage.save('users_settings_data', {'1': {'sold_out': 1}})
+
+    storage = SqliteStorage(str(tmp_path))
+    try:
+        assert storage.read('users_settings_data') == {'1': {'sold_out': 1}}
+        assert (tmp_path / 'users_settings_data.json.migrated').exists()
+    finally:
+        storage.close()
@@ -0,0 +1,51 @@
+from SubscriberIndex import SubscriberIndex
+
+
+def make_index(favourites, synced_at=0.0):
+    index = SubscriberIndex()
+    for user_id, item_ids in favourites.items():
+        index.sync(user_id, item_ids, now=synced_at)
+    return index
+
+
+def test_sync_updates_the_subscribers():
+    index = make_index({'u1': ['a', 'b'], 'u2': ['b']})
+
+    index.sync('u1', ['c'], now=0.0)
+
+    assert index.subscribers('a') == set()
+    assert index.subscribers('b') == {'u2'}
+    assert index.subscribers('c') == {'u1'}
+    assert 'a' not in index.item_subscribers
+
+
+def test_remove_forgets_the_user():
+    index = make_index({'u1': ['a'], 'u2': ['a']})
+
+    index.remove('u1')
+
+    assert index.subscribers('a') == {'u2'}
+    assert index.favourites('u1') == set()
+    assert index.is_stale('u1', 60, now=1.0)
+
+
+def test_stale_users_are_always_fetched():
+    index = make_index({'u1': ['a']})
+
+    assert index.select_fetchers(['u1', 'new'], max_age_seconds=60, now=60.0) == ['u1', 'new']
+
+
+def test_fresh_users_fetched_until_every_item_is_covered():
+    index = make_index({'small': ['a'], 'big': ['a', 'b', 'c'], 'other': ['d'], 'covered': ['b', 'c']})
+
+    fetchers = index.select_fetchers(['small', 'big', 'other', 'covered'], max_age_seconds=60, now=10.0)
+
+    assert fetchers == ['big', 'other']
+    assert set().union(*(index.favourites(user_id) for user_id in fetchers)) == {'a', 'b', 'c', 'd'}
+
+
+def test_items_of_stale_users_count_as_covered():
+    index = make_index({'fresh': ['a', 'b']})
+    index.sync('stale', ['a', 'b', 'c'], now=-100.0)
+
+    assert index.select_fetchers(['fresh', 'stale'], max_age_seconds=60, now=10.0) == ['stale']
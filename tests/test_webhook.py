@@ -0,0 +1,112 @@
+import socket
+import asyncio
+
+import aiohttp
+import pytest
+
+from Webhook import WebhookServer
+
+UPDATE = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': 7, 'type': 'private'}, 'text': '/info'}}
+
+
+class Bot:
+    def __init__(self, fail_set_webhook=False, delay=0.0):
+        self.fail_set_webhook = fail_set_webhook
+        self.delay = delay
+        self.webhook = None
+        self.updates = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def set_webhook(self, **kwargs):
+        if self.fail_set_webhook:
+            raise RuntimeError('setWebhook failed')
+        self.webhook = kwargs
+
+    async def process_new_updates(self, updates):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.delay)
+        self.in_flight -= 1
+        self.updates += updates
+
+
+def free_port():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        return listener.getsockname()[1]
+
+
+def run_server(bot, test, **kwargs):
+    async def main():
+        server = WebhookServer(bot, 'https://bot.example.com/', host='127.0.0.1', port=free_port(),
+                               secret_token='secret', **kwargs)
+        await server.start()
+        try:
+            async with aiohttp.ClientSession(f'http://127.0.0.1:{server.port}') as session:
+                return await test(session)
+        finally:
+            await server.stop()
+
+    return asyncio.run(asyncio.wait_for(main(), 10))
+
+
+def test_registers_the_webhook_with_its_secret():
+    bot = Bot()
+
+    async def test(session):
+        return None
+
+    run_server(bot, test, max_concurrent_updates=500)
+
+    assert bot.webhook == {'url': 'https://bot.example.com/telegram', 'secret_token': 'secret', 'max_connections': 100}
+
+
+def test_requests_without_the_secret_or_an_update_are_refused():
+    bot = Bot()
+
+    async def test(session):
+        statuses = []
+        for headers, data in (({}, UPDATE), ({'X-Telegram-Bot-Api-Secret-Token': 'wrong'}, UPDATE),
+                              ({'X-Telegram-Bot-Api-Secret-Token': 'sécret'}, UPDATE),
+                              ({'X-Telegram-Bot-Api-Secret-Token': 'secret'}, 'not json')):
+            kwargs = {'json': data} if isinstance(data, dict) else {'data': data}
+            async with session.post('/telegram', headers=headers, **kwargs) as response:
+                statuses.append(response.status)
+        return statuses
+
+    assert run_server(bot, test) == [403, 403, 403, 400]
+    assert bot.updates == []
+
+
+def test_updates_are_processed_at_most_max_concurrent_at_once():
+    bot = Bot(delay=0.05)
+
+    async def test(session):
+        async def post(update_id):
+            async with session.post('/telegram', json=dict(UPDATE, update_id=update_id),
+                                    headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'}) as response:
+                return response.status
+
+        statuses = await asyncio.gather(*(post(update_id) for update_id in range(6)))
+        while len(bot.updates) < 6:
+            await asyncio.sleep(0.01)
+        return statuses
+
+    assert run_server(bot, test, max_concurrent_updates=2) == [200] * 6
+    assert sorted(update.update_id for update in bot.updates) == list(range(6))
+    assert bot.max_in_flight == 2
+
+
+def test_start_fails_and_frees_the_port_when_the_webhook_is_refused():
+    port = free_port()
+
+    async def main():
+        server = WebhookServer(Bot(fail_set_webhook=True), 'https://bot.example.com', host='127.0.0.1', port=port)
+        with pytest.raises(RuntimeError):
+            await server.start()
+        assert server.runner is None
+
+    asyncio.run(main())
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', port))